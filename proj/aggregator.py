@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Telemetry aggregator of a group of cars
+
+Runs next to a group of cars (same machine) between them and the server.
+A car started with client.py --group G joins the platoon through the server
+as before, then attaches to aggregator G and detaches from the server, so
+the server keeps one connection per group instead of one per car:
+
+    car -> aggregator   position updates, acked here like the server does
+                        (every MSG_POS, MSG_STREAM cumulatively), STOP/QUIT
+    aggregator -> server  every 1/RATE seconds one MSG_BATCH frame holding the
+                        latest update of every car that sent one since the
+                        last batch (older updates are dropped), STOP/QUIT at once
+    server -> aggregator  STOP/QUIT broadcast, passed on to every car of the
+                        group but its origin, REWIRE passed on to its car
+
+A car closing its connection is passed on as its QUIT, unless it left the
+platoon (MSG_LEAVE, passed on at once), the server going away
+closes every car connection, so failures stop the platoon as before.
+
+    python3 aggregator.py NAMEOFSERVERMACHINE GROUP [--platoon K] [--transport tcp|unix] [--rate HZ] [--stats SEC]
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import sys, time, socket, asyncio, argparse
+import protocol, transport, metrics
+from ingest import ACKEVERY, ACKINTERVAL
+
+#-----------------------------------------------------------------------------
+# Aggregator of one group, all connections handled by one event loop
+#-----------------------------------------------------------------------------
+class Aggregator:
+    def __init__(self, server, group, platoon=0, link=None, rate=50.0, host=None):
+        self.server = server                    # ADDRESS OF SERVER
+        self.group = group
+        self.platoon = platoon
+        self.link = link or transport.TCPTransport()
+        self.rate = rate                        # BATCHES PER SECOND TO THE SERVER
+        self.host = host or socket.gethostbyname(socket.gethostname())
+        self.cars = {}                          # CAR ID -> STREAM OF ATTACHED CAR
+        self.latest = {}                        # CAR ID -> LATEST UPDATE NOT SENT YET
+        self.upstream = None                    # STREAM TO SERVER
+        self.done = None                        # SET WHEN THE SERVER CLOSED THE CONNECTION
+        self.updates = metrics.counter("updates_in", group=group)       # UPDATES RECEIVED FROM CARS
+        self.entries = metrics.counter("entries_out", group=group)      # UPDATES SENT IN BATCHES
+        self.batches = metrics.counter("batches_out", group=group)
+
+    #-------------------------------------------------------------------------
+    # CONNECT TO SERVER, SERVE CARS UNTIL THE SERVER CLOSES THE CONNECTION
+    #-------------------------------------------------------------------------
+    async def run(self):
+        self.done = asyncio.Event()
+        sock = self.link.connect(self.server, transport.platoon_port(self.platoon), 15)
+        sock.sendall(("g" + str(self.group) + "\n").encode("utf-8"))  # NOT A CAR: MY GROUP, NO ID, NO START POSITION
+        reader, self.upstream = await asyncio.open_connection(sock=sock)
+        port = transport.group_port(self.platoon, self.group)
+        cars = await self.link.start_server(self.handle_car, self.host, port, 1024)
+        print("SYSTEM: Aggregator of group {} is ready on port {}.".format(self.group, port))
+        async with cars:
+            batcher = asyncio.ensure_future(self.send_batches())
+            await self.relay(reader)
+            batcher.cancel()
+        for writer in self.cars.values():       # CARS SEE THE SERVER GOING AWAY
+            writer.close()
+        print("SYSTEM: Server closed the connection, {} updates received, {} sent in {} batches.".format(
+            self.updates.value, self.entries.value, self.batches.value))
+
+    #-------------------------------------------------------------------------
+    # PASS STOP/QUIT BROADCAST BY THE SERVER ON TO EVERY CAR BUT ITS ORIGIN,
+    # REWIRE ON TO THE CAR IT IS FOR
+    #-------------------------------------------------------------------------
+    async def relay(self, reader):
+        while True:
+            try:
+                msg = await protocol.readmsg(reader)
+            except ConnectionError:             # SERVER EXITED WITH A BATCH UNREAD
+                msg = None
+            if msg is None:
+                break
+            if msg.type == protocol.MSG_REWIRE:
+                writer = self.cars.get(msg.carid)
+                if writer is not None and not writer.is_closing():
+                    writer.write(protocol.pack(*msg))
+                continue
+            if msg.type not in protocol.UNBROADCAST:
+                continue
+            frame = protocol.pack(*msg)
+            for carid, writer in self.cars.items():
+                if carid != msg.carid and not writer.is_closing():
+                    writer.write(frame)
+        self.done.set()
+
+    #-------------------------------------------------------------------------
+    # EVERY 1/rate SECONDS, SEND THE LATEST UPDATE OF EVERY CAR THAT SENT ONE
+    #-------------------------------------------------------------------------
+    async def send_batches(self):
+        seq = 0
+        interval = 1.0/self.rate
+        while True:
+            await asyncio.sleep(interval)
+            if not self.latest:
+                continue
+            entries, self.latest = list(self.latest.values()), {}
+            seq += 1
+            self.upstream.write(protocol.pack_batch(self.group, seq, entries))
+            try:
+                await self.upstream.drain()
+            except ConnectionError:             # SERVER GONE, relay() ENDS THE RUN
+                break
+            self.entries.inc(len(entries))
+            self.batches.inc()
+
+    #-------------------------------------------------------------------------
+    # ONE COROUTINE PER CAR: ATTACH, THEN UPDATES AND EVENTS
+    #-------------------------------------------------------------------------
+    async def handle_car(self, reader, writer):
+        msg = await protocol.readmsg(reader)
+        if msg is None or msg.type != protocol.MSG_ATTACH:
+            writer.close()
+            return
+        carid = msg.carid
+        self.cars[carid] = writer
+        unacked = 0                             # STREAMED UPDATES SINCE LAST CUMULATIVE ACK
+        lastack = time.monotonic()
+        try:
+            while not self.done.is_set():
+                msg = await protocol.readmsg(reader)
+                if msg is None:                 # CAR CLOSED THE CONNECTION, SERVER QUITS AS IF IT WAS CONNECTED
+                    self.forward(protocol.pack(protocol.MSG_QUIT, carid))
+                    break
+                if msg.type in (protocol.MSG_POS, protocol.MSG_STREAM):
+                    self.latest[carid] = protocol.Entry(carid, msg.seq, msg.pos, msg.speed, msg.ts)
+                    self.updates.inc()
+                    unacked += 1
+                    now = time.monotonic()
+                    # SAME ACKS AS THE SERVER: EVERY MSG_POS, MSG_STREAM CUMULATIVELY
+                    if msg.type == protocol.MSG_POS or unacked >= ACKEVERY or now - lastack >= ACKINTERVAL:
+                        writer.write(protocol.pack(protocol.MSG_ACK, carid, msg.seq))
+                        await writer.drain()
+                        unacked = 0
+                        lastack = now
+                elif msg.type in protocol.UNBROADCAST or msg.type == protocol.MSG_QUIT:
+                    self.forward(protocol.pack(*msg))
+                elif msg.type == protocol.MSG_LEAVE:    # CAR LEFT, ITS CONNECTION CLOSING IS NO FAILURE
+                    self.latest.pop(carid, None)
+                    self.forward(protocol.pack(*msg))
+                    break
+        except ConnectionError:
+            self.forward(protocol.pack(protocol.MSG_QUIT, carid))
+        except asyncio.CancelledError:          # EVENT LOOP SHUTTING DOWN AFTER THE SERVER WENT AWAY
+            pass
+        finally:
+            del self.cars[carid]
+            writer.close()
+
+    #-------------------------------------------------------------------------
+    # SEND AN EVENT TO THE SERVER AT ONCE, AHEAD OF THE NEXT BATCH
+    #-------------------------------------------------------------------------
+    def forward(self, frame):
+        if not self.upstream.is_closing():
+            self.upstream.write(frame)
+
+#-----------------------------------------------------------------------------
+################################ MAIN FUNCTION ###############################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch telemetry of a group of cars to the platoon server")
+    parser.add_argument("server", help="name of server machine")
+    parser.add_argument("group", type=int, help="group number, cars attach with client.py --group GROUP")
+    parser.add_argument("--platoon", type=int, default=0, help="platoon of the group (default %(default)s)")
+    parser.add_argument("--transport", choices=("tcp", "unix"), default="tcp", help="transport to server and cars (default %(default)s)")
+    parser.add_argument("--rate", type=float, default=50.0, help="batches per second to the server (default %(default)s)")
+    parser.add_argument("--stats", type=float, default=0, help="print metrics to stderr every SEC seconds (default off)")
+    args = parser.parse_args()
+    if not 0 <= args.group < transport.MAXGROUPS:
+        sys.exit("SYSTEM: group must be 0 .. {}".format(transport.MAXGROUPS - 1))
+    if args.stats:
+        metrics.registry.start_dump(args.stats)
+    aggregator = Aggregator(socket.gethostbyname(args.server), args.group, args.platoon, transport.get(args.transport), args.rate)
+    try:
+        asyncio.run(aggregator.run())
+    except OSError as e:
+        print("Connection error: {}".format(e))
+        sys.exit(1)
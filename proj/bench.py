@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmarks
+
+Measures the paths the simulation depends on with the real code, and prints
+one JSON document so runs can be compared across commits and platoon sizes:
+
+    propagation     front -> back position latency, sendbpos() -> updatefpos()
+                    (time from the front car publishing a position to the
+                    car behind receiving it)
+    control_hop     one forwarded event through detectbevent() (back link in,
+                    front link out)
+    ingest          MSG_STREAM updates per second through receivePos() with
+                    N streaming cars
+    frame           time per frame of start_simulation() with N cars (needs
+                    pygame, uses the dummy video driver without a display)
+    cpu             CPU of the server and every client process of a real
+                    N-car run (server.py --headless, N x client.py)
+
+Latencies and frame times are in milliseconds.
+
+    python3 bench.py [--cars N] [--duration SEC] [--transport unix|tcp] [--only NAME ...] [--out FILE]
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import os, sys, time, json, socket, argparse, platform, contextlib, tempfile, subprocess, pty
+from threading import Thread, Event
+import numpy as np
+import protocol, transport, client
+from carstate import CarState, CMD_ACCELERATE, CMD_FRONTSTATE, CMD_QUIT
+from ingest import IngestServer, start_positions
+from snapshot import SnapshotStore
+from broadcast import Broadcast
+from peers import Links
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#-----------------------------------------------------------------------------
+# Function to summarize samples in seconds as milliseconds
+#-----------------------------------------------------------------------------
+def summarize(samples):
+    if not samples:
+        return {"count": 0}
+    ms = np.asarray(samples)*1000.0
+    return {"count": len(ms), "mean": float(ms.mean()), "p50": float(np.percentile(ms, 50)),
+            "p90": float(np.percentile(ms, 90)), "p99": float(np.percentile(ms, 99)), "max": float(ms.max())}
+
+#-----------------------------------------------------------------------------
+# Car state recording when every front position arrives
+#-----------------------------------------------------------------------------
+class ArrivalState(CarState):
+    def __init__(self):
+        CarState.__init__(self, 2, 0, client.posrate)
+        self.arrivals = []                      # (FRONT POSITION, ARRIVAL TIME)
+
+    def post(self, cmd, arg=None):
+        if cmd == CMD_FRONTSTATE:               # (POSITION, SPEED, TIME RECEIVED)
+            arg = arg[0]
+        self.arrivals.append((arg, time.perf_counter()))
+
+#-----------------------------------------------------------------------------
+# Function to measure front -> back position propagation latency
+#-----------------------------------------------------------------------------
+def bench_propagation(duration):
+    front, back = socket.socketpair()
+    sender = CarState(1, 0, client.posrate)
+    receiver = ArrivalState()
+    sender.post(CMD_ACCELERATE, 0.5)
+    published = {}                              # POSITION -> TIME IT WAS PUBLISHED BY THE OWNER
+
+    Thread(target=client.sendbpos, args=(sender, Links(1, None, None, back=front, backID=2)), daemon=True).start()
+    Thread(target=client.updatefpos, args=(receiver, Links(2, None, None, front=back, frontID=1), Broadcast(None, 2)), daemon=True).start()
+    # FRONT CAR OWNER LOOP, SAME TICK RATE AS client.py
+    clock = client.SimClock(client.tickrate)
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        snap = sender.tick(clock.tick())
+        published[snap.pos] = time.perf_counter()
+    sender.post(CMD_QUIT)
+    sender.tick(0)
+    front.close()
+
+    samples = [t - published[pos] for pos, t in receiver.arrivals if pos in published]
+    return dict(summarize(samples), pubrate=client.pubrate, tickrate=client.tickrate)
+
+#-----------------------------------------------------------------------------
+# Function to measure latency of one event forwarded by detectbevent()
+#-----------------------------------------------------------------------------
+def bench_control_hop(duration):
+    backCar, backLink = socket.socketpair()     # CAR BEHIND -> ME
+    frontLink, frontCar = socket.socketpair()   # ME -> CAR IN FRONT
+    state = CarState(2, 0, client.posrate)
+    links = Links(2, None, None, front=frontLink, frontID=1, back=backLink, backID=3)
+    Thread(target=client.detectbevent, args=(state, links, Broadcast(None, 2)), daemon=True).start()
+
+    samples = []
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        start = time.perf_counter()
+        protocol.sendmsg(backCar, protocol.MSG_ACC, 3, len(samples))
+        msg = protocol.recvmsg(frontCar)
+        samples.append(time.perf_counter() - start)
+        if msg is None or msg.type != protocol.MSG_ACC:
+            break
+        state.apply_commands()                  # KEEP COMMAND QUEUE SHORT
+    backCar.close()
+    return summarize(samples)
+
+#-----------------------------------------------------------------------------
+# Function to read and drop everything received until the connection closes
+#-----------------------------------------------------------------------------
+def drain(sock):
+    while True:
+        try:
+            if not sock.recv(65536):
+                return
+        except OSError:                         # SERVER RESET THE CONNECTION AT TEARDOWN
+            return
+
+#-----------------------------------------------------------------------------
+# Function to join the ingest server like client.py and stream updates
+#-----------------------------------------------------------------------------
+def streaming_car(link, lead, numcars, ready, go, stop):
+    sock = link.connect("127.0.0.1", 6789)
+    sock.sendall(b"0")
+    data = b""
+    while b"\n" not in data:
+        data += sock.recv(4096)
+    carid, data = data.split(b"\n", 1)
+    if lead:
+        sock.sendall(b"c"*(numcars - 1) + b"s")
+    decoder = json.JSONDecoder()
+    while True:
+        try:
+            decoder.raw_decode(data.decode("utf-8"))
+            break
+        except ValueError:
+            data += sock.recv(4096)
+    sock.sendall(b"xpos")
+    sock.recv(4096)
+    sock.sendall(protocol.pack(protocol.MSG_READY, int(carid)))     # NO PEERS, GO IS DRAINED BELOW
+    # DRAIN CUMULATIVE ACKS SO THE SERVER NEVER BLOCKS ON A FULL SOCKET
+    Thread(target=drain, args=(sock,), daemon=True).start()
+    batch = protocol.pack(protocol.MSG_STREAM, int(carid), 1, 1.0, 0.5)*64
+    ready.set()
+    go.wait()
+    try:
+        while not stop.is_set():
+            sock.sendall(batch)
+    except OSError:
+        pass
+
+#-----------------------------------------------------------------------------
+# Function to measure MSG_STREAM updates per second ingested by receivePos()
+#-----------------------------------------------------------------------------
+def bench_ingest(numcars, duration):
+    link = transport.InProcTransport()
+    ingest = IngestServer("127.0.0.1", 6789, link=link)
+    ingest.start()
+    go, stop = Event(), Event()
+    readies = []
+    for i in range(numcars):
+        ready = Event()
+        readies.append(ready)
+        Thread(target=streaming_car, args=(link, i == 0, numcars, ready, go, stop), daemon=True).start()
+        if i == 0:
+            while not ingest.leadSeen:
+                time.sleep(0.01)
+    for ready in readies:
+        ready.wait()
+    # EVERY UPDATE ADDS 2 TO THE SEQUENCE OF ITS SLOT
+    go.set()
+    time.sleep(0.2)                             # WARM UP
+    first, start = int(ingest.store.snapshot()["seq"].sum()), time.perf_counter()
+    time.sleep(duration)
+    last, end = int(ingest.store.snapshot()["seq"].sum()), time.perf_counter()
+    stop.set()
+    ingest.stop()
+    updates = (last - first)//2
+    return {"cars": numcars, "updates": updates, "per_second": updates/(end - start)}
+
+#-----------------------------------------------------------------------------
+# Function to measure frame time of the pygame render loop
+#-----------------------------------------------------------------------------
+def bench_frame(numcars, duration):
+    if "DISPLAY" not in os.environ:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import server
+    if server.pygame is None:
+        return {"skipped": "pygame is not installed"}
+
+    # INGEST STATE AS AFTER THE LEAD CAR STARTED THE SIMULATION, FED BY A MOVING PLATOON
+    ingest = IngestServer("127.0.0.1", 6789)
+    ingest.clientList = {i+1: ("127.0.0.1", 0) for i in range(numcars)}
+    ingest.start_x = start_positions(numcars)
+    ingest.store = SnapshotStore(numcars)
+    ingest.store.reset(ingest.start_x, time.time())
+
+    def drive():
+        pos = np.array(ingest.start_x, dtype=float)
+        while not ingest.simulationExit:
+            pos += 1.0
+            for i in range(numcars):
+                ingest.store.update(i, pos[i], 0.5, time.time())
+            time.sleep(0.005)
+    Thread(target=drive, daemon=True).start()
+    Thread(target=lambda: (time.sleep(duration), ingest.stop()), daemon=True).start()
+
+    frametimes = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(HERE)                          # car2.png IS LOADED FROM THE CURRENT DIRECTORY
+        try:
+            server.start_simulation(ingest, os.path.join(tmp, "bench_"), frametimes)
+        finally:
+            os.chdir(cwd)
+        server.pygame.quit()
+    return dict(summarize(frametimes[1:]), cars=numcars, driver=os.environ.get("SDL_VIDEODRIVER", "default"))
+
+#-----------------------------------------------------------------------------
+# Function to run server and clients as processes and measure CPU of each
+#-----------------------------------------------------------------------------
+def bench_cpu(numcars, duration, link):
+    python = sys.executable
+    devnull = subprocess.DEVNULL
+    procs = {}
+    ttys = []
+    tmp = tempfile.TemporaryDirectory()
+    start = time.monotonic()
+    try:
+        procs["server"] = subprocess.Popen([python, os.path.join(HERE, "server.py"), "--headless", "--transport", link],
+                                           cwd=tmp.name, stdin=devnull, stdout=devnull, stderr=devnull)
+        time.sleep(1.0)                         # SERVER IS LISTENING
+        for i in range(numcars):
+            master, slave = pty.openpty()       # CLIENTS READ KEYS FROM A TERMINAL
+            procs["car{}".format(i+1)] = subprocess.Popen([python, os.path.join(HERE, "client.py"), "localhost", "--transport", link],
+                                                          cwd=tmp.name, stdin=slave, stdout=devnull, stderr=devnull)
+            os.close(slave)
+            ttys.append(master)
+            time.sleep(0.3 if i == 0 else 0.05) # LEAD CAR CONNECTS FIRST
+        os.write(ttys[0], b"c"*(numcars - 1) + b"s")
+        time.sleep(1.0 + 0.01*numcars)          # ROSTER SENT AND PEERS LINKED
+        os.write(ttys[0], b"dd")
+        time.sleep(duration)
+        os.write(ttys[0], b"q")
+
+        # COLLECT RESOURCE USAGE OF EVERY PROCESS
+        results = {}
+        deadline = time.monotonic() + 10
+        pending = dict(procs)
+        while pending:
+            for name, proc in list(pending.items()):
+                pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                if pid == 0:
+                    if time.monotonic() < deadline:
+                        continue
+                    proc.kill()
+                    pid, status, usage = os.wait4(proc.pid, 0)
+                proc.returncode = status
+                wall = time.monotonic() - start
+                cpu = usage.ru_utime + usage.ru_stime
+                results[name] = {"cpu_s": cpu, "cpu_percent": 100.0*cpu/wall}
+                del pending[name]
+            time.sleep(0.05)
+    finally:
+        for proc in procs.values():
+            if proc.returncode is None:
+                proc.kill()
+        for fd in ttys:
+            os.close(fd)
+        tmp.cleanup()
+    cars = [results[name]["cpu_percent"] for name in results if name != "server"]
+    return {"cars": numcars, "transport": link, "processes": results,
+            "car_cpu_percent_mean": float(np.mean(cars)) if cars else 0.0}
+
+BENCHMARKS = ("propagation", "control_hop", "ingest", "frame", "cpu")
+
+#-----------------------------------------------------------------------------
+################################ MAIN FUNCTION ###############################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="P2P platoon simulation benchmarks")
+    parser.add_argument("--cars", type=int, default=5, help="platoon size (default %(default)s)")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per benchmark (default %(default)s)")
+    parser.add_argument("--transport", choices=("unix", "tcp"), default="unix", help="transport of the process benchmark (default %(default)s)")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, help="benchmarks to run")
+    parser.add_argument("--out", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {"cars": args.cars, "duration": args.duration, "time": time.time(),
+               "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+    for name in args.only:
+        print("SYSTEM: running {}...".format(name), file=sys.stderr)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):   # KEEP SIMULATION OUTPUT OUT OF THE REPORT
+            if name == "propagation":
+                results[name] = bench_propagation(args.duration)
+            elif name == "control_hop":
+                results[name] = bench_control_hop(args.duration)
+            elif name == "ingest":
+                results[name] = bench_ingest(args.cars, args.duration)
+            elif name == "frame":
+                results[name] = bench_frame(args.cars, args.duration)
+            elif name == "cpu":
+                results[name] = bench_cpu(args.cars, args.duration, args.transport)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report + "\n")
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Platoon-wide broadcast of urgent events
+
+STOP and QUIT relayed hop by hop reach the ends of the platoon after up to
+N-1 hops. The car where such an event starts also sends it once to the
+server (MSG_BSTOP, MSG_BQUIT), which writes it to every other car, so every
+car gets it after two links whatever its place in the platoon. The hop by
+hop relay stays as a fallback.
+
+Every copy carries the event ID (car ID and sequence number of the origin)
+and the send time at the origin: the first copy to arrive is applied and
+relayed, later copies are dropped. The latency of every copy is recorded per
+path (server, hop) in the metrics registry.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import time
+from threading import Lock
+import protocol, metrics
+
+#-----------------------------------------------------------------------------
+# Urgent events of one car: originate, broadcast and drop duplicates
+#-----------------------------------------------------------------------------
+class Broadcast:
+    def __init__(self, sock, carid):
+        self.sock = sock                        # LINK TO SERVER, SHARED WITH THE SENDING THREADS (transport.SerialSocket)
+        self.carid = carid
+        self.seen = set()                       # (ORIGIN CAR ID, SEQ) OF EVENTS ALREADY APPLIED
+        self.lock = Lock()                      # seen IS SHARED BY ALL RECEIVING THREADS
+        self.latency = {path: metrics.histogram("event_latency_seconds", car=carid, path=path)
+                        for path in ("server", "hop")}
+
+    #-------------------------------------------------------------------------
+    # START AN EVENT (MSG_STOP OR MSG_QUIT) HERE, RETURNS IT FOR THE HOP BY HOP RELAY
+    #-------------------------------------------------------------------------
+    def originate(self, msgtype, seq, pos=0.0, speed=0.0):
+        event = protocol.Message(msgtype, self.carid, seq, pos, speed, time.time())
+        with self.lock:
+            self.seen.add((event.carid, event.seq))
+        try:
+            self.sock.sendall(protocol.pack(protocol.BROADCAST[msgtype], *event[1:]))
+        except OSError:                         # SERVER GONE, HOP BY HOP RELAY STILL CARRIES THE EVENT
+            pass
+        return event
+
+    #-------------------------------------------------------------------------
+    # TRUE IF msg (RECEIVED ON path) IS THE FIRST COPY OF ITS EVENT
+    #-------------------------------------------------------------------------
+    def first(self, msg, path):
+        latency = time.time() - msg.ts          # ORIGIN CLOCK, ONLY EXACT IF CARS SHARE A HOST OR CLOCK
+        self.latency[path].observe(max(latency, 0.0))
+        with self.lock:
+            if (msg.carid, msg.seq) in self.seen:
+                return False
+            self.seen.add((msg.carid, msg.seq))
+        name = "Stop" if msg.type in (protocol.MSG_STOP, protocol.MSG_BSTOP) else "Quit"
+        print("SYSTEM: {} from car {} after {:.2f} ms ({})\r".format(name, msg.carid, latency*1000.0, path))
+        return True
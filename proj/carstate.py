@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-owner client state
+
+Position, speed, front car position and the end of simulation flag of one
+car are owned by the main loop of client.py. Other threads never write them:
+they post commands (accelerate, decelerate, stop, front position, quit) to a
+queue that the owner drains once per tick, and they read the latest
+snapshot, an immutable tuple replaced in one assignment after every tick.
+
+Between position updates from the front car its position is dead reckoned:
+extrapolated from the last position and speed received, at the expected
+rate of setpos() (see predict). The front car runs the same prediction and
+only sends a correction when its real position is too far from it.
+
+Everything that changes the state goes through apply() on the owner thread,
+and the random factor of setpos() comes from the car's own seeded generator,
+so a run is reproduced exactly by replaying the seed and the commands applied
+at every tick (see replay.py). Front car states are stored against the
+simulation time of the car, not the wall clock, for the same reason.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import queue, random, time
+from collections import namedtuple
+
+#-----------------------------------------------------------------------------
+# CONTROLLER CONSTANTS
+MAXSPEED = 1.0          # MAX SPEED FOR USER ACCELERATION
+MAXHEADWAY = 151        # MAX HEADWAY
+MINHEADWAY = 150        # MIN HEADWAY
+CRASHHEADWAY = 100      # CAR WIDTH, HEADWAY AT OR BELOW THIS IS A CRASH
+HEADWAYACC = 0.05       # SPEED CHANGE WHEN HEADWAY IS TOO BIG
+CATCHUPSPEED = 2.0      # MAX SPEED GAINED WHEN HEADWAY IS TOO BIG (E.G. REWIRED TO A CAR FAR AHEAD)
+DECELERATION = 0.1      # SPEED CHANGE ON DECELERATE
+DRIFT = 0.5             # MEAN OF THE RANDOM FACTOR IN setpos()
+
+# HEADWAY STATES (SEE getheadway)
+HEADWAY_OK = 0
+HEADWAY_BIG = 1
+HEADWAY_SMALL = -1
+HEADWAY_CRASH = -10
+
+# COMMANDS POSTED TO THE OWNER
+CMD_ACCELERATE = 1      # ARG: SPEED CHANGE
+CMD_DECELERATE = 2
+CMD_STOP = 3
+CMD_FRONTPOS = 4        # ARG: POSITION OF FRONT CAR
+CMD_QUIT = 5
+CMD_FRONTSTATE = 6      # ARG: (POSITION, SPEED, MONOTONIC TIME RECEIVED) OF FRONT CAR, DEAD RECKONED
+                        # (APPLIED AS (POSITION, SPEED, SIMULATION TIME RECEIVED))
+
+#-----------------------------------------------------------------------------
+# State published after every tick, frontpos is -1 if there is no front car
+#-----------------------------------------------------------------------------
+Snapshot = namedtuple("Snapshot", "pos speed frontpos headway endgame")
+
+#-----------------------------------------------------------------------------
+# Function to predict a position elapsed seconds after it was pos at speed
+#-----------------------------------------------------------------------------
+def predict(pos, speed, elapsed, posrate):
+    return pos + speed * posrate * DRIFT * elapsed
+
+#-----------------------------------------------------------------------------
+# Function to calculate headway state
+# RETURNING    0 IF I'M LEADCAR OR HEADWAY IS OKAY
+#              1 IF HEADWAY IS TOO BIG
+#             -1 IF HEADWAY IS TOO SMALL
+#            -10 IF CRASH
+#-----------------------------------------------------------------------------
+def getheadway(pos, frontpos):
+    # IF THERE IS NO FRONT CAR
+    if frontpos == -1:
+        return HEADWAY_OK
+    headway = frontpos - pos
+    # HEADWAY TOO BIG
+    if headway > MAXHEADWAY:
+        return HEADWAY_BIG
+    # HEADWAY TOO SMALL
+    elif headway < MINHEADWAY:
+        # CRASH (CAR WIDTH = 100, EACH CAR POS = CENTER OF CAR'S LOCATION)
+        if headway <= CRASHHEADWAY:
+            return HEADWAY_CRASH
+        return HEADWAY_SMALL
+    # ACCEPTIBLE HEADWAY
+    return HEADWAY_OK
+
+#-----------------------------------------------------------------------------
+# State of one car, written only by the thread calling tick()
+#-----------------------------------------------------------------------------
+class CarState:
+    def __init__(self, carid, pos, posrate, seed=None, log=None):
+        self.carid = carid                      # MY ID, SENT IN EVERY MESSAGE
+        self.pos = pos                          # MY POSITION
+        self.speed = 0                          # MY SPEED
+        self.frontpos = -1                      # FRONT POSITION (IF NO FRONT CAR, SET TO -1)
+        self.front = None                       # LAST (POSITION, SPEED, SIMULATION TIME) OF FRONT CAR IF DEAD RECKONED
+        self.endgame = False                    # FLAG FOR ON GOING SIMULATION
+        self.posrate = posrate                  # POSITION UNITS PER SECOND AT SPEED 1.0
+        self.commands = queue.SimpleQueue()     # COMMANDS FROM OTHER THREADS
+        self.seed = random.randrange(2**32) if seed is None else seed
+        self.rng = random.Random(self.seed)     # RANDOM FACTOR OF setpos()
+        self.time = 0.0                         # SIMULATION SECONDS SINCE START
+        self.ticks = 0                          # TICKS SINCE START
+        self.log = log                          # IF SET, EVERY APPLIED COMMAND IS WRITTEN TO IT
+        self.snapshot = self.publish(HEADWAY_OK)
+
+    #-------------------------------------------------------------------------
+    # POST A COMMAND FROM ANY THREAD, APPLIED ON THE NEXT TICK
+    #-------------------------------------------------------------------------
+    def post(self, cmd, arg=None):
+        self.commands.put((cmd, arg))
+
+    #-------------------------------------------------------------------------
+    # ONE TICK OF THE OWNER: APPLY COMMANDS, MOVE, FOLLOW FRONT CAR, PUBLISH
+    #-------------------------------------------------------------------------
+    def tick(self, dt):
+        self.apply_commands()
+        return self.step(dt)
+
+    #-------------------------------------------------------------------------
+    # MOVE AND FOLLOW FRONT CAR, DEPENDS ONLY ON STATE AND SEED (REPLAYED AS IS)
+    #-------------------------------------------------------------------------
+    def step(self, dt):
+        # EXTRAPOLATE FRONT POSITION FROM ITS LAST UPDATE
+        if self.front is not None:
+            pos, speed, received = self.front
+            self.frontpos = predict(pos, speed, self.time - received, self.posrate)
+        self.setpos(dt)
+        headway = getheadway(self.pos, self.frontpos)
+        # IF HEADWAY IS TOO BIG, ACCELERATE (UP TO CATCHUPSPEED, FASTER OVERSHOOTS INTO A CRASH)
+        if headway == HEADWAY_BIG:
+            if self.speed < CATCHUPSPEED:
+                self.speed += HEADWAYACC
+        # IF HEADWAY IS TOO SMALL, DECELERATE
+        elif headway == HEADWAY_SMALL:
+            self.decelerate()
+        self.time += dt
+        self.ticks += 1
+        self.snapshot = self.publish(headway)
+        return self.snapshot
+
+    #-------------------------------------------------------------------------
+    # END SIMULATION FROM THE OWNER (E.G. CRASH)
+    #-------------------------------------------------------------------------
+    def finish(self):
+        self.endgame = True
+        self.snapshot = self.publish(self.snapshot.headway)
+
+    #-------------------------------------------------------------------------
+    # DRAIN COMMAND QUEUE
+    #-------------------------------------------------------------------------
+    def apply_commands(self):
+        now = None
+        while True:
+            try:
+                cmd, arg = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            # FRONT STATE AGE ON THE WALL CLOCK -> SIMULATION TIME IT WAS RECEIVED
+            if cmd == CMD_FRONTSTATE:
+                if now is None:
+                    now = time.monotonic()
+                pos, speed, received = arg
+                arg = (pos, speed, self.time - (now - received))
+            self.apply(cmd, arg)
+
+    #-------------------------------------------------------------------------
+    # APPLY ONE COMMAND (LOGGED WITH THE TICK IT IS APPLIED BEFORE)
+    #-------------------------------------------------------------------------
+    def apply(self, cmd, arg):
+        if self.log is not None:
+            self.log.write(self.ticks, cmd, arg)
+        if cmd == CMD_ACCELERATE:
+            # IF MY SPEED IS LESS THAN MAX SPEED, INCREASE SPEED
+            if self.speed < MAXSPEED:
+                self.speed += arg
+        elif cmd == CMD_DECELERATE:
+            self.decelerate()
+        elif cmd == CMD_STOP:
+            self.speed = 0
+        elif cmd == CMD_FRONTPOS:
+            self.frontpos = arg
+            self.front = None
+        elif cmd == CMD_FRONTSTATE:
+            self.front = arg
+        elif cmd == CMD_QUIT:
+            self.endgame = True
+
+    #-------------------------------------------------------------------------
+    # DECELERATE: IF MOVING, DECREASE SPEED ELSE SET SPEED TO 0
+    #-------------------------------------------------------------------------
+    def decelerate(self):
+        if self.speed > 0:
+            self.speed -= DECELERATION
+        else:
+            self.speed = 0
+
+    #-------------------------------------------------------------------------
+    # SET CURRENT POSITION, dt SECONDS OF SIMULATION TIME
+    #-------------------------------------------------------------------------
+    def setpos(self, dt):
+        # IF SPEED IS NEGATIVE, SET TO 0
+        if self.speed < 0:
+            self.speed = 0
+        self.pos = self.pos + self.speed * self.posrate * dt * self.rng.random()
+
+    #-------------------------------------------------------------------------
+    # IMMUTABLE COPY FOR OTHER THREADS
+    #-------------------------------------------------------------------------
+    def publish(self, headway):
+        return Snapshot(self.pos, self.speed, self.frontpos, headway, self.endgame)
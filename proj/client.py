@@ -7,56 +7,83 @@ Created on Wed Mar  6 17:06:22 2019
 """
 
 
-import socket, sys, traceback, json, time, os, termios, tty, struct, random, errno
-from threading import Thread, Lock
+import socket, sys, traceback, json, time, os, termios, tty, errno, argparse, random
+from threading import Thread, Event
+from itertools import count
+import protocol, transport, metrics
+from simclock import SimClock
+from publisher import Publisher
+from broadcast import Broadcast
+from peers import Links
+from replay import EventLog
+from snapshot import SharedStore, shared_name
+from carstate import CarState, CMD_ACCELERATE, CMD_DECELERATE, CMD_STOP, CMD_FRONTPOS, CMD_FRONTSTATE, CMD_QUIT, predict, HEADWAY_BIG, HEADWAY_SMALL, HEADWAY_CRASH
 
 # GLOBAL VARIABLES 
-lock = Lock()           # LOCK FOR SYNCHRONIZING GLOBAL VARIABLES
 listReceived = False    # FLAG FOR CLIENT LIST RECEIVED FROM SERVER
-endgame = False         # FLAG FOR ON GOING SIMULATION
-clientList = {}         # LIST OF CLIENTS
-mypos = 0               # MY POSITION
-myspeed = 0             # MY SPEED
-maxspeed = 1.0          # MAX SPEED
-frontpos = -1           # FRONT POSITION (IF NO FRONT CAR, SET TO -1)
-maxheadway = 151        # MAX HEADWAY
-minheadway = 150        # MIN HEADWAY
+maxclients = 500        # MAX NUMBER OF CARS THE LEAD CAR CAN ACCEPT
+tickrate = 100          # PHYSICS TICKS PER SECOND
+posrate = 10.0          # POSITION UNITS PER SECOND AT SPEED 1.0 (BEFORE RANDOM FACTOR)
+stream = False          # STREAM UPDATES TO SERVER WITHOUT WAITING FOR EACH ACK
+sendrate = 100          # POSITION UPDATES PER SECOND TO SERVER, ACKED OR STREAMED (0 = AS FAST AS POSSIBLE)
+pubrate = 100           # MAX POSITION UPDATES PER SECOND TO THE CAR BEHIND
+pubthreshold = 0.1      # MAX ERROR OF THE CAR BEHIND PREDICTING MY POSITION BEFORE A CORRECTION IS SENT
+pubheartbeat = 1.0      # MAX SECONDS BETWEEN POSITION UPDATES TO THE CAR BEHIND
+shm = False             # PUBLISH POSITION THROUGH SHARED MEMORY (CLIENT ON SERVER MACHINE)
+seqno = count(1)        # SEQUENCE NUMBER OF MESSAGES SENT
+stats = 0               # SECONDS BETWEEN METRICS DUMPS ON STDERR (0 = NO DUMP)
+metricsport = 0         # METRICS ENDPOINT ON metricsport + MY ID (0 = NO ENDPOINT)
+seed = None             # RANDOM SEED OF THE PLATOON, CAR SEED IS seed + MY ID (None = RANDOM)
+platoon = 0             # PLATOON TO JOIN, SELECTS THE SERVER PORT (SEE shard.py)
+group = None            # IF SET, REPORT THROUGH THE AGGREGATOR OF THIS GROUP ON MY MACHINE (SEE aggregator.py)
+record = None           # IF SET, LOG EVERY INPUT TO record + "car" + MY ID + ".log" (SEE replay.py)
+peertimeout = 30.0      # MAX SECONDS TO WAIT FOR GO FROM SERVER AND TO CONNECT TO THE FRONT CAR
 
 #-----------------------------------------------------------------------------
 # MAIN
 #-----------------------------------------------------------------------------
-def initialize():
-    # INITIALIZE SOCKET FOR SERVER
-    sockfd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sockfd.settimeout(15)
-    host = socket.gethostbyname(sys.argv[1])
-    port = 6789
+def initialize(args):
+    host = socket.gethostbyname(args.server)
     os.system('clear')
+    if stats:
+        metrics.registry.start_dump(stats)
+    # SCRIPTED KEYS INSTEAD OF THE TERMINAL (E.G. STARTED BY launcher.py)
+    keysource = KeyScript(args.keys, args.keydelay) if args.keys is not None else None
+    run_client(host, transport.get(args.transport), keysource)
+
+#-----------------------------------------------------------------------------
+# RUN ONE CLIENT, SEVERAL CLIENTS MAY RUN IN ONE PROCESS (ONE THREAD EACH)
+# keysource() RETURNS THE NEXT KEY PRESSED (DEFAULT: TERMINAL)
+#-----------------------------------------------------------------------------
+def run_client(host, link, keysource=None):
+    keysource = keysource or getch
+    port = transport.platoon_port(platoon)
     
     # ATTEMPTING TO CONNECT TO SERVER
     try:
         print("SYSTEM: Attempting to connect to server.\r")
-        sockfd.connect((host, port))
-    except sockfd.timeout as e:
-        print("Connection error: timeout {}\r")
-        sockfd.close()
+        sockfd = link.connect(host, port, 15)
+    except OSError as e:
+        print("Connection error: {}\r".format(e))
         sys.exit()
         
     # RECEIVE ID 
-    myID = requestMyID(sockfd, 0)
+    myID, handshakeBuf = requestMyID(sockfd, 0)
+    if metricsport:
+        metrics.registry.serve(metricsport + int(myID))
     
     # IF LEAD CAR, DETECT INPUT FROM KEYBORAD
     if int(myID) == 1:
-        detect_key_press(sockfd)
+        detect_key_press(sockfd, keysource)
         
     # RECEIVE LIST OF CLIENTS FROM SERVER
-    receive_list(sockfd)
+    clientList = receive_list(sockfd, handshakeBuf)
     
     # START SIMULATION
-    connect_to_peers(myID, port, sockfd)
+    connect_to_peers(myID, port, sockfd, clientList, link, keysource)
         
 #-----------------------------------------------------------------------------
-# REQUESTING MY ID TO SERVER     
+# REQUESTING MY ID TO SERVER, RETURNS ID AND BYTES RECEIVED AFTER IT (START OF CLIENT LIST)
 #-----------------------------------------------------------------------------
 def requestMyID(sockfd, reqOpt, BUFSIZE = 4096):
     # SENDING REQUEST FOR MYID
@@ -66,12 +93,18 @@ def requestMyID(sockfd, reqOpt, BUFSIZE = 4096):
         print("Could not request server for 'myID'\r")
         sys.exit()
         
-    # RECEIVING MYID
+    # RECEIVING MYID, TERMINATED BY NEWLINE (CLIENT LIST MAY FOLLOW IN SAME RECV)
     try:
-        myID = sockfd.recv(BUFSIZE).decode("utf-8")
+        data = ""
+        while "\n" not in data:
+            msg = sockfd.recv(BUFSIZE).decode("utf-8")
+            if not msg:
+                raise ConnectionError("server closed connection")
+            data += msg
+        myID, handshakeBuf = data.split("\n", 1)
         print("SYSTEM: Connection with the server was successful.\r")
         print("SYSTEM: My position (ID) is : " + myID)
-        return myID
+        return myID, handshakeBuf
     except:
         print("Could not connect to server\r")
         sys.exit()
@@ -90,10 +123,27 @@ def getch():
         termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
     return ch
 
+#-----------------------------------------------------------------------------
+# KEY SOURCE PLAYING A SCRIPT, BLOCKS FOREVER ONCE THE SCRIPT IS DONE
+#-----------------------------------------------------------------------------
+class KeyScript:
+    def __init__(self, keys, delay=1.0):
+        self.keys = iter(keys)
+        self.delay = delay                      # SECONDS WAITED FOR EACH '.'
+
+    def __call__(self):
+        for key in self.keys:
+            if key == ".":
+                time.sleep(self.delay)
+                continue
+            return key
+        Event().wait()                          # NO MORE INPUT
+
 #-----------------------------------------------------------------------------
 # LEADCAR RECEIVING USER-PRESSED KEYBORAD INPUT FROM PROMPT
 #-----------------------------------------------------------------------------
-def detect_key_press(sockfd):
+def detect_key_press(sockfd, keysource):
+    global maxclients
     button_delay = 0.001
     numclient = 1
     print("******************************************************************************************\r")
@@ -101,7 +151,7 @@ def detect_key_press(sockfd):
     print("******************************************************************************************\r")
     while True:
         # KEY PRESSED BY USER 
-        key = getch()
+        key = keysource()
         
         # IF 's/S', REQUEST CLIENT LIST FROM SERVER
         if key == "s" or key == "S":
@@ -115,7 +165,7 @@ def detect_key_press(sockfd):
         
         # IF 'c/C', LET SERVER ACCPET MORE CLIENT 
         elif key == "c" or key == "C":
-            if numclient >= 9:
+            if numclient >= maxclients:
                 print("SYSTEM: Cannot accept more client, max reached\r")
             else:
                 print("SYSTEM: Receiving more client...\r")
@@ -130,29 +180,83 @@ def detect_key_press(sockfd):
 #-----------------------------------------------------------------------------
 # RECEIVE CLIENT LIST FROM SERVER
 #-----------------------------------------------------------------------------
-def receive_list(sockfd, BUFSIZE = 4096):
-    global clientList, numClients, lock
+def receive_list(sockfd, handshakeBuf, BUFSIZE = 4096):
     try:
-        # RECEIVE LIST
-        jsonList = sockfd.recv(BUFSIZE).decode("utf-8")
-        
-        # INITIALIZE GLOBAL VARIABLES (CLIENTLIST, NUMCLIENTS)
-        lock.acquire()
-        clientList = json.loads(jsonList)
-        lock.release()
+        # RECEIVE LIST, LARGE PLATOONS MAY NEED MORE THAN ONE RECV
+        jsonList = handshakeBuf
+        while True:
+            try:
+                newList = json.loads(jsonList)
+                break
+            except ValueError:
+                pass
+            data = sockfd.recv(BUFSIZE).decode("utf-8")
+            if not data:
+                raise ConnectionError("server closed connection")
+            jsonList += data
         
         # PRINT CLIENT LIST
-        print(clientList)
+        print(newList)
+        return newList
     except:
         print("Could not receive list\r")
         sys.exit()
         
+#-----------------------------------------------------------------------------
+# SEND READY TO SERVER AND WAIT FOR GO (SENT ONCE EVERY CAR IS LISTENING)
+#-----------------------------------------------------------------------------
+def wait_for_go(sockfd, myID):
+    timeout = sockfd.gettimeout()
+    try:
+        sockfd.sendall(protocol.pack(protocol.MSG_READY, int(myID)))
+        sockfd.settimeout(peertimeout)
+        msg = protocol.recvmsg(sockfd)
+    except OSError:
+        msg = None
+    if msg is None or msg.type != protocol.MSG_GO:
+        print("Server did not start the peer connections\r")
+        sys.exit()
+    sockfd.settimeout(timeout)
+
+#-----------------------------------------------------------------------------
+# CONNECT, RETRYING WITH EXPONENTIAL BACKOFF (10 MS UP TO 0.5 S) FOR peertimeout SECONDS
+#-----------------------------------------------------------------------------
+def connect_with_backoff(link, host, port):
+    deadline = time.monotonic() + peertimeout
+    delay = 0.01
+    while True:
+        try:
+            return link.connect(host, port)
+        except OSError:
+            if time.monotonic() + delay > deadline:
+                raise
+        time.sleep(delay)
+        delay = min(delay*2, 0.5)
+
+#-----------------------------------------------------------------------------
+# ATTACH TO THE AGGREGATOR OF MY GROUP, THEN DETACH FROM THE SERVER
+# RETURNS THE AGGREGATOR SOCKET, USED AS SERVER SOCKET FROM HERE ON
+#-----------------------------------------------------------------------------
+def attach_group(sockfd, myID, link):
+    try:
+        host = socket.gethostbyname(socket.gethostname())
+        aggsock = connect_with_backoff(link, host, transport.group_port(platoon, group))
+        aggsock.sendall(protocol.pack(protocol.MSG_ATTACH, int(myID)))
+        # ATTACHED FIRST, A BROADCAST SENT BEFORE THE SERVER SEES DETACH STILL REACHES ME THROUGH THE AGGREGATOR
+        sockfd.sendall(protocol.pack(protocol.MSG_DETACH, int(myID)))
+    except OSError as e:
+        print("Could not attach to aggregator of group " + str(group) + ": " + str(e) + "\r")
+        sys.exit()
+    aggsock.settimeout(sockfd.gettimeout())
+    sockfd.close()
+    print("SYSTEM: Reporting through aggregator of group " + str(group) + ".\r")
+    return aggsock
+
 #-----------------------------------------------------------------------------
 # START SIMULATION
 #-----------------------------------------------------------------------------
-def connect_to_peers(myID, port, sockfd, BUFSIZE = 4096):
-    global clientList, mypos, endgame, numClients, sleepTime
-    
+def connect_to_peers(myID, port, sockfd, clientList, link, keysource, BUFSIZE = 4096):
+
     # REQUEST INITIAL LOCATION TO SERVER
     try:
         print("SYSTEM: Requesting server for 'start position'\r")
@@ -166,211 +270,215 @@ def connect_to_peers(myID, port, sockfd, BUFSIZE = 4096):
         start_x = sockfd.recv(BUFSIZE).decode("utf-8")
         print("SYSTEM: My start position is : " + start_x + "\r")
         
-        # INTIALIZE GLOBAL VARIABLE (MYPOS)
-        lock.acquire()
-        mypos = int(start_x)
-        lock.release()
+        # INTIALIZE MY STATE, OWNED BY THE MAIN THREAD FROM HERE ON
+        carseed = (random.randrange(2**32) if seed is None else seed) + int(myID)
+        log = None
+        if record:
+            log = EventLog(record + "car" + myID + ".log", int(myID), int(start_x), posrate, carseed, 1.0/tickrate)
+        state = CarState(int(myID), int(start_x), posrate, carseed, log)
     except:
         print("Could not receive my start position\r")
         sys.exit()
 
     carinfront = False
-    caronback = False
     print("SYSTEM: Attempting to connect to other peers (neighbour cars).\r")
     
-    # CONNECT TO THE CAR BEHIND ME, HAS ID = MYID + 1
+    # LISTEN FOR THE CAR BEHIND ME, HAS ID = MYID + 1
+    # EVERY CAR LISTENS, A CAR MAY BE REWIRED BEHIND ME LATER (SEE peers.py)
     behindID = str(int(myID) + 1)
-    # IF THERE IS CAR BEHIND ME, INITIALIZE SOCKET AND BIND
-    if behindID in clientList.keys():
-        mySock1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        mySock1.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        myHost, myPort = clientList[myID]
-        myPort = port + int(myID)
-        try:
-            mySock1.bind((myHost, myPort))
-            caronback = True
-        except:
-            print("Bind failed. Error : " + str(sys.exc_info()))
-            sys.exit()
-        mySock1.listen(1)
-        behindSock, behindAddr = mySock1.accept()
-        
+    myHost, myPort = clientList[myID]
+    myPort = port + int(myID)
+    try:
+        mySock1 = link.listen(myHost, myPort)
+    except:
+        print("Bind failed. Error : " + str(sys.exc_info()))
+        sys.exit()
+    # IF THERE IS CAR BEHIND ME, ACCEPT IT ONCE LINKED TO MY FRONT CAR
+    caronback = behindID in clientList.keys()
+
+    # TELL SERVER I AM LISTENING, WAIT UNTIL EVERY CAR IS (NO CAR CONNECTS BEFORE ITS FRONT CAR LISTENS)
+    wait_for_go(sockfd, myID)
+
     # CONNECT TO THE CAR IN FRONT OF ME, HAS ID = myID - 1
     frontID = str(int(myID) - 1)
     # IF THERE IS CAR IN FRONT OF ME, INITIALIZE SOCKET AND CONNECT
     if frontID in clientList.keys():
-        mySock2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         frontHost, frontPort = clientList[frontID]
         frontPort = port + int(frontID)
         print("SYSTEM: Connecting to client with id " + frontID + "\r")
-        connected = False
-        # WAITING FOR CONNECTION
-        while not connected:
-            try:
-                mySock2.connect((frontHost, frontPort))
-                carinfront = True
-                connected = True
-            except:
-                pass
+        try:
+            mySock2 = connect_with_backoff(link, frontHost, frontPort)
+            carinfront = True
+        except OSError as e:
+            print("Could not connect to client with id " + frontID + ": " + str(e) + "\r")
+            sys.exit()
+
+    # ACCEPT THE CAR BEHIND ME, ITS CONNECTION IS QUEUED ON MY LISTENING SOCKET
+    if caronback:
+        behindSock, behindAddr = mySock1.accept()
     
     print("SYSTEM: Connection with peers is successful.\r")
 
-    # IF THERE IS CAR IN FRONT, SET TMPFSOCK TO SOCKET WITH FRONT CAR
+    # REPORT TO THE AGGREGATOR OF MY GROUP INSTEAD OF THE SERVER, IT PASSES UPDATES AND EVENTS ON
+    if group is not None:
+        sockfd = attach_group(sockfd, myID, link)
+
+    # IN SHARED MEMORY MODE, MY POSITION IS WRITTEN TO MY SLOT AND FRONT POSITION READ FROM ITS SLOT,
+    # PEER AND SERVER SOCKETS ONLY CARRY EVENTS (ACC, DEC, STOP, QUIT)
+    store = None
+    if shm:
+        try:
+            store = SharedStore(shared_name(port), len(clientList))
+        except:
+            print("Could not attach shared memory, is server running with --shm?\r")
+            sys.exit()
+        sockfd.settimeout(None)                 # SERVER SENDS NOTHING UNTIL IT CLOSES
+
+    # HANDSHAKE IS OVER, COUNT MESSAGES, BYTES AND SEND/RECV TIME ON EVERY LINK FROM HERE ON
+    meter = lambda sock, side: metrics.MeteredSocket(sock, protocol.FRAME.size, car=myID, link=side)
+    # UPDATES, BROADCASTS (usrinput) AND LEAVE/QUIT ARE SENT TO THE SERVER FROM DIFFERENT THREADS, ONE FRAME AT A TIME
+    sockfd = transport.SerialSocket(meter(sockfd, "server"))
+    # STOP AND QUIT STARTED HERE ALSO GO TO THE SERVER, WHICH SENDS THEM TO EVERY CAR
+    bcast = Broadcast(sockfd, state.carid)
+
+    # FRONT AND BACK LINKS, REPLACED WHEN THE SERVER REWIRES ME (E.G. MY FRONT CAR LEFT)
+    connectpeer = lambda carid: connect_with_backoff(link, clientList[str(carid)][0], port + carid)
+    links = Links(state.carid, mySock1, connectpeer, meter)
     if carinfront:
-        tmpfsock = mySock2
-    # ELSE, SET TMPFSOCK TO SERVER SOCKET
-    else:
-        tmpfsock = sockfd
-        
-    # IF THERE IS CAR ON BACK, SET TMPBSOCK TO SOCKET WITH BACK CAR
+        links.front, links.frontID = meter(mySock2, "front"), int(frontID)
     if caronback:
-        tmpbsock = behindSock
-    # ELSE, SET TMPBSOCK TO SERVER SOCKET
-    else:
-        tmpbsock = sockfd
+        links.back, links.backID = meter(behindSock, "back"), int(behindID)
+    links.start()
     
     
     #=============================================================================
     #                               THREADS
     #=============================================================================
     
-    # THREAD OF RECEIVING USER INPUT (ACCELERATE, DECELERATE, STOP, QUIT)
+    # THREAD OF RECEIVING USER INPUT (ACCELERATE, DECELERATE, STOP, QUIT, LEAVE)
     try:
-        t1 = Thread(target=usrinput, name = "thread_1", args=(carinfront, caronback, tmpfsock, tmpbsock), daemon = True)
+        t1 = Thread(target=usrinput, name = "thread_1", args=(state, keysource, links, bcast, sockfd), daemon = True)
         t1.start()
     except socket.error as e:
         if detectfailure(e):
-            lock.acquire()
-            endgame = True
-            lock.release()
+            state.post(CMD_QUIT)
             sys.exit()
     except:
         print("Thread didn't start: usrinput()\r")
         traceback.print_exc()
         
-    # IF THERE IS A CAR IN FRONT
-    if carinfront:
-        # RECV FROM FRONT CAR: CONTINUOUSLY LISTEN FOR FRONT CAR POSITION
-        try:
-            t2 = Thread(target=updatefpos, name = "thread_2", args=(caronback, tmpfsock, tmpbsock), daemon = True)
-            t2.start()
-        except socket.error as e:
-            if detectfailure(e):
-                lock.acquire()
-                endgame = True
-                lock.release()
-                sys.exit()
-        except:
-            print("Thread didn't start: updatefpos()\r")
-            traceback.print_exc()
+    # FRONT AND BACK THREADS RUN WITHOUT A NEIGHBOUR TOO, A REWIRE MAY GIVE ME ONE
+    # RECV FROM FRONT CAR: CONTINUOUSLY LISTEN FOR FRONT CAR POSITION
+    try:
+        t2 = Thread(target=updatefpos, name = "thread_2", args=(state, links, bcast), daemon = True)
+        t2.start()
+    except socket.error as e:
+        if detectfailure(e):
+            state.post(CMD_QUIT)
+            sys.exit()
+    except:
+        print("Thread didn't start: updatefpos()\r")
+        traceback.print_exc()
     
-    # IF THERE IS A CAR ON BACK
-    if caronback:
+    if store is None:
         # SEND TO BACK CAR: CONTINOUSLY SEND MY POSITION TO CAR ON BACK
         try:
-            t3 = Thread(target=sendbpos, name = "thread_3", args=(tmpbsock,), daemon = True)
+            t3 = Thread(target=sendbpos, name = "thread_3", args=(state, links), daemon = True)
             t3.start()
         except socket.error as e:
             if detectfailure(e):
-                lock.acquire()
-                endgame = True
-                lock.release()
+                state.post(CMD_QUIT)
                 sys.exit()
         except:
             print("Thread didn't start: sendbpos()\r")
             traceback.print_exc()
-        
-        # RECV FROM BACK CAR: CONTINOUSLY RECEIVE ON USER INPUT OF BACK CAR (ACC, DCC, STOP, QUIT)
-        try:
-            t4 = Thread(target=detectbevent, name = "thread_4", args=(carinfront, tmpbsock, tmpfsock), daemon = True)
-            t4.start()
-        except socket.error as e:
-            if detectfailure(e):
-                lock.acquire()
-                endgame = True
-                lock.release()
-                sys.exit()
-        except:    
-            print("Thread didn't start: detectbevent()\r")
-            traceback.print_exc()
     
-    # SEND TO SERVER: CONTINOUSLY SEND MY POSITION AND SPEED TO SERVER 
+    # RECV FROM BACK CAR: CONTINOUSLY RECEIVE ON USER INPUT OF BACK CAR (ACC, DCC, STOP, QUIT)
     try:
-        t5 = Thread(target=sendserver, name = "thread_5", args=(sockfd,), daemon = True)
-        t5.start()
+        t4 = Thread(target=detectbevent, name = "thread_4", args=(state, links, bcast), daemon = True)
+        t4.start()
     except socket.error as e:
         if detectfailure(e):
-            lock.acquire()
-            endgame = True
-            lock.release()
+            state.post(CMD_QUIT)
             sys.exit()
-    except:
-        print("Thread didn't start: sendserver()\r")
+    except:    
+        print("Thread didn't start: detectbevent()\r")
         traceback.print_exc()
+    
+    # SEND TO SERVER: CONTINOUSLY SEND MY POSITION AND SPEED TO SERVER 
+    if store is None:
+        try:
+            target, args = (streamserver, (state, sockfd)) if stream else (sendserver, (state, sockfd, bcast, links))
+            t5 = Thread(target=target, name = "thread_5", args=args, daemon = True)
+            t5.start()
+        except socket.error as e:
+            if detectfailure(e):
+                state.post(CMD_QUIT)
+                sys.exit()
+        except:
+            print("Thread didn't start: sendserver()\r")
+            traceback.print_exc()
+    
+    # RECV FROM SERVER: CUMULATIVE ACKS OF STREAMED UPDATES AND BROADCAST EVENTS (IN SHARED MEMORY MODE ONLY EVENTS)
+    if stream or store is not None:
+        try:
+            t6 = Thread(target=recvserver, name = "thread_6", args=(state, sockfd, bcast, links), daemon = True)
+            t6.start()
+        except:
+            print("Thread didn't start: recvserver()\r")
+            traceback.print_exc()
         
     #=============================================================================
     #                              MAIN THREAD
     #=============================================================================
+    clock = SimClock(tickrate)
+    ticks = metrics.counter("ticks", car=myID)                  # HEADWAY CHECKS, RATE SHOWN IN DUMPS
+    metrics.gauge("command_queue", state.commands.qsize, car=myID)
     while True:
+        # WAIT FOR NEXT TICK, APPLY COMMANDS FROM OTHER THREADS, UPDATE CURRENT POSITION
+        # AND SPEED (ACCELERATE IF HEADWAY IS TOO BIG, DECELERATE IF TOO SMALL)
+        dt = clock.tick()
+        # IN SHARED MEMORY MODE, READ FRONT POSITION FROM ITS SLOT AND PUBLISH MINE TO MY SLOT
+        frontslot = links.frontID - 1           # FRONT CAR MAY CHANGE ON A REWIRE
+        if store is not None and frontslot >= 0:
+            state.post(CMD_FRONTPOS, float(store.read(frontslot)["pos"]))
+        snap = state.tick(dt)
+        ticks.inc()
+        if store is not None:
+            store.update(state.carid - 1, snap.pos, snap.speed, time.time())
+        
         # IF SIMULATION IS OVER, BREAK
-        if endgame:
+        if snap.endgame:
             break
-        
-        # UPDATE CURRENT POSITION
-        setpos()
-        # CALCULATE HEADWAY DISTANCE
-        headway = getheadway()
-        
-        # IF HEADWAY IS TOO BIG, ACCELERATE
-        if headway == 1:
-            accelerateH(headway, 0.05)#0.1)
-        # IF HEADWAY IS TOO SMALL, DECELERATE
-        elif headway == -1:      
-            decelerate()
         # IF CRASH HAPPENED
-        if headway == -10:
+        if snap.headway == HEADWAY_CRASH:
             print("SYSTEM: CAR CRASH!!!!\r")
-            # LET OTHER CARS TO QUIT
-            if carinfront:
-                try:
-                    message = json.dumps("Q")
-                    tmpfsock.send(struct.pack("i", len(message))+message.encode("utf-8"))
-                    print("SYSTEM: Send front to QUIT\r")
-                except socket.error as e:
-                    if detectfailure(e):
-                        sys.exit()
-                except:
-                    print("Send front to QUIT in main failed\r")
-            if caronback:
-                try:
-                    message = json.dumps("Q")
-                    tmpbsock.send(struct.pack("i", len(message))+message.encode("utf-8"))
-                    print("SYSTEM: Sending back to QUIT\r")
-                except socket.error as e:
-                    if detectfailure(e):
-                        sys.exit()
-                except:
-                    print("Send to back QUIT from main failed\r")
+            # LET OTHER CARS TO QUIT, THROUGH THE SERVER AND HOP BY HOP
+            event = bcast.originate(protocol.MSG_QUIT, next(seqno), snap.pos, snap.speed)
+            front, back = links.front, links.back
+            if front is not None:
+                print("SYSTEM: Send front to QUIT\r")
+                sendsock(state, front, protocol.MSG_QUIT, "Send front to QUIT in main failed\r", event)
+            if back is not None:
+                print("SYSTEM: Sending back to QUIT\r")
+                sendsock(state, back, protocol.MSG_QUIT, "Send to back QUIT from main failed\r", event)
             print("Quitting now...\r")
-            # SET GLOBAL VARIABLE (ENDGAME) TO TRUE TO END SIMULATION
-            lock.acquire()
-            endgame = True
-            lock.release()
+            # END SIMULATION, OTHER THREADS SEE IT IN THE NEXT SNAPSHOT
+            state.finish()
             break
     
     # CLOSING CLIENT SOCKETS
-    if carinfront:
-        mySock2.close()
-    if caronback:
-        behindSock.close()
+    if log is not None:
+        log.close(state)
+    if store is not None:
+        store.close()
+    links.close()
     
-    # CLOSING SERVER SOCKET
+    # CLOSING SERVER SOCKET, AFTER LEAVING THE PLATOON IT GOES ON WITHOUT MY QUIT
     try:
-        sendlist = {}
-        sendlist[0] = -9
-        sendlist[1] = -9
-        msg = json.dumps(sendlist)
-        sockfd.sendall(str(msg).encode("utf-8"))
+        snap = state.snapshot
+        if not links.left:
+            protocol.sendmsg(sockfd, protocol.MSG_QUIT, state.carid, next(seqno), snap.pos, snap.speed)
     except socket.error as e:
         if detectfailure(e):
             sys.exit()
@@ -398,12 +506,16 @@ def detectfailure(e):
 
 #-----------------------------------------------------------------------------
 # SEND SOCKET
+# origin IS THE EVENT BEING RELAYED (STOP, QUIT), ITS ID AND SEND TIME ARE KEPT
 #-----------------------------------------------------------------------------
-def sendsock(sock, msg, exception):
-    # WRAP MESSAGE IN FORMAT OF (LENGTH OF MESSAGE, MESSAGE)
+def sendsock(state, sock, msgtype, exception, origin=None):
+    # WRAP MESSAGE IN A PROTOCOL FRAME
+    snap = state.snapshot
     try:
-        message = json.dumps(msg)
-        sock.send(struct.pack("i", len(message))+message.encode("utf-8"))
+        if origin is None:
+            protocol.sendmsg(sock, msgtype, state.carid, next(seqno), snap.pos, snap.speed)
+        else:
+            protocol.sendmsg(sock, msgtype, origin.carid, origin.seq, snap.pos, snap.speed, origin.ts)
     except socket.error as e:
         if detectfailure(e):
             sys.exit()
@@ -411,99 +523,187 @@ def sendsock(sock, msg, exception):
         print(exception)
 
 #-----------------------------------------------------------------------------
-# SEND TO SERVER
+# SEND TO SERVER, sendrate UPDATES PER SECOND (EACH WAITS FOR ITS ACK)
 #-----------------------------------------------------------------------------
-def sendserver(sock, BUF=1024):
-    global endgame, mypos
+def sendserver(state, sock, bcast, links):
+    global sendrate
+    clock = SimClock(sendrate) if sendrate else None
     while True:
+        snap = state.snapshot
         # IF SIMULATION ENDED, BREAK
-        if endgame:
+        if snap.endgame:
             break
         # SEND SERVER MY POSITION AND SPEED 
         try:
-            sendlist = {}
-            sendlist[0] = mypos
-            sendlist[1] = myspeed
-            msg = json.dumps(sendlist)
-            sock.sendall(str(msg).encode("utf-8"))
+            protocol.sendmsg(sock, protocol.MSG_POS, state.carid, next(seqno), snap.pos, snap.speed)
             
-            # ACKNOWLEDGEMENT FROM SERVER
-            ack = sock.recv(BUF).decode("utf-8")
-            if not ack:
-                print("SYSTEM: Failure detected, quiting now...\r")
-                lock.acquire()
-                endgame = True
-                lock.release()
+            # ACKNOWLEDGEMENT FROM SERVER, BROADCAST EVENTS MAY ARRIVE BEFORE IT
+            ack = protocol.recvmsg(sock)
+            while ack is not None and serverevent(state, bcast, ack, links):
+                ack = protocol.recvmsg(sock)
+            if ack is None:
+                # AFTER LEAVING, THE SERVER CLOSING MY CONNECTION IS NO FAILURE
+                if not links.left:
+                    print("SYSTEM: Failure detected, quiting now...\r")
+                state.post(CMD_QUIT)
                 break
+        except ConnectionError:                 # SERVER RESET THE CONNECTION (E.G. CLOSED WITH MY UPDATE UNREAD)
+            if not links.left:
+                print("SYSTEM: Failure detected, quiting now...\r")
+            state.post(CMD_QUIT)
+            break
+        except socket.error as e:
+            if detectfailure(e):
+                sys.exit()
+        except:
+            traceback.print_exc()
+            sys.exit()
+        if clock:
+            clock.tick()
+
+#-----------------------------------------------------------------------------
+# STREAM TO SERVER (NO WAITING FOR ACK)
+#-----------------------------------------------------------------------------
+def streamserver(state, sock):
+    global sendrate
+    clock = SimClock(sendrate) if sendrate else None
+    while True:
+        snap = state.snapshot
+        # IF SIMULATION ENDED, BREAK
+        if snap.endgame:
+            break
+        # SEND SERVER MY POSITION AND SPEED, ACKS ARE READ BY recvserver()
+        try:
+            protocol.sendmsg(sock, protocol.MSG_STREAM, state.carid, next(seqno), snap.pos, snap.speed)
+        except ConnectionError:
+            print("SYSTEM: Failure detected, quiting now...\r")
+            state.post(CMD_QUIT)
+            break
         except socket.error as e:
             if detectfailure(e):
                 sys.exit()
         except:
             traceback.print_exc()
             sys.exit()
+        if clock:
+            clock.tick()
+
+#-----------------------------------------------------------------------------
+# RECV FROM SERVER (CUMULATIVE ACKS AND BROADCAST EVENTS)
+# SERVER ACKS AT LEAST EVERY ingest.ACKINTERVAL, AN ACK ONLY SHOWS IT IS ALIVE:
+# NO ACK WITHIN THE SOCKET TIMEOUT MEANS THE SERVER IS GONE
+#-----------------------------------------------------------------------------
+def recvserver(state, sock, bcast, links):
+    while True:
+        # IF SIMULATION ENDED, BREAK
+        if state.snapshot.endgame:
+            break
+        try:
+            ack = protocol.recvmsg(sock)
+        except socket.timeout:
+            ack = None
+        except ConnectionError:
+            ack = None
+        except socket.error as e:
+            if detectfailure(e):
+                sys.exit()
+            continue
+        if ack is None:
+            if not links.left:
+                print("SYSTEM: Failure detected, quiting now...\r")
+            state.post(CMD_QUIT)
+            break
+        if ack.type != protocol.MSG_ACK:
+            serverevent(state, bcast, ack, links)
+
+#-----------------------------------------------------------------------------
+# APPLY AN EVENT BROADCAST BY THE SERVER OR A REWIRE, RETURNS FALSE IF msg IS NEITHER
+#-----------------------------------------------------------------------------
+def serverevent(state, bcast, msg, links):
+    # NEW FRONT AND BACK CAR, LINKED BY THE REWIRE THREAD (SEE peers.py)
+    if msg.type == protocol.MSG_REWIRE:
+        links.post(*protocol.rewire_links(msg))
+        return True
+    if msg.type not in protocol.UNBROADCAST:
+        return False
+    # IGNORE COPIES OF AN EVENT ALREADY APPLIED (E.G. RELAYED HOP BY HOP)
+    if bcast.first(msg, "server"):
+        if msg.type == protocol.MSG_BSTOP:
+            state.post(CMD_STOP)
+        else:
+            state.post(CMD_QUIT)
+    return True
 
 #-----------------------------------------------------------------------------
 # RECV FROM BACK
 #-----------------------------------------------------------------------------
-def detectbevent(carinfront, tmpbsock, tmpfsock):
-    global endgame, lock
+def detectbevent(state, links, bcast):
     while True:
         # IF SIMULATION ENDED, BREAK
-        if endgame:
+        if state.snapshot.endgame:
             break
+        # BACK CAR CHANGED (REWIRE), LISTEN TO THE NEW ONE, WITHOUT ONE WAIT FOR ONE
+        sock = links.back
+        if sock is None:
+            links.wait("back", None, 1.0)
+            continue
         
         # RECEIVE EVENT FROM BACK
         try:
-            size = struct.unpack("i", tmpbsock.recv(struct.calcsize("i")))[0]
-            data=""
-            while len(data) < size:
-                msg = tmpbsock.recv(size - len(data)).decode("utf-8")
-                if not msg:
+            msg = protocol.recvmsg(sock)
+            # IF BACK CAR CLOSED THE CONNECTION, WAIT FOR ITS REPLACEMENT (E.G. IT LEFT), IF NONE STOP LISTENING
+            if msg is None:
+                if links.wait("back", sock) is sock:
                     break
-                data += msg
+                continue
+            tmpfsock = links.front              # RELAYED TO MY CURRENT FRONT CAR
                 
             # IF BACK CAR NEEDS ME TO ACCELERATE 
-            if data == "\"A\"":
+            if msg.type == protocol.MSG_ACC:
                 print("SYSTEM: Acceleration from back car\r")
                 # IF THERE IS CAR IN FRONT OF ME, PROPAGATE MESSAGE
-                if carinfront:
+                if tmpfsock is not None:
                     print("SYSTEM: Send front car to accelerate\r")
                     exc = "Send front car accelerate from detectbevent failed"
-                    sendsock(tmpfsock, "A", exc)
-                accelerate(0.1)
+                    sendsock(state, tmpfsock, protocol.MSG_ACC, exc)
+                state.post(CMD_ACCELERATE, 0.1)
                 
             # IF BACK CAR NEEDS ME TO DECELERATE
-            elif data == "\"D\"":
+            elif msg.type == protocol.MSG_DEC:
                 print("SYSTEM: Deceleration from back car\r")
                 # IF THERE IS A CAR IN FRONT OF ME, PROPAGATE MESSAGE
-                if carinfront:
+                if tmpfsock is not None:
                     print("SYSTEM: Send front car to decelerate\r")
                     exc = "Send front car decelerate from detectbevent failed"
-                    sendsock(tmpfsock, "D", exc)
-                decelerate()
+                    sendsock(state, tmpfsock, protocol.MSG_DEC, exc)
+                state.post(CMD_DECELERATE)
                 
             # IF BACK CAR NEEDS ME TO STOP
-            elif data == "\"S\"":
+            elif msg.type == protocol.MSG_STOP:
+                # IGNORE COPIES OF A STOP ALREADY APPLIED (E.G. BROADCAST BY THE SERVER)
+                if not bcast.first(msg, "hop"):
+                    continue
                 print("SYSTEM: Stop from back car\r")
                 # IF THERE IS CAR IN FRONT OF ME, TELL IT TO STOP
-                if carinfront:
+                if tmpfsock is not None:
                     print("SYSTEM: Send front to Stop\r")
                     exc = "Send to front stop from detectbevent failed"
-                    sendsock(tmpfsock, "S", exc)
-                stop()
+                    sendsock(state, tmpfsock, protocol.MSG_STOP, exc, msg)
+                state.post(CMD_STOP)
                 
             # IF BACK CAR NEEDS ME TO QUIT
-            elif data == "\"Q\"":
+            elif msg.type == protocol.MSG_QUIT:
+                # A COPY OF A QUIT ALREADY APPLIED IS NOT RELAYED AGAIN
+                if not bcast.first(msg, "hop"):
+                    break
                 print("SYSTEM: Quit from back car\r")
                 # IF THERE IS CAR IN FRONT OF ME, TELL IT TO QUIT
-                if carinfront:
+                if tmpfsock is not None:
                     print("SYSTEM: Send front to Quit\r")
                     exc = "Send to front Quit from detectbevent failed"
-                    sendsock(tmpfsock, "Q", exc)
-                # UPDATE GLOBAL VARIABLE (ENDGAME) TO END SIMULATION
-                lock.acquire()
-                endgame = True
-                lock.release()
+                    sendsock(state, tmpfsock, protocol.MSG_QUIT, exc, msg)
+                # END SIMULATION
+                state.post(CMD_QUIT)
                 break
         except:
             pass
@@ -511,74 +711,103 @@ def detectbevent(carinfront, tmpbsock, tmpfsock):
 #-----------------------------------------------------------------------------
 # SEND TO BACK
 #-----------------------------------------------------------------------------
-def sendbpos(sock):
-    global endgame, mypos
+def sendbpos(state, links):
+    global pubrate, pubthreshold, pubheartbeat
+    publisher = None
+    clock = SimClock(pubrate)
     while True:
+        snap = state.snapshot
         # IF SIMULATION ENDED, BREAK
-        if endgame:
+        if snap.endgame:
             break
+        # BACK CAR CHANGED (REWIRE), A NEW PUBLISHER SENDS MY POSITION TO THE NEW ONE AT ONCE
+        sock = links.back
+        if sock is None:
+            publisher = None
+        elif publisher is None or publisher.sock is not sock:
+            publisher = Publisher(sock, pubthreshold, pubheartbeat, posrate)
         
-        # SEND MY POSITION TO BACK
+        # OFFER MY LATEST POSITION TO BACK, SENT ONLY IF ITS PREDICTION IS OFF AND SOCKET IS WRITABLE
         try:
-            msg = json.dumps(mypos)
-            sock.send(struct.pack("i", len(msg))+msg.encode("utf-8"))
+            if publisher is not None:
+                publisher.offer(state.carid, snap.pos, snap.speed)
         except socket.error as e:
             if detectfailure(e):
                 sys.exit()
+        except ValueError:                      # LINK CLOSED BY A REWIRE, NEXT TICK USES THE NEW ONE
+            pass
         except:
             traceback.print_exc()
             sys.exit()
-        time.sleep(0.0000001)
+        clock.tick()
 
 #-----------------------------------------------------------------------------
 # RECEIVE FROM FRONT 
 #-----------------------------------------------------------------------------
-def updatefpos(caronback, tmpfsock, tmpbsock):
-    global frontpos, endgame, lock
+def updatefpos(state, links, bcast):
+    # ERROR OF MY PREDICTION OF THE FRONT POSITION WHEN A CORRECTION ARRIVES
+    error = metrics.histogram("front_error", metrics.DISTANCES, car=state.carid)
+    front = None                                # LAST (POSITION, SPEED, TIME) RECEIVED
+    sock = None                                 # LINK TO FRONT CAR I AM LISTENING ON
     while True:
         # IF SIMULATION ENDED, BREAK
-        if endgame:
+        if state.snapshot.endgame:
             break
+        # FRONT CAR CHANGED (REWIRE), FOLLOW THE NEW ONE, WITHOUT ONE I DRIVE AS LEAD CAR
+        if sock is not links.front:
+            if sock is not None and links.front is None:
+                state.post(CMD_FRONTPOS, -1)
+            sock, front = links.front, None
+        if sock is None:
+            links.wait("front", None, 1.0)
+            continue
         
         # RECEIVE MESSAGE FROM FRONT
         try:
-            size = struct.unpack("i", tmpfsock.recv(struct.calcsize("i")))[0]
-            data = ""
-            while len(data) < size:
-                msg = tmpfsock.recv(size - len(data)).decode("utf-8")
-                if not msg:
+            msg = protocol.recvmsg(sock)
+            # IF FRONT CAR CLOSED THE CONNECTION, WAIT FOR ITS REPLACEMENT (E.G. IT LEFT), IF NONE STOP LISTENING
+            if msg is None:
+                if links.wait("front", sock) is sock:
                     break
-                data += msg
+                continue
+            tmpbsock = links.back               # RELAYED TO MY CURRENT BACK CAR
                 
             # IF FRONT CAR NEEDS ME TO STOP
-            if data == "\"S\"":
+            if msg.type == protocol.MSG_STOP:
+                # IGNORE COPIES OF A STOP ALREADY APPLIED (E.G. BROADCAST BY THE SERVER)
+                if not bcast.first(msg, "hop"):
+                    continue
                 print("SYSTEM: Stop from front car\r")
                 # IF THERE IS CAR ON BACK, TELL IT TO STOP
-                if caronback:
+                if tmpbsock is not None:
                     print("SYSTEM: Sending back to Stop\r")
                     exc = "Send to back Stop from updatefpos failed"
-                    sendsock(tmpbsock, "S", exc)
-                stop()
+                    sendsock(state, tmpbsock, protocol.MSG_STOP, exc, msg)
+                state.post(CMD_STOP)
                 
             # IF FRONT CAR NEEDS ME TO QUIT 
-            elif data == "\"Q\"":
+            elif msg.type == protocol.MSG_QUIT:
+                # A COPY OF A QUIT ALREADY APPLIED IS NOT RELAYED AGAIN
+                if not bcast.first(msg, "hop"):
+                    break
                 print("SYSTEM: Quit from front car\r")
                 # IF THERE IS CAR ON BACK, TELL IT TO QUIT
-                if caronback:
+                if tmpbsock is not None:
                     print("SYSTEM: Sending back to Quit\r")
                     exc = "Send to back Quit from updatefpos failed"
-                    sendsock(tmpbsock, "Q", exc)
-                # UPDATE GLOBAL VARIABLE (ENDGAME) TO END SIMULATION
-                lock.acquire()
-                endgame = True
-                lock.release()
+                    sendsock(state, tmpbsock, protocol.MSG_QUIT, exc, msg)
+                # END SIMULATION
+                state.post(CMD_QUIT)
                 break
             
-            # IF MESSAGE WAS POSITION OF FRONT CAR, UPDATE GLOBAL VARIABLE (FRONTPOS)
-            else:
-                lock.acquire()
-                frontpos = (float(data))
-                lock.release()
+            # IF MESSAGE WAS POSITION OF FRONT CAR, PREDICT FRONT POSITION FROM IT FROM NEXT TICK ON
+            elif msg.type == protocol.MSG_POS:
+                # RECEIVE TIME, NOT msg.ts: CLOCKS OF TWO HOSTS MAY DIFFER MORE THAN THE TRANSIT TIME
+                now = time.monotonic()
+                if front is not None:
+                    error.observe(abs(predict(front[0], front[1], now - front[2], posrate) - msg.pos))
+                front = (msg.pos, msg.speed, now)
+                state.post(CMD_FRONTSTATE, front)
         except socket.error as e:
             if detectfailure(e):
                 sys.exit()
@@ -588,170 +817,126 @@ def updatefpos(caronback, tmpfsock, tmpbsock):
             pass
 
 #-----------------------------------------------------------------------------
-# READ USER INPUT (ACTIONS: ACCELERATE, DECELERATE, STOP, QUIT)
+# READ USER INPUT (ACTIONS: ACCELERATE, DECELERATE, STOP, QUIT, LEAVE)
 #-----------------------------------------------------------------------------
-def usrinput(carinfront, caronback, tmpfsock, tmpbsock):
-    global endgame, myspeed, frontpos, mypos, lock, myspeed, maxspeed
+def usrinput(state, keysource, links, bcast, sockfd):
     button_delay = 0.0001
     while True:
         # IF SIMULATION ENDED, BREAK
-        if endgame:
+        if state.snapshot.endgame:
             break
         
         # DETECT USER INPUT FROM TERMINAL
-        key = getch()
+        key = keysource()
+        # CURRENT NEIGHBOURS, None IF THERE IS NO CAR (THEY MAY CHANGE ON A REWIRE)
+        tmpfsock, tmpbsock = links.front, links.back
         # IF KEY WAS 'd/D', ACCELERATE
         if (key == 'd' or key == 'D'):
 #            print("SYSTEM: Accelerating..")
-            accelerate(0.1)
+            state.post(CMD_ACCELERATE, 0.1)
             # IF THERE IS A CAR IN FRONT AND HEADWAY IS TOO SMALL, TELL FRONT CAR TO ACCELERATE
-            headway = getheadway()
-            if carinfront and headway == -1:
+            headway = state.snapshot.headway
+            if tmpfsock is not None and headway == HEADWAY_SMALL:
                     print("SYSTEM: Headway is too small, Send front car to accelerate\r")
                     exc = "Send front to accelerate from usrinput failed"
-                    sendsock(tmpfsock, "A", exc)
+                    sendsock(state, tmpfsock, protocol.MSG_ACC, exc)
                     
         # IF KEY WAS 'a/A', DECELERATE
         elif (key == 'a' or key == 'A'):
 #            print("SYSTEM: Decelerating...")
-            decelerate()
+            state.post(CMD_DECELERATE)
             # IF THERE IS CAR IN FRONT AND HEADWAY IS TOO BIG, TELL FRONT CAR TO DECELERATE
-            headway = getheadway()
-            if carinfront and headway == 1:
+            headway = state.snapshot.headway
+            if tmpfsock is not None and headway == HEADWAY_BIG:
                     print("SYSTEM: Headway is too big, Send front car to decelerate\r")
                     exc = "Send front to decelerate from usrinput failed"
-                    sendsock(tmpfsock, "D", exc)
+                    sendsock(state, tmpfsock, protocol.MSG_DEC, exc)
         
         # IF KEY WAS 's/S', STOP
         elif (key == 's' or key == 'S'):
             print("SYSTEM: Stopping...\r")
+            # TELL EVERY CAR TO STOP THROUGH THE SERVER, AND NEIGHBOURS DIRECTLY
+            snap = state.snapshot
+            event = bcast.originate(protocol.MSG_STOP, next(seqno), snap.pos, snap.speed)
             # IF THERE IS CAR IN FRONT, TELL FRONT CAR TO STOP
-            if carinfront:
+            if tmpfsock is not None:
                 print("SYSTEM: Send front to Stop\r")
                 exc = "Send to front Stop failed in usrinput"
-                sendsock(tmpfsock, "S", exc)
+                sendsock(state, tmpfsock, protocol.MSG_STOP, exc, event)
             # IF THERE IS CAR ON BACK, TELL BACK CAR TO STOP
-            if caronback:
+            if tmpbsock is not None:
                 print("SYSTEM: Send back to Stop\r")
                 exc = "Send to back Stop failed in usrinput"
-                sendsock(tmpbsock, "S", exc)
-            stop()
+                sendsock(state, tmpbsock, protocol.MSG_STOP, exc, event)
+            state.post(CMD_STOP)
             
         # IF KEY WAS 'q/Q', QUIT
         elif (key == 'q' or key == 'Q'):
             print("SYSTEM: Ending simulation...\r")
+            # TELL EVERY CAR TO QUIT THROUGH THE SERVER, AND NEIGHBOURS DIRECTLY
+            snap = state.snapshot
+            event = bcast.originate(protocol.MSG_QUIT, next(seqno), snap.pos, snap.speed)
             # IF THERE IS CAR IN FRONT, TELL FRONT CAR TO QUIT
-            if carinfront:
+            if tmpfsock is not None:
                 print("SYSTEM: Send front to Quit\r")
                 exc = "Send to front Quit failed in usrinput"
-                sendsock(tmpfsock, "Q", exc)
+                sendsock(state, tmpfsock, protocol.MSG_QUIT, exc, event)
             # IF THERE IS CAR ON BACK, TELL BACK CAR TO QUIT
-            if caronback:
+            if tmpbsock is not None:
                 print("SYSTEM: Send back to Quit\r")
                 exc = "Send to back Quit failed in usrinput"
-                sendsock(tmpbsock, "Q", exc)                     
-            # UPDATE GLOBAL VARIABLE (ENDGAME) TO END SIMULATION
-            lock.acquire()
-            endgame = True
-            lock.release()
+                sendsock(state, tmpbsock, protocol.MSG_QUIT, exc, event)                     
+            # END SIMULATION
+            state.post(CMD_QUIT)
+            break
+            
+        # IF KEY WAS 'l/L', LEAVE THE PLATOON, THE OTHER CARS GO ON
+        elif (key == 'l' or key == 'L'):
+            print("SYSTEM: Leaving the platoon...\r")
+            # SERVER TELLS MY FRONT AND BACK CAR TO LINK TO EACH OTHER (SEE roster.py)
+            links.left = True
+            sendsock(state, sockfd, protocol.MSG_LEAVE, "Send leave to server failed in usrinput")
+            # END MY SIMULATION, MY LINKS CLOSE WITHOUT QUIT
+            state.post(CMD_QUIT)
             break
         time.sleep(button_delay)
 
-#-----------------------------------------------------------------------------
-# ACCELERATE ON USER INPUT (EVENT)
-#-----------------------------------------------------------------------------
-def accelerate(acc_change):
-    global myspeed, maxspeed, lock
-    # UPDATE GLOBAL VARIABLE (MYSPEED) 
-    lock.acquire()
-    # IF MY SPEED IS LESS THAN MAX SPEED, INCREASE SPEED
-    if myspeed < maxspeed:
-        myspeed += acc_change
-    lock.release()
-
-#-----------------------------------------------------------------------------
-# ACCELERATE WITH REGRADS TO HEADWAY
-#-----------------------------------------------------------------------------
-def accelerateH(headway, acc_change):
-    global maxheadway, myspeed, maxspeed, lock
-    # UPDATE GLOBAL VARIABLE (MYSPEED)
-    lock.acquire()
-    # IF HEADWAY IS NOT TOO BIG AND MYSPEED IS LESS THAN MAX, INCREASE SPEED
-    if headway < maxheadway:
-        myspeed += acc_change
-    lock.release()
-
-#-----------------------------------------------------------------------------
-# DECELERATE
-#-----------------------------------------------------------------------------
-def decelerate():
-    global myspeed, lock
-    # UPDATE GLOBAL VARIABLE (MYSPEED)
-    lock.acquire()
-    # IF I'M MOVING, DECREASE SPEED
-    if myspeed > 0:
-        myspeed -= 0.1
-    # ELSE, SET SPEED TO 0
-    else:
-        myspeed = 0
-    lock.release()
-
-#-----------------------------------------------------------------------------
-# STOP
-#-----------------------------------------------------------------------------
-def stop():
-    global myspeed
-    # WHILE MY SPEED IS GREATER THAN 0, DECELERATE
-    while myspeed > 0:
-        decelerate()
-
-#-----------------------------------------------------------------------------
-# SET CURRENT POSITION
-#-----------------------------------------------------------------------------
-def setpos():
-    global myspeed, maxspeed, mypos, lock
-    # UPDATE ON GLOBAL VARIABLE (MYSPEED, MYPOS)
-    lock.acquire()
-    # IF SPEED IS NEGATIVE, SET TO 0
-    if myspeed < 0:
-        myspeed = 0
-    # UPDATE MY POSITION 
-    mypos = (mypos + (myspeed * (random.random()/50000)))
-    lock.release()
-
-#-----------------------------------------------------------------------------
-# CALCULATE HEADWAY
-# RETURNING    0 IF I'M LEADCAR OR HEADWAY IS OKAY
-#              1 IF HEADWAY IS TOO BIG
-#             -1 IF HEADWAY IS TOO SMALL
-#            -10 IF CRASH
-#-----------------------------------------------------------------------------
-def getheadway():
-    global frontpos, mypos, maxheadway, minheadway, lock
-    # IF THERE IS NO FRONT CAR
-    if frontpos == -1:
-        return 0
-    
-    # CALCULATE HEADWAY USING FRONTPOS AND MYPOS
-    lock.acquire()
-    headway = frontpos - mypos
-    lock.release()
-    
-    # HEADWAY TOO BIG
-    if headway > maxheadway:     
-        return 1
-    # HEADWAY TOO SMALL
-    elif headway < minheadway:
-        # CRASH (CAR WIDTH = 100, EACH CAR POS = CENTER OF CAR'S LOCATION)
-        if headway <= 100:
-            return -10
-        else:
-            return -1
-    # ACCEPTIBLE HEADWAY
-    else:   
-        return 0
-
-
 #=============================================================================
 if __name__ == "__main__":
-    initialize()
+    parser = argparse.ArgumentParser(description="P2P platoon simulation client")
+    parser.add_argument("server", help="name of server machine")
+    parser.add_argument("--transport", choices=("tcp", "unix"), default="tcp", help="transport to server and peers (default %(default)s)")
+    parser.add_argument("--shm", action="store_true", help="publish position through shared memory, client must run on server machine")
+    parser.add_argument("--tickrate", type=float, default=tickrate, help="physics ticks per second (default %(default)s)")
+    parser.add_argument("--stream", action="store_true", help="stream updates to server without waiting for each ack")
+    parser.add_argument("--sendrate", type=float, default=sendrate, help="position updates per second to the server, 0 = unpaced (default %(default)s)")
+    parser.add_argument("--pubrate", type=float, default=pubrate, help="max position updates per second to the car behind (default %(default)s)")
+    parser.add_argument("--pubthreshold", type=float, default=pubthreshold, help="max error of the car behind predicting my position before a correction is sent (default %(default)s)")
+    parser.add_argument("--pubheartbeat", type=float, default=pubheartbeat, help="max seconds between position updates to the car behind (default %(default)s)")
+    parser.add_argument("--stats", type=float, default=0, help="print metrics to stderr every SEC seconds (default off)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve metrics on http://127.0.0.1:PORT+ID/metrics (default off)")
+    parser.add_argument("--seed", type=int, help="random seed, same seed and inputs give the same run (default random)")
+    parser.add_argument("--record", metavar="PREFIX", help="log seed and every input to PREFIXcarID.log, replay with replay.py PREFIX")
+    parser.add_argument("--keys", help="press these keys instead of reading the terminal, '.' waits KEYDELAY seconds")
+    parser.add_argument("--keydelay", type=float, default=1.0, help="seconds waited for each '.' in --keys (default %(default)s)")
+    parser.add_argument("--maxclients", type=int, default=maxclients, help="max number of cars the lead car accepts (default %(default)s)")
+    parser.add_argument("--platoon", type=int, default=platoon, help="platoon to join on a server running several (default %(default)s)")
+    parser.add_argument("--group", type=int, help="report through aggregator.py GROUP on this machine instead of the server")
+    args = parser.parse_args()
+    if args.maxclients > transport.MAXCARS:     # CAR PORTS ABOVE THAT BELONG TO AGGREGATORS
+        sys.exit("SYSTEM: at most {} cars per platoon".format(transport.MAXCARS))
+    maxclients = args.maxclients
+    tickrate = args.tickrate
+    stream = args.stream
+    sendrate = args.sendrate
+    pubrate = args.pubrate
+    pubthreshold = args.pubthreshold
+    pubheartbeat = args.pubheartbeat
+    shm = args.shm
+    stats = args.stats
+    seed = args.seed
+    record = args.record
+    metricsport = args.metrics_port
+    platoon = args.platoon
+    group = args.group
+    initialize(args)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless platoon engine
+
+Runs the same per-car controller as client.py (setpos / getheadway /
+accelerateH / decelerate) for a whole platoon in one process. All car state
+is kept in NumPy arrays so one tick costs a handful of vector operations
+regardless of the number of cars.
+
+    python3 engine.py NUMCARS [NUMTICKS] [LEADSPEED]
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import sys, time
+import numpy as np
+# CONTROLLER CONSTANTS AND HEADWAY STATES, SHARED WITH THE CARS (SEE carstate.py)
+from carstate import (MAXSPEED, MAXHEADWAY, MINHEADWAY, CRASHHEADWAY, HEADWAYACC, CATCHUPSPEED, DECELERATION,
+                      HEADWAY_OK, HEADWAY_BIG, HEADWAY_SMALL, HEADWAY_CRASH)
+
+#-----------------------------------------------------------------------------
+# RATES (MIRROR client.py)
+TICKRATE = 100          # PHYSICS TICKS PER SECOND
+POSRATE = 10.0          # POSITION UNITS PER SECOND AT SPEED 1.0 (BEFORE RANDOM FACTOR)
+
+#-----------------------------------------------------------------------------
+# Function to calculate start position of all cars (same as server.py)
+#-----------------------------------------------------------------------------
+def start_positions(numcars):
+    # LEAD CAR (ID 1) IS AT INDEX 0 AND IS THE FURTHEST AHEAD
+    return np.arange(numcars, 0, -1, dtype=np.float64)*150 - 50
+
+#-----------------------------------------------------------------------------
+# Platoon state, index i holds car with ID i+1
+#-----------------------------------------------------------------------------
+class Platoon:
+    def __init__(self, numcars, seed=None):
+        self.numcars = numcars
+        self.pos = start_positions(numcars)             # POSITION OF EVERY CAR
+        self.speed = np.zeros(numcars)                  # SPEED OF EVERY CAR
+        self.crashed = np.zeros(numcars, dtype=bool)    # CARS THAT HAVE CRASHED
+        self.ticks = 0
+        self.rng = np.random.default_rng(seed)
+
+    #-------------------------------------------------------------------------
+    # USER EVENTS (SAME AS client.accelerate / decelerate / stop)
+    #-------------------------------------------------------------------------
+    def accelerate(self, cars, acc_change):
+        # IF SPEED IS LESS THAN MAX SPEED, INCREASE SPEED
+        below = self.speed[cars] < MAXSPEED
+        self.speed[cars] = np.where(below, self.speed[cars] + acc_change, self.speed[cars])
+
+    def decelerate(self, cars):
+        # IF MOVING, DECREASE SPEED ELSE SET SPEED TO 0
+        moving = self.speed[cars] > 0
+        self.speed[cars] = np.where(moving, self.speed[cars] - DECELERATION, 0)
+
+    def stop(self, cars):
+        self.speed[cars] = 0
+
+    #-------------------------------------------------------------------------
+    # HEADWAY OF EVERY CAR TO THE CAR IN FRONT (LEAD CAR HAS NO HEADWAY)
+    #-------------------------------------------------------------------------
+    def headway(self):
+        headway = np.empty(self.numcars)
+        headway[0] = np.inf
+        np.subtract(self.pos[:-1], self.pos[1:], out=headway[1:])
+        return headway
+
+    #-------------------------------------------------------------------------
+    # HEADWAY STATE OF EVERY CAR (SEE client.getheadway)
+    #-------------------------------------------------------------------------
+    def headway_state(self, headway=None):
+        if headway is None:
+            headway = self.headway()
+        state = np.full(self.numcars, HEADWAY_OK, dtype=np.int8)
+        state[headway > MAXHEADWAY] = HEADWAY_BIG
+        state[headway < MINHEADWAY] = HEADWAY_SMALL
+        state[headway <= CRASHHEADWAY] = HEADWAY_CRASH
+        state[0] = HEADWAY_OK                   # LEAD CAR HAS NO FRONT CAR, ITS SPEED IS SET BY ITS USER
+        return state
+
+    #-------------------------------------------------------------------------
+    # ONE TICK OF THE MAIN LOOP OF EVERY CLIENT, RETURNS HEADWAY STATE
+    #-------------------------------------------------------------------------
+    def step(self, dt=1.0/TICKRATE):
+        # SET CURRENT POSITION (client.setpos)
+        np.maximum(self.speed, 0, out=self.speed)
+        self.pos += self.speed * POSRATE * dt * self.rng.random(self.numcars)
+
+        # CALCULATE HEADWAY DISTANCE (client.getheadway)
+        state = self.headway_state()
+
+        # IF HEADWAY IS TOO BIG, ACCELERATE UP TO CATCHUPSPEED (client.accelerateH)
+        self.speed[(state == HEADWAY_BIG) & (self.speed < CATCHUPSPEED)] += HEADWAYACC
+        # IF HEADWAY IS TOO SMALL, DECELERATE (client.decelerate)
+        small = state == HEADWAY_SMALL
+        self.speed[small] = np.where(self.speed[small] > 0, self.speed[small] - DECELERATION, 0)
+        # IF CRASH HAPPENED
+        self.crashed |= state == HEADWAY_CRASH
+
+        self.ticks += 1
+        return state
+
+    #-------------------------------------------------------------------------
+    # RUN FOR A NUMBER OF TICKS OR UNTIL A CAR CRASHES, RETURNS TICKS RUN
+    #-------------------------------------------------------------------------
+    def run(self, numticks):
+        for i in range(numticks):
+            self.step()
+            if self.crashed.any():
+                return i + 1
+        return numticks
+
+#-----------------------------------------------------------------------------
+################################ MAIN FUNCTION ###############################
+if __name__ == "__main__":
+    numcars = int(sys.argv[1])
+    numticks = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    leadspeed = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+
+    platoon = Platoon(numcars)
+    platoon.speed[0] = leadspeed
+    start = time.perf_counter()
+    ran = platoon.run(numticks)
+    elapsed = time.perf_counter() - start
+    print("SYSTEM: {} cars, {} ticks in {:.3f} s ({:.0f} ticks/s, {:.0f} car-ticks/s)".format(
+        numcars, ran, elapsed, ran/elapsed, ran*numcars/elapsed))
+    if platoon.crashed.any():
+        print("SYSTEM: CAR CRASH!!!! cars {}".format((np.flatnonzero(platoon.crashed) + 1).tolist()))
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Asyncio ingest server
+
+Handles every client connection on one event loop running in a single
+thread: the join handshake (ID request, 'c'/'s' menu of the lead car,
+'xpos' start position, READY/GO before cars link to their peers) and the
+telemetry stream afterwards, sent by every car or batched per group of cars
+by an aggregator, including urgent events (STOP, QUIT) that are written to
+every other car at once. Every position update also goes to the roster of
+the platoon (see roster.py): when a car leaves or the order changes, the cars
+whose neighbours changed are told to rewire (MSG_REWIRE). In shared memory mode cars write their position to
+a SharedStore directly and the telemetry stream only carries QUIT (and end
+of connection). The render loop in server.py only reads snapshots of the
+state kept here.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import asyncio, json, time
+from threading import Thread, Event, current_thread
+import protocol, transport, metrics
+from snapshot import SnapshotStore, SharedStore, shared_name
+from roster import Roster
+
+ACKEVERY = 64           # STREAMED UPDATES PER CUMULATIVE ACK
+ACKINTERVAL = 0.5       # MAX SECONDS BETWEEN CUMULATIVE ACKS (HEARTBEAT)
+
+#-----------------------------------------------------------------------------
+# Function to calculate start position of all cars based on number of clients
+#-----------------------------------------------------------------------------
+def start_positions(numclients):
+    start_x = list(range(1,numclients+1))
+    start_x = [item*150 - 50 for item in start_x]
+    start_x.reverse()
+    return start_x
+
+#-----------------------------------------------------------------------------
+# Ingest server, all connections handled by one event loop
+#-----------------------------------------------------------------------------
+class IngestServer:
+    def __init__(self, host, port, backlog=1024, link=None, shared=False, expect=0):
+        self.host = host
+        self.port = port
+        self.backlog = backlog                  # LISTEN BACKLOG
+        self.link = link or transport.TCPTransport()    # TRANSPORT CLIENTS CONNECT THROUGH
+        self.clientList = {}                    # LIST TO MAINTAIN CLIENT ADDRESSES
+        self.writers = {}                       # LIST TO MAINTAIN CLIENT STREAMS
+        self.groups = {}                        # STREAMS OF AGGREGATORS, BY GROUP NUMBER (SEE aggregator.py)
+        self.store = None                       # POSITION AND SPEED OF CLIENTS, CREATED ON START
+        self.shared = shared                    # CARS ON THIS MACHINE WRITE THE STORE IN SHARED MEMORY
+        self.start_x = []                       # START POSITION OF CLIENTS
+        self.roster = None                      # ORDER OF CARS BY POSITION, CREATED ON START
+        self.lock = metrics.TimedLock(metrics.histogram("lock_wait_seconds", lock="simulationExit"))  # LOCK FOR simulationExit
+        self.simulationExit = False             # SET WHEN SIMULATION SHOULD QUIT
+        self.started = Event()                  # SET WHEN CLIENT LIST WAS SENT TO ALL CLIENTS
+        self.ready = Event()                    # SET WHEN SERVER IS LISTENING
+        self.updated = Event()                  # SET ON EVERY POSITION UPDATE
+        self.clientID = 0                       # LAST ASSIGNED CLIENT ID
+        self.leadSeen = False                   # FIRST CONNECTION IS THE LEAD CAR
+        self.accepting = True                   # FALSE ONCE LEAD CAR STARTED SIMULATION
+        self.waiting = 0                        # CONNECTIONS WAITING FOR ADMISSION
+        if expect > transport.MAXCARS:          # CAR PORTS ABOVE THAT BELONG TO AGGREGATORS
+            raise ValueError("at most {} cars per platoon".format(transport.MAXCARS))
+        self.expect = expect                    # IF SET, PLATOON SIZE: CARS JOIN WITHOUT 'c', ALL IN PARALLEL
+        self.idsSent = 0                        # CLIENTS THAT RECEIVED THEIR ID
+        self.firstConnect = None                # TIME LEAD CAR CONNECTED
+        self.joinTime = None                    # SECONDS FROM LEAD CAR CONNECTING TO CLIENT LIST SENT
+        self.listSent = None                    # TIME CLIENT LIST WAS SENT
+        self.listening = 0                      # CARS LISTENING FOR THE CAR BEHIND THEM (MSG_READY)
+        self.error = None                       # EXCEPTION RAISED WHILE BINDING
+        self.updates = metrics.counter("ingest_updates")    # POSITION UPDATES PUBLISHED TO THE STORE
+        self.broadcasts = metrics.counter("broadcasts")     # URGENT EVENTS SENT TO EVERY CAR
+        self.detached = metrics.counter("detached")         # CARS REPORTING THROUGH AN AGGREGATOR
+        self.left = metrics.counter("left")                 # CARS THAT LEFT THE PLATOON
+        self.rewires = metrics.counter("rewires")           # MSG_REWIRE SENT TO CARS
+        self.loop = None
+        self.thread = None                      # THREAD RUNNING THE EVENT LOOP
+
+    #-------------------------------------------------------------------------
+    # START EVENT LOOP IN A BACKGROUND THREAD
+    #-------------------------------------------------------------------------
+    def start(self):
+        self.thread = Thread(target=asyncio.run, name="ingest loop", args=(self.serve(),), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    #-------------------------------------------------------------------------
+    # STOP THE SIMULATION FROM ANY THREAD, WAITS UP TO timeout SECONDS FOR THE
+    # EVENT LOOP TO SEND WHAT IS STILL BUFFERED (SEE flush)
+    #-------------------------------------------------------------------------
+    def stop(self, timeout=2.0):
+        with self.lock:
+            self.simulationExit = True
+        if self.shared and self.store is not None:
+            self.store.close()                  # REMOVE SHARED MEMORY
+            self.store = None
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.exitEvent.set)
+            except RuntimeError:                # EVENT LOOP ALREADY CLOSED
+                pass
+        if self.thread is not None and self.thread is not current_thread():
+            self.thread.join(timeout)
+
+    #-------------------------------------------------------------------------
+    # ACCEPT CONNECTIONS UNTIL SIMULATION EXITS
+    #-------------------------------------------------------------------------
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.admit = asyncio.Semaphore(0)       # ONE PERMIT PER 'c' FROM LEAD CAR
+        self.joined = asyncio.Queue()           # IDS OF ADMITTED CLIENTS, IN ORDER OF ARRIVAL
+        self.allJoined = asyncio.Event()        # SET WHEN expect CLIENTS RECEIVED THEIR ID
+        self.startEvent = asyncio.Event()       # SET WHEN CLIENT LIST WAS SENT
+        self.exitEvent = asyncio.Event()        # SET WHEN SIMULATION SHOULD QUIT
+        try:
+            server = await self.link.start_server(self.handle_client, self.host, self.port, self.backlog)
+        except OSError as e:
+            self.error = e
+            self.ready.set()
+            return
+        print("SYSTEM: Server is ready to accept connections.")
+        self.ready.set()
+        async with server:
+            await self.exitEvent.wait()
+            await self.flush()
+        with self.lock:
+            self.simulationExit = True
+
+    #-------------------------------------------------------------------------
+    # SEND WHAT IS STILL BUFFERED (E.G. A BROADCAST QUIT) BEFORE THE LOOP STOPS
+    # WITH MANY CARS THE QUIT OF THE LEAD CAR ENDS THE LOOP WHILE COPIES OF ITS
+    # BROADCAST ARE STILL QUEUED ON SLOW CONNECTIONS
+    #-------------------------------------------------------------------------
+    async def flush(self, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            writers = list(self.writers.values()) + list(self.groups.values())
+            if not any(writer.transport.get_write_buffer_size() for writer in writers if not writer.is_closing()):
+                break
+            await asyncio.sleep(0.01)
+
+    #-------------------------------------------------------------------------
+    # FLAG SIMULATION EXIT FROM INSIDE THE EVENT LOOP
+    #-------------------------------------------------------------------------
+    def exit_simulation(self):
+        with self.lock:
+            self.simulationExit = True
+        self.exitEvent.set()
+        self.updated.set()
+
+    #-------------------------------------------------------------------------
+    # ONE COROUTINE PER CLIENT: HANDSHAKE, THEN TELEMETRY
+    #-------------------------------------------------------------------------
+    async def handle_client(self, reader, writer):
+        try:
+            recvOpt = (await reader.readexactly(1)).decode("utf-8")
+            if recvOpt == "g":                  # AGGREGATOR OF A GROUP OF CARS, NOT A CAR (GROUP NUMBER FOLLOWS)
+                await self.receiveGroup(reader, writer)
+                return
+            clientID = await self.join(reader, writer, recvOpt)
+            if clientID is None:
+                writer.close()
+                return
+            if not await self.send_start_position(reader, writer, clientID):
+                return
+            await self.receivePos(reader, writer, clientID)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            print("SYSTEM: Failure detected, quiting now...\r")
+            self.exit_simulation()
+        except asyncio.CancelledError:          # EVENT LOOP SHUTTING DOWN AFTER SIMULATION EXIT
+            writer.close()
+
+    #-------------------------------------------------------------------------
+    # JOIN PHASE: WAIT FOR ADMISSION, SEND ID, LEAD CAR DRIVES THE MENU
+    # WITH expect, EVERY CLIENT GETS ITS ID IN ORDER OF ARRIVAL WITHOUT WAITING
+    # FOR 'c', SO ALL HANDSHAKES RUN IN PARALLEL
+    #-------------------------------------------------------------------------
+    async def join(self, reader, writer, recvOpt):
+        lead = not self.leadSeen
+        self.leadSeen = True
+        if lead:
+            self.firstConnect = time.monotonic()
+        elif self.expect:
+            if self.clientID >= self.expect or not self.accepting:
+                return None                     # PLATOON IS FULL
+        else:
+            # WAIT UNTIL LEAD CAR PRESSES 'c' TO ACCEPT ONE MORE CLIENT
+            self.waiting += 1
+            await self.admit.acquire()
+            self.waiting -= 1
+            if not self.accepting:
+                return None
+
+        self.clientID += 1                      # ASSIGN CLIENT ID IN ORDER OF ADMISSION
+        clientID = self.clientID
+        clientAdd = writer.get_extra_info("peername")
+        if not isinstance(clientAdd, tuple):    # UNIX AND IN-PROCESS PEERS HAVE NO HOST:PORT
+            clientAdd = (self.host, 0)
+        print("SYSTEM: Connection received from CLIENT " + str(clientID) + " with address " + str(clientAdd[0]) + ":" + str(clientAdd[1]))
+        self.add_client_to_list(writer, clientID, clientAdd)
+        if recvOpt == "0":
+            self.send_client_ID(writer, clientID)
+            await writer.drain()
+        self.idsSent += 1
+        if self.idsSent == self.expect:
+            self.allJoined.set()
+        if not lead and not self.expect:
+            self.joined.put_nowait(clientID)    # ID IS SENT, LEAD CAR MENU MAY CONTINUE
+
+        if lead:
+            await self.lead_menu(reader)
+        else:
+            await self.startEvent.wait()
+        return clientID
+
+    #-------------------------------------------------------------------------
+    # LEAD CAR MENU: 'c' ACCEPTS ONE MORE CLIENT, 's' STARTS SIMULATION
+    #-------------------------------------------------------------------------
+    async def lead_menu(self, reader):
+        while True:
+            menu = (await reader.readexactly(1)).decode("utf-8")
+            if menu == "c":
+                if self.expect:                 # CLIENTS ARE ADMITTED WITHOUT 'c'
+                    continue
+                if self.clientID >= transport.MAXCARS:  # PLATOON IS FULL, NO PORT FOR ONE MORE CAR
+                    print("SYSTEM: at most {} cars per platoon.".format(transport.MAXCARS))
+                    continue
+                self.admit.release()            # ADMIT ONE CLIENT AND WAIT UNTIL IT HAS JOINED
+                await self.joined.get()
+            elif menu == "s":
+                if self.expect:                 # START ONCE THE WHOLE PLATOON HAS JOINED
+                    await self.allJoined.wait()
+                print("SYSTEM: Sending client list to all clients.")
+                self.accepting = False
+                for i in range(self.waiting):   # TURN AWAY CLIENTS STILL WAITING
+                    self.admit.release()
+                await self.send_client_list()
+                break
+
+    #-------------------------------------------------------------------------
+    # SEND CLIENT ID WHEN APPROPRIATE REQUEST IS RECEIVED
+    #-------------------------------------------------------------------------
+    def send_client_ID(self, writer, clientID):
+        writer.write((str(clientID) + "\n").encode("utf-8"))    # NEWLINE SEPARATES ID FROM CLIENT LIST
+
+    #-------------------------------------------------------------------------
+    # ADD A CLIENT CONNECTION AND INFORMATION TO LIST
+    #-------------------------------------------------------------------------
+    def add_client_to_list(self, writer, clientID, clientAdd):
+        self.clientList[clientID] = clientAdd[:2]
+        self.writers[clientID] = writer
+
+    #-------------------------------------------------------------------------
+    # SEND CLIENT LIST TO ALL CLIENTS AND INITIALIZE STATE
+    #-------------------------------------------------------------------------
+    async def send_client_list(self):
+        self.start_x = start_positions(len(self.clientList))
+        if self.shared:
+            self.store = SharedStore(shared_name(self.port), len(self.clientList), create=True)
+        else:
+            self.store = SnapshotStore(len(self.clientList))
+        self.store.reset(self.start_x, time.time())
+        self.roster = Roster({clientID: self.start_x[clientID-1] for clientID in self.clientList})
+        jsonList = json.dumps(self.clientList).encode("utf-8")
+        for writer in self.writers.values():
+            writer.write(jsonList)
+        await asyncio.gather(*[writer.drain() for writer in self.writers.values()])
+        self.listSent = time.monotonic()
+        self.joinTime = self.listSent - self.firstConnect
+        metrics.gauge("join_seconds").set(self.joinTime)
+        print("SYSTEM: {} cars joined in {:.3f} s.".format(len(self.clientList), self.joinTime))
+        self.startEvent.set()
+        self.started.set()
+
+    #-------------------------------------------------------------------------
+    # SEND START POSITION ON 'xpos' REQUEST
+    #-------------------------------------------------------------------------
+    async def send_start_position(self, reader, writer, clientID):
+        qqq = (await reader.readexactly(4)).decode("utf-8")   # RECEIVE REQUEST FROM CLIENT TO SEND START POSITION
+        if qqq != "xpos":
+            print(clientID, qqq)
+            print("Could not send the position to client")
+            self.exit_simulation()
+            return False
+        writer.write(str(self.start_x[clientID-1]).encode("utf-8"))
+        await writer.drain()
+        return True
+
+    #-------------------------------------------------------------------------
+    # SEND AN URGENT EVENT TO EVERY CAR BUT ITS ORIGIN, WITHOUT WAITING FOR ANY OF THEM
+    #-------------------------------------------------------------------------
+    def broadcast(self, msg, origin):
+        frame = protocol.pack(msg.type, msg.carid, msg.seq, msg.pos, msg.speed, msg.ts)
+        for clientID, writer in self.writers.items():
+            if clientID != origin and not writer.is_closing():
+                writer.write(frame)
+        for writer in self.groups.values():     # AGGREGATORS PASS IT ON TO THEIR CARS BUT THE ORIGIN
+            if not writer.is_closing():
+                writer.write(frame)
+        self.broadcasts.inc()
+
+    #-------------------------------------------------------------------------
+    # TELL CARS WHOSE NEIGHBOURS CHANGED ({CAR ID: (FRONT, BACK)}) TO REWIRE, A CAR
+    # REPORTING THROUGH AN AGGREGATOR GETS IT FROM ITS AGGREGATOR
+    #-------------------------------------------------------------------------
+    def rewire(self, changes):
+        for clientID, (front, back) in changes.items():
+            frame = protocol.pack_rewire(clientID, front, back)
+            writers = [self.writers[clientID]] if clientID in self.writers else self.groups.values()
+            for writer in writers:
+                if not writer.is_closing():
+                    writer.write(frame)
+        self.rewires.inc(len(changes))
+        print("SYSTEM: Platoon order changed, " + str(len(changes)) + " cars rewired: " + str(self.roster.order()) + "\r")
+
+    #-------------------------------------------------------------------------
+    # CAR LEFT THE PLATOON, ITS FRONT AND BACK CAR LINK TO EACH OTHER
+    #-------------------------------------------------------------------------
+    def leave(self, clientID):
+        print("SYSTEM: CLIENT " + str(clientID) + " left the platoon.\r")
+        self.left.inc()
+        changes = self.roster.remove(clientID)
+        if changes:
+            self.rewire(changes)
+
+    #-------------------------------------------------------------------------
+    # ONE MORE CAR IS LISTENING FOR ITS PEER, ONCE ALL ARE, TELL EVERY CAR TO
+    # CONNECT TO ITS FRONT CAR: ALL PEER LINKS COME UP AT ONCE, NOT DOWN THE CHAIN
+    #-------------------------------------------------------------------------
+    def peer_ready(self):
+        self.listening += 1
+        if self.listening != len(self.clientList):
+            return
+        frame = protocol.pack(protocol.MSG_GO)
+        for writer in self.writers.values():
+            if not writer.is_closing():
+                writer.write(frame)
+        elapsed = time.monotonic() - self.listSent
+        metrics.gauge("listen_seconds").set(elapsed)
+        print("SYSTEM: {} cars listening for peers {:.3f} s after the client list.".format(self.listening, elapsed))
+
+    #-------------------------------------------------------------------------
+    # RECEIVE BATCHES OF UPDATES AND EVENTS OF A GROUP OF CARS FROM ITS AGGREGATOR
+    # BATCHES ARE NOT ACKED, THE AGGREGATOR ACKS ITS CARS ITSELF
+    #-------------------------------------------------------------------------
+    async def receiveGroup(self, reader, writer):
+        try:                                    # GROUP NUMBER OF THE AGGREGATOR, NEWLINE TERMINATED
+            group = int((await reader.readline()).decode("utf-8"))
+        except ValueError:
+            writer.close()
+            return
+        if group in self.groups:                # ONE AGGREGATOR PER GROUP
+            print("SYSTEM: Aggregator of group " + str(group) + " already connected.\r")
+            writer.close()
+            return
+        self.groups[group] = writer
+        print("SYSTEM: Aggregator of group " + str(group) + " connected.\r")
+        batchSize = metrics.histogram("batch_size", metrics.DEPTHS, group=group)
+        msgsReceived = metrics.counter("msgs_received", group=group, link="ingest")
+        bytesReceived = metrics.counter("bytes_received", group=group, link="ingest")
+        await self.startEvent.wait()            # STORE EXISTS ONCE THE CLIENT LIST WAS SENT
+        while not self.exitEvent.is_set():
+            body = await protocol.readbody(reader)
+            if body is None:                    # AGGREGATOR GONE, ITS CARS CAN NOT REPORT ANY MORE
+                print("SYSTEM: Failure detected, quiting now...\r")
+                self.exit_simulation()
+                break
+            msgsReceived.inc()
+            bytesReceived.inc(protocol.HEADER.size + len(body))
+            if body[0] == protocol.MSG_BATCH:
+                msg, entries = protocol.unpack_batch(body)
+                for entry in entries:
+                    self.store.update(entry.carid - 1, entry.pos, entry.speed, entry.ts)
+                    changes = self.roster.update(entry.carid, entry.pos)
+                    if changes:
+                        self.rewire(changes)
+                self.updates.inc(len(entries))
+                batchSize.observe(len(entries))
+                self.updated.set()
+                continue
+            msg = protocol.unpack(body)
+            if msg.type in protocol.UNBROADCAST:
+                self.broadcast(msg, msg.carid)
+            elif msg.type == protocol.MSG_LEAVE:
+                self.leave(msg.carid)
+            elif msg.type == protocol.MSG_QUIT: # A CAR OF THE GROUP QUIT OR FAILED
+                self.exit_simulation()
+                break
+        writer.close()
+
+    #-------------------------------------------------------------------------
+    # RECEIVE POSITION AND SPEED INFORMATION FROM ONE CLIENT
+    #-------------------------------------------------------------------------
+    async def receivePos(self, reader, writer, key):
+        unacked = 0                             # STREAMED UPDATES SINCE LAST CUMULATIVE ACK
+        lastack = time.monotonic()
+        # PER CONNECTION METRICS, RECV TIME INCLUDES WAITING FOR THE NEXT MESSAGE
+        msgsReceived = metrics.counter("msgs_received", car=key, link="ingest")
+        bytesReceived = metrics.counter("bytes_received", car=key, link="ingest")
+        msgsSent = metrics.counter("msgs_sent", car=key, link="ingest")
+        bytesSent = metrics.counter("bytes_sent", car=key, link="ingest")
+        recvSeconds = metrics.histogram("recv_seconds", car=key, link="ingest")
+        while not self.exitEvent.is_set():
+            start = time.perf_counter()
+            msg = await protocol.readmsg(reader)
+            recvSeconds.observe(time.perf_counter() - start)
+            if msg is None:                     # IF CONNECTION WAS CLOSED BY CLIENT THEN QUIT SIMULATION
+                print("SYSTEM: Failure detected, quiting now...\r")
+                self.exit_simulation()
+                break
+            msgsReceived.inc()
+            bytesReceived.inc(protocol.FRAME.size)
+            # CAR REPORTS THROUGH AN AGGREGATOR FROM NOW ON, CLOSING THIS CONNECTION IS NO FAILURE
+            if msg.type == protocol.MSG_DETACH:
+                del self.writers[key]
+                self.detached.inc()
+                break
+            # CAR LEFT THE PLATOON, CLOSING THIS CONNECTION IS NO FAILURE
+            if msg.type == protocol.MSG_LEAVE:
+                del self.writers[key]
+                self.leave(key)
+                break
+            # PEER SET UP: THIS CAR IS LISTENING FOR THE CAR BEHIND IT
+            if msg.type == protocol.MSG_READY:
+                self.peer_ready()
+                continue
+            # URGENT EVENT (STOP, QUIT) STARTED BY THIS CAR, SEND IT TO EVERY OTHER CAR
+            if msg.type in protocol.UNBROADCAST:
+                self.broadcast(msg, key)
+                continue
+            # CHECK IF USER QUIT SIMULATION ON CLIENT SIDE, THEN QUIT SIMULATION ON SERVER SIDE
+            if msg.type == protocol.MSG_QUIT:
+                self.exit_simulation()
+                break
+            if msg.type != protocol.MSG_POS and msg.type != protocol.MSG_STREAM:
+                continue                        # IGNORE ANY OTHER MESSAGE
+
+            # PUBLISH POSITION AND SPEED OF CAR WITHOUT WAITING FOR READERS
+            self.store.update(key-1, msg.pos, msg.speed, time.time())
+            self.updates.inc()
+            changes = self.roster.update(key, msg.pos)
+            if changes:
+                self.rewire(changes)
+            self.updated.set()
+            # SEND ACK TO CLIENT ON RECEIVING INFORMATION
+            if msg.type == protocol.MSG_POS:
+                writer.write(protocol.pack(protocol.MSG_ACK, key, msg.seq))
+                await writer.drain()
+                msgsSent.inc()
+                bytesSent.inc(protocol.FRAME.size)
+                continue
+            # STREAMED UPDATES ARE ACKED CUMULATIVELY, EVERY ACKEVERY UPDATES OR ACKINTERVAL SECONDS
+            unacked += 1
+            now = time.monotonic()
+            if unacked >= ACKEVERY or now - lastack >= ACKINTERVAL:
+                writer.write(protocol.pack(protocol.MSG_ACK, key, msg.seq))
+                await writer.drain()
+                msgsSent.inc()
+                bytesSent.inc(protocol.FRAME.size)
+                unacked = 0
+                lastack = now
+        writer.close()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Platoon launcher
+
+Starts server.py and N client.py processes on this machine and drives the
+join phase without a terminal: the lead car gets the script "c" x (N-1),
+"s", then KEYS, every other car an empty script. The server runs with
+--expect N, so all cars join in parallel (--serial keeps the one car per
+'c' join of the lead car menu). Reports how long each
+phase of the start up took, from launch until
+
+    server          the server is listening
+    groups          every aggregator is connected to the server (--groups G only)
+    ids             every car has its ID
+    ready           every car is linked to its neighbours (simulation runs)
+    exit            every process has exited
+
+    python3 launcher.py N [--keys KEYS] [--delay SEC] [--transport tcp|unix] [--shm] [--view] [--serial] [--groups G]
+                          [--client-args ARGS] [--server-args ARGS] [--logs DIR] [--timeout SEC] [--out FILE]
+
+The output of every process is read by one selector loop, lines are kept in
+DIR/server.log and DIR/carID.log with --logs.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import os, sys, time, json, shlex, socket, argparse, selectors, subprocess
+import transport
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# LINES MARKING THE END OF A START UP PHASE
+SERVERREADY = "Server is ready to accept connections"
+IDRECEIVED = "My position (ID) is"
+PEERSLINKED = "Connection with peers is successful"
+GROUPREADY = "Aggregator of group"
+
+#-----------------------------------------------------------------------------
+# One child process, its output is split into lines as it arrives
+#-----------------------------------------------------------------------------
+class Child:
+    def __init__(self, name, args, logdir=None):
+        self.name = name
+        env = dict(os.environ, PYTHONUNBUFFERED="1", TERM=os.environ.get("TERM", "dumb"))
+        self.proc = subprocess.Popen(args, cwd=os.getcwd(), env=env, stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        self.buf = b""
+        self.marks = {}                         # LINE MARK -> TIME IT WAS SEEN
+        self.log = open(os.path.join(logdir, name + ".log"), "w") if logdir else None
+
+    #-------------------------------------------------------------------------
+    # READ AVAILABLE OUTPUT, RETURNS FALSE AT END OF OUTPUT
+    #-------------------------------------------------------------------------
+    def read(self, now):
+        data = os.read(self.proc.stdout.fileno(), 65536)
+        if not data:
+            return False
+        *lines, self.buf = (self.buf + data).split(b"\n")
+        for line in lines:
+            text = line.decode("utf-8", "replace").strip("\r")
+            for mark in (SERVERREADY, IDRECEIVED, PEERSLINKED, GROUPREADY):
+                if mark in text and mark not in self.marks:
+                    self.marks[mark] = now
+            if self.log:
+                self.log.write(text + "\n")
+        return True
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+        if self.log:
+            self.log.close()
+
+#-----------------------------------------------------------------------------
+# Launcher of one platoon
+#-----------------------------------------------------------------------------
+class Launcher:
+    def __init__(self, numcars, keys="dd.....q", delay=1.0, clientArgs=(), serverArgs=(), logdir=None, timeout=60.0,
+                 groups=0, groupArgs=()):
+        self.numcars = numcars
+        self.keys = keys                        # PRESSED BY THE LEAD CAR ONCE THE SIMULATION STARTED
+        self.delay = delay
+        self.clientArgs = list(clientArgs)
+        self.serverArgs = list(serverArgs)
+        self.logdir = logdir
+        self.timeout = timeout                  # MAX SECONDS OF EVERY PHASE
+        self.groups = groups                    # AGGREGATORS, CAR i REPORTS THROUGH GROUP i % groups
+        self.groupArgs = list(groupArgs)
+        self.selector = selectors.DefaultSelector()
+        self.children = []
+        self.start = None
+
+    #-------------------------------------------------------------------------
+    # START ONE PROCESS AND WATCH ITS OUTPUT
+    #-------------------------------------------------------------------------
+    def spawn(self, name, script, args):
+        child = Child(name, [sys.executable, os.path.join(HERE, script)] + args, self.logdir)
+        self.selector.register(child.proc.stdout, selectors.EVENT_READ, child)
+        self.children.append(child)
+        return child
+
+    #-------------------------------------------------------------------------
+    # READ OUTPUT UNTIL done() IS TRUE, RETURNS TIME SINCE LAUNCH
+    #-------------------------------------------------------------------------
+    def wait(self, phase, done):
+        deadline = time.monotonic() + self.timeout
+        while not done():
+            if time.monotonic() > deadline:
+                raise TimeoutError("{} not reached within {} s".format(phase, self.timeout))
+            if not self.selector.get_map():     # ALL OUTPUT CLOSED, WAIT FOR THE PROCESSES TO EXIT
+                if all(child.proc.poll() is not None for child in self.children) and not done():
+                    raise RuntimeError("{} not reached, all processes exited".format(phase))
+                time.sleep(0.05)
+                continue
+            for key, events in self.selector.select(0.1):
+                if not key.data.read(time.monotonic()):
+                    self.selector.unregister(key.fileobj)
+        return time.monotonic() - self.start
+
+    #-------------------------------------------------------------------------
+    # CLIENT ARGUMENTS SELECTING THE AGGREGATOR OF CAR i (NONE WITHOUT GROUPS)
+    #-------------------------------------------------------------------------
+    def group(self, i):
+        return ["--group", str(i % self.groups)] if self.groups else []
+
+    #-------------------------------------------------------------------------
+    # LAUNCH SERVER AND CARS, RETURNS SECONDS FROM LAUNCH TO EVERY PHASE
+    #-------------------------------------------------------------------------
+    def run(self):
+        hostname = socket.gethostname()         # SERVER LISTENS ON THE ADDRESS OF THIS HOST NAME
+        self.start = time.monotonic()
+        times = {}
+        try:
+            server = self.spawn("server", "server.py", self.serverArgs)
+            times["server"] = self.wait("server", lambda: SERVERREADY in server.marks)
+            if self.groups:
+                aggregators = [self.spawn("group{}".format(g), "aggregator.py", [hostname, str(g)] + self.groupArgs)
+                               for g in range(self.groups)]
+                times["groups"] = self.wait("groups", lambda: all(GROUPREADY in a.marks for a in aggregators))
+
+            # LEAD CAR FIRST: ACCEPTS EVERY OTHER CAR, STARTS THE SIMULATION, THEN PLAYS KEYS
+            leadkeys = "c"*(self.numcars - 1) + "s" + self.keys
+            lead = self.spawn("car1", "client.py", [hostname, "--keys", leadkeys, "--keydelay", str(self.delay),
+                                                    "--maxclients", str(max(self.numcars, 1))] + self.group(0) + self.clientArgs)
+            self.wait("lead car ID", lambda: IDRECEIVED in lead.marks)
+            # OTHER CARS ALL AT ONCE, ADMITTED ONE BY ONE IN ORDER OF ARRIVAL
+            for i in range(1, self.numcars):
+                self.spawn("car{}".format(i+1), "client.py", [hostname, "--keys", ""] + self.group(i) + self.clientArgs)
+            cars = [child for child in self.children if child.name.startswith("car")]
+
+            times["ids"] = self.wait("ids", lambda: all(IDRECEIVED in car.marks for car in cars))
+            times["ready"] = self.wait("ready", lambda: all(PEERSLINKED in car.marks for car in cars))
+            times["exit"] = self.wait("exit", lambda: all(child.proc.poll() is not None for child in self.children))
+        finally:
+            for child in self.children:
+                child.close()
+            self.selector.close()
+        return times
+
+#-----------------------------------------------------------------------------
+################################ MAIN FUNCTION ###############################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start the server and N clients and time the start up")
+    parser.add_argument("numcars", type=int, help="number of cars")
+    parser.add_argument("--keys", default="dd.....q", help="keys pressed by the lead car after start, '.' waits (default %(default)s)")
+    parser.add_argument("--delay", type=float, default=1.0, help="seconds waited for each '.' (default %(default)s)")
+    parser.add_argument("--transport", choices=("tcp", "unix"), default="tcp", help="transport between cars and server (default %(default)s)")
+    parser.add_argument("--shm", action="store_true", help="cars publish positions through shared memory")
+    parser.add_argument("--view", action="store_true", help="show the pygame viewer instead of recording headless")
+    parser.add_argument("--serial", action="store_true", help="admit one car per 'c' of the lead car instead of all cars in parallel")
+    parser.add_argument("--groups", type=int, default=0, help="start this many aggregators, cars report through them (default none)")
+    parser.add_argument("--client-args", default="", help="more arguments for every client.py")
+    parser.add_argument("--server-args", default="", help="more arguments for server.py")
+    parser.add_argument("--logs", help="write the output of every process to this directory")
+    parser.add_argument("--timeout", type=float, default=60.0, help="max seconds of every start up phase (default %(default)s)")
+    parser.add_argument("--out", help="also write the phase times as JSON to this file")
+    args = parser.parse_args()
+    if args.numcars > transport.MAXCARS:        # CAR PORTS ABOVE THAT BELONG TO AGGREGATORS
+        sys.exit("SYSTEM: at most {} cars per platoon".format(transport.MAXCARS))
+    if args.groups > transport.MAXGROUPS:
+        sys.exit("SYSTEM: at most {} groups per platoon".format(transport.MAXGROUPS))
+
+    common = ["--transport", args.transport] + (["--shm"] if args.shm else [])
+    serverArgs = common + ([] if args.view else ["--headless"]) + shlex.split(args.server_args)
+    if not args.serial:
+        serverArgs += ["--expect", str(args.numcars)]
+    clientArgs = common + shlex.split(args.client_args)
+    if args.logs:
+        os.makedirs(args.logs, exist_ok=True)
+    launcher = Launcher(args.numcars, args.keys, args.delay, clientArgs, serverArgs, args.logs, args.timeout,
+                        args.groups, ["--transport", args.transport])
+    times = launcher.run()
+    for phase, seconds in times.items():
+        print("SYSTEM: {:<7} {:8.3f} s".format(phase, seconds))
+    print("SYSTEM: {} cars ready in {:.3f} s ({:.1f} cars/s)".format(
+        args.numcars, times["ready"], args.numcars/times["ready"]))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"cars": args.numcars, "transport": args.transport, "time": time.time(), "phases": times}, f, indent=2)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Platoon layout stage
+
+Takes one consistent snapshot (see snapshot.py) of the positions and speeds
+received by the server per frame and computes, in a single vectorized pass,
+the headway of every car, the cumulative offset of every car behind the lead
+car and the screen x coordinate of every car. The render loop and the recorder both use
+the same layout, so nothing is recomputed or re-parsed per car.
+
+Cars are laid out in the order of the platoon (see roster.py), not by ID: a
+car that left is not part of the layout and the headway of every car is the
+distance to the car actually in front of it.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+from collections import namedtuple
+import numpy as np
+
+#-----------------------------------------------------------------------------
+# Layout of one frame, index i holds the i-th car from the front,
+# slots[i] ITS INDEX IN THE SNAPSHOT (CAR ID - 1)
+#-----------------------------------------------------------------------------
+Layout = namedtuple("Layout", "position speed headway offset screen_x slots")
+
+#-----------------------------------------------------------------------------
+# Function to lay out the platoon, lead car is kept at 'd' once it reaches it
+# slots ARE THE SNAPSHOT INDICES OF THE CARS FROM FRONT TO BACK (DEFAULT ALL CARS BY ID)
+#-----------------------------------------------------------------------------
+def compute(position, speed, d, slots=None):
+    if slots is None:
+        slots = np.arange(len(position))
+    else:                                       # ONLY CARS STILL IN THE PLATOON, FRONT CAR FIRST
+        position, speed = position[slots], speed[slots]
+    # HEADWAY TO THE CAR IN FRONT, HEADWAY OF LEAD CAR IS 0
+    headway = np.zeros(len(position))
+    np.subtract(position[:-1], position[1:], out=headway[1:])
+    # CUMULATIVE HEADWAY = DISTANCE BEHIND THE LEAD CAR
+    offset = np.cumsum(headway)
+    # BEFORE THE LEAD CAR REACHES 'd' CARS ARE DRAWN AT THEIR POSITION,
+    # AFTER THAT THE PLATOON IS KEPT IN THE CENTRE OF THE SCREEN
+    if len(position) and position[0] >= d:
+        screen_x = d - offset
+    else:
+        screen_x = position
+    return Layout(position, speed, headway, offset, screen_x, slots)
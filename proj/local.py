@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-process platoon run
+
+Hosts the server and N clients in one process, every client in its own
+thread, connected through the in-process transport by default (no ports, no
+TCP stack). The lead car accepts every client and starts the simulation,
+then plays KEYS ('.' waits DELAY seconds); the other cars take no input.
+The server records headless unless --view is given. With --shm, cars
+publish positions through shared memory instead of messages.
+
+    python3 local.py N [--keys KEYS] [--delay SEC] [--transport inproc|unix|tcp] [--shm] [--view] [--stats SEC] [--seed N] [--record PREFIX]
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import time, argparse
+from threading import Thread
+import client, server, transport, metrics
+from ingest import IngestServer
+
+#-----------------------------------------------------------------------------
+# Function to run server and clients, returns when the simulation exits
+#-----------------------------------------------------------------------------
+def run_local(numcars, keys, delay=1.0, link=None, headless=True, shared=False):
+    link = link or transport.InProcTransport()
+    host = "127.0.0.1"
+    client.shm = shared
+    ingest = IngestServer(host, 6789, link=link, shared=shared, expect=numcars)   # ALL CARS JOIN IN PARALLEL
+    ingest.start()
+
+    # LEAD CAR CONNECTS FIRST, ACCEPTS EVERY OTHER CAR AND STARTS THE SIMULATION
+    leadkeys = client.KeyScript("c"*(numcars - 1) + "s" + keys, delay)
+    cars = [Thread(target=client.run_client, name="car 1", args=(host, link, leadkeys), daemon=True)]
+    cars[0].start()
+    while not ingest.leadSeen:
+        time.sleep(0.01)
+    for i in range(1, numcars):
+        car = Thread(target=client.run_client, name="car {}".format(i+1), args=(host, link, client.KeyScript("")), daemon=True)
+        car.start()
+        cars.append(car)
+
+    ingest.started.wait()                       # WAIT UNTIL LEAD CAR STARTS THE SIMULATION
+    if headless:
+        server.run_headless(ingest)
+    else:
+        server.start_simulation(ingest)
+    ingest.stop()
+    for car in cars:                            # LET CARS CLOSE THEIR LINKS
+        car.join(5)
+
+#-----------------------------------------------------------------------------
+################################ MAIN FUNCTION ###############################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="P2P platoon simulation, server and clients in one process")
+    parser.add_argument("numcars", type=int, help="number of cars")
+    parser.add_argument("--keys", default="dd.....q", help="keys pressed by the lead car after start, '.' waits (default %(default)s)")
+    parser.add_argument("--delay", type=float, default=1.0, help="seconds waited for each '.' (default %(default)s)")
+    parser.add_argument("--transport", choices=sorted(transport.TRANSPORTS), default="inproc", help="transport between cars and server (default %(default)s)")
+    parser.add_argument("--shm", action="store_true", help="cars publish positions through shared memory")
+    parser.add_argument("--view", action="store_true", help="show the pygame viewer instead of recording headless")
+    parser.add_argument("--stats", type=float, default=0, help="print metrics of server and cars to stderr every SEC seconds (default off)")
+    parser.add_argument("--seed", type=int, help="random seed of the platoon (default random)")
+    parser.add_argument("--record", metavar="PREFIX", help="log every input of every car, replay with replay.py PREFIX")
+    args = parser.parse_args()
+    client.seed = args.seed
+    client.record = args.record
+    if args.stats:
+        metrics.registry.start_dump(args.stats)
+    run_local(args.numcars, args.keys, args.delay, transport.get(args.transport), not args.view, args.shm)
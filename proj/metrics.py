@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runtime metrics
+
+Counters, gauges and histograms kept in one registry per process, cheap
+enough to update on every message and every tick: an update is a few
+attribute writes, no lock and no I/O. Threads update them without locking,
+so an increment racing another thread on the same metric may rarely be lost.
+
+Metrics are read either by a periodic dump (text on stderr, counters with
+their rate since the last dump) or by scraping a local HTTP endpoint in the
+Prometheus text format:
+
+    curl http://127.0.0.1:PORT/metrics
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import sys, time, bisect
+from threading import Thread, Lock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# HISTOGRAM BUCKET UPPER BOUNDS (SECONDS FOR LATENCIES, COUNTS FOR DEPTHS, POSITION UNITS FOR DISTANCES)
+BOUNDS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+          1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEPTHS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+DISTANCES = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 100.0)
+
+#-----------------------------------------------------------------------------
+# Monotonic counter
+#-----------------------------------------------------------------------------
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+#-----------------------------------------------------------------------------
+# Gauge, either set by its owner or read from a function at collection time
+#-----------------------------------------------------------------------------
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    @property
+    def value(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.current
+
+#-----------------------------------------------------------------------------
+# Histogram with fixed buckets
+#-----------------------------------------------------------------------------
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds) + 1)     # LAST BUCKET COUNTS VALUES ABOVE ALL BOUNDS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    #-------------------------------------------------------------------------
+    # UPPER BOUND OF THE BUCKET HOLDING QUANTILE q (MAX IF ABOVE ALL BOUNDS)
+    #-------------------------------------------------------------------------
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q*self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+#-----------------------------------------------------------------------------
+# Lock recording how long every acquire waited
+#-----------------------------------------------------------------------------
+class TimedLock:
+    def __init__(self, hist):
+        self.lock = Lock()
+        self.hist = hist
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.hist.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+#-----------------------------------------------------------------------------
+# Socket wrapper counting messages and bytes and timing every send and recv
+# EVERY sendall() CARRIES ONE MESSAGE, RECEIVED MESSAGES ARE COUNTED IN FRAMES
+# OF framesize BYTES (ALL PROTOCOL FRAMES HAVE THE SAME SIZE). RECV TIME
+# INCLUDES WAITING FOR DATA. EVERYTHING ELSE IS PASSED TO THE SOCKET.
+#-----------------------------------------------------------------------------
+class MeteredSocket:
+    def __init__(self, sock, framesize, **labels):
+        self.sock = sock
+        self.framesize = framesize
+        self.partial = 0                        # BYTES OF A FRAME NOT COMPLETELY RECEIVED
+        self.msgs_sent = registry.counter("msgs_sent", **labels)
+        self.bytes_sent = registry.counter("bytes_sent", **labels)
+        self.msgs_received = registry.counter("msgs_received", **labels)
+        self.bytes_received = registry.counter("bytes_received", **labels)
+        self.send_seconds = registry.histogram("send_seconds", **labels)
+        self.recv_seconds = registry.histogram("recv_seconds", **labels)
+
+    def sendall(self, data):
+        start = time.perf_counter()
+        self.sock.sendall(data)
+        self.send_seconds.observe(time.perf_counter() - start)
+        self.msgs_sent.inc()
+        self.bytes_sent.inc(len(data))
+
+    def recv(self, size, *flags):
+        start = time.perf_counter()
+        data = self.sock.recv(size, *flags)
+        self.recv_seconds.observe(time.perf_counter() - start)
+        self.bytes_received.inc(len(data))
+        self.partial += len(data)
+        if self.partial >= self.framesize:
+            self.msgs_received.inc(self.partial // self.framesize)
+            self.partial %= self.framesize
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+#-----------------------------------------------------------------------------
+# Registry of all metrics of this process, keyed by name and labels
+#-----------------------------------------------------------------------------
+class Registry:
+    def __init__(self):
+        self.metrics = {}                       # (NAME, LABELS) -> METRIC
+        self.lock = Lock()                      # ONLY FOR CREATING METRICS
+        self.started = time.monotonic()
+
+    def get(self, cls, name, labels, *args):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, cls(*args))
+        return metric
+
+    def counter(self, name, **labels):
+        return self.get(Counter, name, labels)
+
+    def gauge(self, name, fn=None, **labels):
+        gauge = self.get(Gauge, name, labels)
+        if fn is not None:                      # A NEW OWNER (E.G. NEXT RUN) REPLACES THE FUNCTION
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, bounds=BOUNDS, **labels):
+        return self.get(Histogram, name, labels, bounds)
+
+    #-------------------------------------------------------------------------
+    # PROMETHEUS TEXT FORMAT
+    #-------------------------------------------------------------------------
+    def render(self):
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append("# TYPE platoon_{} {}".format(name, metric.kind))
+                typed.add(name)
+            if metric.kind != "histogram":
+                lines.append("platoon_{}{} {}".format(name, fmtlabels(labels), metric.value))
+                continue
+            seen = 0
+            for bound, n in zip(metric.bounds + ("+Inf",), metric.counts):
+                seen += n
+                lines.append("platoon_{}_bucket{} {}".format(name, fmtlabels(labels + (("le", str(bound)),)), seen))
+            lines.append("platoon_{}_sum{} {}".format(name, fmtlabels(labels), metric.sum))
+            lines.append("platoon_{}_count{} {}".format(name, fmtlabels(labels), metric.count))
+        return "\n".join(lines) + "\n"
+
+    #-------------------------------------------------------------------------
+    # HUMAN READABLE SUMMARY, COUNTER RATES SINCE last (NAME -> (VALUE, TIME))
+    #-------------------------------------------------------------------------
+    def summary(self, last):
+        now = time.monotonic()
+        lines = ["METRICS at {:.1f}s".format(now - self.started)]
+        for key, metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+            name = key[0] + fmtlabels(key[1])
+            if metric.kind == "counter":
+                prev, since = last.get(key, (0, self.started))
+                rate = (metric.value - prev)/(now - since) if now > since else 0.0
+                last[key] = (metric.value, now)
+                lines.append("  {} {} ({:.1f}/s)".format(name, metric.value, rate))
+            elif metric.kind == "gauge":
+                lines.append("  {} {}".format(name, metric.value))
+            elif metric.count:
+                scale, unit = (1000.0, "ms") if metric.bounds is BOUNDS else (1, "")
+                lines.append("  {} n={} mean={:.3f}{u} p50<={:.3f}{u} p99<={:.3f}{u} max={:.3f}{u}".format(
+                    name, metric.count, scale*metric.sum/metric.count, scale*metric.quantile(0.5),
+                    scale*metric.quantile(0.99), scale*metric.max, u=unit))
+        return lines
+
+    #-------------------------------------------------------------------------
+    # PRINT A SUMMARY EVERY interval SECONDS FROM A BACKGROUND THREAD
+    #-------------------------------------------------------------------------
+    def start_dump(self, interval, out=None):
+        def dump():
+            last = {}
+            while True:
+                time.sleep(interval)
+                # LINES END WITH \r\n, CLIENT TERMINALS MAY BE IN RAW MODE
+                (out or sys.stderr).write("\r\n".join(self.summary(last)) + "\r\n")
+        Thread(target=dump, name="metrics dump", daemon=True).start()
+
+    #-------------------------------------------------------------------------
+    # SERVE GET /metrics ON host:port FROM A BACKGROUND THREAD
+    #-------------------------------------------------------------------------
+    def serve(self, port, host="127.0.0.1"):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):      # NO LOG LINE PER SCRAPE
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        httpd.daemon_threads = True
+        Thread(target=httpd.serve_forever, name="metrics endpoint", daemon=True).start()
+        return httpd
+
+#-----------------------------------------------------------------------------
+# Function to format labels as {k="v",...}
+#-----------------------------------------------------------------------------
+def fmtlabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+#-----------------------------------------------------------------------------
+# PROCESS-WIDE REGISTRY
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
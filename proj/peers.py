@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Live peer links of one car
+
+The links of a car to the car in front and the car behind it, replaced while
+the car runs. The server keeps the order of the platoon (see roster.py) and
+sends MSG_REWIRE to every car whose neighbours changed, e.g. when a car
+leaves: its front and back car get each other as neighbours and link up
+without the platoon being restarted.
+
+Every car keeps listening on port + ID after the start, a new back car
+connects there and says who it is (MSG_ATTACH), a new front car is connected
+to. Rewires are applied one at a time in order by their own thread. Threads
+using a link read links.front / links.back on every use, a thread whose link
+was closed waits for its replacement (see wait) instead of ending. The ID of
+a missing neighbour is 0 and its link is None.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import socket, queue
+from threading import Thread, Condition
+import protocol, metrics
+
+REWIRETIMEOUT = 5.0     # MAX SECONDS TO WAIT FOR A NEW BACK CAR, OR FOR THE REPLACEMENT OF A CLOSED LINK
+
+#-----------------------------------------------------------------------------
+# Function to close a socket another thread may be blocked on (close alone does not wake it)
+#-----------------------------------------------------------------------------
+def shut(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):           # NOT CONNECTED, OR IN-PROCESS LISTENER
+        pass
+    sock.close()
+
+#-----------------------------------------------------------------------------
+# Front and back link of one car
+# connect(ID) RETURNS A SOCKET CONNECTED TO THE LISTENER OF CAR ID,
+# wrap(SOCK, SIDE) WRAPS EVERY NEW LINK (E.G. metrics.MeteredSocket)
+#-----------------------------------------------------------------------------
+class Links:
+    def __init__(self, carid, listener, connect, wrap=None, front=None, frontID=0, back=None, backID=0):
+        self.carid = carid
+        self.listener = listener                # MY LISTENING SOCKET, NEW BACK CARS CONNECT HERE
+        self.connect = connect
+        self.wrap = wrap or (lambda sock, side: sock)
+        self.front = front                      # LINK TO THE CAR IN FRONT
+        self.frontID = frontID
+        self.back = back                        # LINK TO THE CAR BEHIND
+        self.backID = backID
+        self.pending = {}                       # CAR ID -> ACCEPTED CONNECTION NOT LINKED YET
+        self.changed = Condition()              # NOTIFIED WHEN A LINK OR pending CHANGES
+        self.commands = queue.SimpleQueue()     # (FRONT ID, BACK ID) OF EVERY MSG_REWIRE, IN ORDER
+        self.closed = False
+        self.left = False                       # SET WHEN THIS CAR LEFT THE PLATOON (MSG_LEAVE)
+        self.rewires = metrics.counter("rewires", car=carid)
+
+    #-------------------------------------------------------------------------
+    # START ACCEPTING NEW BACK CARS AND APPLYING REWIRES
+    #-------------------------------------------------------------------------
+    def start(self):
+        Thread(target=self.accept_loop, name="accept peers", daemon=True).start()
+        Thread(target=self.rewire_loop, name="rewire peers", daemon=True).start()
+
+    #-------------------------------------------------------------------------
+    # NEW NEIGHBOURS FROM THE SERVER, CALLED FROM ANY THREAD
+    #-------------------------------------------------------------------------
+    def post(self, frontID, backID):
+        self.commands.put((frontID, backID))
+
+    #-------------------------------------------------------------------------
+    # CURRENT LINK ON side ("front" OR "back") ONCE IT IS NOT sock ANY MORE, OR
+    # sock AFTER timeout SECONDS (NOT REPLACED)
+    #-------------------------------------------------------------------------
+    def wait(self, side, sock, timeout=REWIRETIMEOUT):
+        with self.changed:
+            self.changed.wait_for(lambda: getattr(self, side) is not sock or self.closed, timeout)
+            return getattr(self, side)
+
+    #-------------------------------------------------------------------------
+    # CLOSE BOTH LINKS AND STOP LISTENING, WAKES EVERY THREAD WAITING ON A LINK
+    #-------------------------------------------------------------------------
+    def close(self):
+        with self.changed:
+            self.closed = True
+            socks = [self.front, self.back] + list(self.pending.values())
+            self.changed.notify_all()
+        self.commands.put(None)
+        shut(self.listener)
+        for sock in socks:
+            if sock is not None:
+                shut(sock)
+
+    #-------------------------------------------------------------------------
+    # ACCEPT CARS CONNECTING BEHIND ME, KEPT BY THEIR ID UNTIL A REWIRE LINKS ONE
+    #-------------------------------------------------------------------------
+    def accept_loop(self):
+        while not self.closed:
+            try:
+                sock, addr = self.listener.accept()
+                sock.settimeout(REWIRETIMEOUT)
+                msg = protocol.recvmsg(sock)
+                sock.settimeout(None)
+            except OSError:
+                if self.closed:
+                    break
+                continue
+            if msg is None or msg.type != protocol.MSG_ATTACH:
+                sock.close()
+                continue
+            with self.changed:
+                old = self.pending.pop(msg.carid, None)
+                self.pending[msg.carid] = sock
+                self.changed.notify_all()
+            if old is not None:
+                old.close()
+
+    #-------------------------------------------------------------------------
+    # APPLY REWIRES ONE AT A TIME, CONNECTING AND WAITING FOR CARS DOES NOT BLOCK THE SERVER SOCKET
+    #-------------------------------------------------------------------------
+    def rewire_loop(self):
+        while True:
+            command = self.commands.get()
+            if command is None or self.closed:
+                break
+            self.rewire(*command)
+
+    #-------------------------------------------------------------------------
+    # LINK TO NEW FRONT AND BACK CARS, A LINK THAT DID NOT CHANGE IS KEPT
+    #-------------------------------------------------------------------------
+    def rewire(self, frontID, backID):
+        if frontID != self.frontID:
+            sock = None
+            if frontID:
+                try:
+                    sock = self.connect(frontID)
+                    sock.sendall(protocol.pack(protocol.MSG_ATTACH, self.carid))
+                    sock = self.wrap(sock, "front")
+                except OSError as e:
+                    print("Could not connect to client with id " + str(frontID) + ": " + str(e) + "\r")
+                    sock = None
+            self.replace("front", sock, frontID if sock is not None else 0)
+        if backID != self.backID:
+            sock = None
+            if backID:
+                with self.changed:
+                    self.changed.wait_for(lambda: backID in self.pending or self.closed, REWIRETIMEOUT)
+                    sock = self.pending.pop(backID, None)
+                if sock is None:
+                    print("Client with id " + str(backID) + " did not connect\r")
+                else:
+                    sock = self.wrap(sock, "back")
+            self.replace("back", sock, backID if sock is not None else 0)
+        self.rewires.inc()
+        print("SYSTEM: Rewired, front car " + str(self.frontID or "none") + ", back car " + str(self.backID or "none") + ".\r")
+
+    #-------------------------------------------------------------------------
+    # SWAP THE LINK ON side, THEN CLOSE THE OLD ONE (ITS READER SEES THE NEW ONE)
+    #-------------------------------------------------------------------------
+    def replace(self, side, sock, carid):
+        with self.changed:
+            if self.closed:
+                old = sock
+            else:
+                old = getattr(self, side)
+                setattr(self, side, sock)
+                setattr(self, side + "ID", carid)
+            self.changed.notify_all()
+        if old is not None:
+            shut(old)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary wire protocol for telemetry and control messages
+
+Every message is one frame: a 4 byte length prefix followed by a fixed
+layout body (message type, car ID, sequence number, position, speed,
+timestamp), all in network byte order. Used between client and server and
+between neighbour cars once the handshake is over. STOP and QUIT keep the car
+ID, sequence number and timestamp of the car where the event started on
+every hop, so copies of one event can be recognized (see broadcast.py).
+MSG_BATCH, sent by aggregators, appends one entry per car to that body.
+MSG_REWIRE carries the new neighbours of a car in its sequence number.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import struct, time, asyncio
+from collections import namedtuple
+
+#-----------------------------------------------------------------------------
+# MESSAGE TYPES
+MSG_POS = 1             # POSITION AND SPEED UPDATE
+MSG_ACC = 2             # ACCELERATE ('A')
+MSG_DEC = 3             # DECELERATE ('D')
+MSG_STOP = 4            # STOP ('S')
+MSG_QUIT = 5            # QUIT ('Q')
+MSG_ACK = 6             # ACKNOWLEDGEMENT FROM SERVER
+MSG_STREAM = 7          # POSITION AND SPEED UPDATE, ACKNOWLEDGED CUMULATIVELY
+MSG_BSTOP = 8           # STOP BROADCAST THROUGH THE SERVER TO EVERY CAR
+MSG_BQUIT = 9           # QUIT BROADCAST THROUGH THE SERVER TO EVERY CAR
+MSG_READY = 10          # CAR IS LISTENING FOR THE CAR BEHIND IT (CAR TO SERVER)
+MSG_GO = 11             # EVERY CAR IS LISTENING, CONNECT TO THE CAR IN FRONT (SERVER TO CARS)
+MSG_ATTACH = 12         # CAR REPORTS THROUGH THIS AGGREGATOR FROM NOW ON (CAR TO AGGREGATOR)
+MSG_DETACH = 13         # CAR REPORTS THROUGH AN AGGREGATOR, CLOSE MY CONNECTION (CAR TO SERVER)
+MSG_BATCH = 14          # LATEST UPDATE OF EVERY CAR OF A GROUP (AGGREGATOR TO SERVER, SEE pack_batch)
+MSG_REWIRE = 15         # NEW FRONT AND BACK CAR OF THE RECEIVING CAR (SERVER TO CAR, SEE pack_rewire)
+MSG_LEAVE = 16          # CAR LEAVES, THE REST OF THE PLATOON GOES ON WITHOUT IT (CAR TO SERVER)
+
+# HOP BY HOP EVENT -> BROADCAST OF THE SAME EVENT, AND BACK
+BROADCAST = {MSG_STOP: MSG_BSTOP, MSG_QUIT: MSG_BQUIT}
+UNBROADCAST = {MSG_BSTOP: MSG_STOP, MSG_BQUIT: MSG_QUIT}
+
+#-----------------------------------------------------------------------------
+# FRAME LAYOUT
+HEADER = struct.Struct("!I")            # LENGTH OF BODY
+BODY = struct.Struct("!BHIddd")         # TYPE, CAR ID, SEQ, POSITION, SPEED, TIMESTAMP
+FRAME = struct.Struct("!IBHIddd")       # HEADER AND BODY PACKED IN ONE CALL
+SEQMASK = 0xFFFFFFFF                    # SEQUENCE NUMBERS WRAP AT 32 BITS
+ENTRY = struct.Struct("!HIddd")         # ONE CAR IN A BATCH: CAR ID, SEQ, POSITION, SPEED, TIMESTAMP
+
+Message = namedtuple("Message", "type carid seq pos speed ts")
+Entry = namedtuple("Entry", "carid seq pos speed ts")
+
+#-----------------------------------------------------------------------------
+# Function to pack one message into a frame
+#-----------------------------------------------------------------------------
+def pack(msgtype, carid=0, seq=0, pos=0.0, speed=0.0, ts=None):
+    if ts is None:
+        ts = time.time()
+    return FRAME.pack(BODY.size, msgtype, carid, seq & SEQMASK, pos, speed, ts)
+
+#-----------------------------------------------------------------------------
+# Function to unpack the body of a frame into a message
+#-----------------------------------------------------------------------------
+def unpack(body):
+    return Message._make(BODY.unpack(body))
+
+#-----------------------------------------------------------------------------
+# Function to pack updates of several cars into one MSG_BATCH frame: a normal
+# body (car ID is the group) followed by one ENTRY per car, the only frame
+# longer than FRAME
+#-----------------------------------------------------------------------------
+def pack_batch(group, seq, entries, ts=None):
+    if ts is None:
+        ts = time.time()
+    body = BODY.pack(MSG_BATCH, group, seq & SEQMASK, 0.0, 0.0, ts)
+    body += b"".join(ENTRY.pack(*entry) for entry in entries)
+    return HEADER.pack(len(body)) + body
+
+#-----------------------------------------------------------------------------
+# Function to unpack the body of a MSG_BATCH frame, returns the message and its entries
+#-----------------------------------------------------------------------------
+def unpack_batch(body):
+    return Message._make(BODY.unpack_from(body)), [Entry._make(e) for e in ENTRY.iter_unpack(body[BODY.size:])]
+
+#-----------------------------------------------------------------------------
+# Function to pack the new front and back car of carid into a MSG_REWIRE frame,
+# both IDs fit in the sequence number (0 = NO CAR)
+#-----------------------------------------------------------------------------
+def pack_rewire(carid, front, back, ts=None):
+    return pack(MSG_REWIRE, carid, front << 16 | back, ts=ts)
+
+#-----------------------------------------------------------------------------
+# Function to get (FRONT ID, BACK ID) from a MSG_REWIRE message
+#-----------------------------------------------------------------------------
+def rewire_links(msg):
+    return msg.seq >> 16, msg.seq & 0xFFFF
+
+#-----------------------------------------------------------------------------
+# Function to receive exactly size bytes, returns None if connection closed
+#-----------------------------------------------------------------------------
+def recvall(sock, size):
+    data = sock.recv(size)
+    if len(data) == size or not data:
+        return data or None
+    buf = bytearray(data)
+    while len(buf) < size:
+        data = sock.recv(size - len(buf))
+        if not data:
+            return None
+        buf += data
+    return bytes(buf)
+
+#-----------------------------------------------------------------------------
+# Function to receive one message, returns None if connection closed
+#-----------------------------------------------------------------------------
+def recvmsg(sock):
+    header = recvall(sock, HEADER.size)
+    if header is None:
+        return None
+    body = recvall(sock, HEADER.unpack(header)[0])
+    if body is None:
+        return None
+    return unpack(body)
+
+#-----------------------------------------------------------------------------
+# Function to send one message
+#-----------------------------------------------------------------------------
+def sendmsg(sock, msgtype, carid=0, seq=0, pos=0.0, speed=0.0, ts=None):
+    sock.sendall(pack(msgtype, carid, seq, pos, speed, ts))
+
+#-----------------------------------------------------------------------------
+# Function to read one message from an asyncio stream, returns None if closed
+#-----------------------------------------------------------------------------
+async def readmsg(reader):
+    body = await readbody(reader)
+    if body is None:
+        return None
+    return unpack(body)
+
+#-----------------------------------------------------------------------------
+# Function to read the body of one frame of any length (e.g. MSG_BATCH), returns None if closed
+#-----------------------------------------------------------------------------
+async def readbody(reader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+        return await reader.readexactly(HEADER.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
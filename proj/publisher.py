@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rate-controlled position publisher
+
+Publishes only the latest position of a car to the car behind. The caller
+offers a value once per tick. The car behind dead reckons this car between
+updates (carstate.predict from the last position and speed sent), so the
+publisher runs the same prediction and sends a correction only when the real
+position is more than a threshold away from it (a speed change shows up as a
+growing error) or when a heartbeat interval passed, and only when the socket
+can take it without blocking. A value that cannot be sent is dropped, the
+next tick offers a newer one, so the follower never works through a queue of
+stale positions.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import select, time
+import protocol
+from carstate import predict
+
+#-----------------------------------------------------------------------------
+# Latest-value publisher for one socket
+#-----------------------------------------------------------------------------
+class Publisher:
+    def __init__(self, sock, threshold=0.1, heartbeat=1.0, posrate=10.0):
+        self.sock = sock
+        self.threshold = threshold          # MAX ERROR OF THE PREDICTION OF THE CAR BEHIND
+        self.heartbeat = heartbeat          # MAX SECONDS BETWEEN SENDS
+        self.posrate = posrate              # POSITION UNITS PER SECOND AT SPEED 1.0, SAME ON EVERY CAR
+        self.lastpos = None                 # LAST POSITION SENT
+        self.lastspeed = 0                  # LAST SPEED SENT
+        self.lastsend = 0                   # TIME OF LAST SEND
+        self.seq = 0                        # SEQUENCE NUMBER OF LAST UPDATE SENT ON THIS LINK
+        self.sent = 0                       # UPDATES SENT
+        self.suppressed = 0                 # UPDATES SKIPPED, PREDICTION WAS CLOSE ENOUGH
+        self.dropped = 0                    # UPDATES DROPPED, SOCKET WAS NOT WRITABLE
+
+    #-------------------------------------------------------------------------
+    # OFFER THE LATEST STATE, RETURNS TRUE IF IT WAS SENT
+    #-------------------------------------------------------------------------
+    def offer(self, carid, pos, speed):
+        now = time.monotonic()
+        if self.lastpos is not None and now - self.lastsend < self.heartbeat:
+            # WHERE THE CAR BEHIND BELIEVES I AM
+            predicted = predict(self.lastpos, self.lastspeed, now - self.lastsend, self.posrate)
+            if abs(pos - predicted) < self.threshold:
+                self.suppressed += 1
+                return False
+        # BACKPRESSURE: IF SOCKET BUFFER IS FULL, DROP THIS UPDATE INSTEAD OF QUEUEING IT
+        writable = select.select([], [self.sock], [], 0)[1]
+        if not writable:
+            self.dropped += 1
+            return False
+        self.seq += 1
+        self.sock.sendall(protocol.pack(protocol.MSG_POS, carid, self.seq, pos, speed))
+        self.lastpos = pos
+        self.lastspeed = speed
+        self.lastsend = now
+        self.sent += 1
+        return True
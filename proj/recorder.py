@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary trace recorder
+
+Timestamped snapshots (time, position, speed and headway of every car) are
+copied into a preallocated ring of chunks. Full chunks are written by a
+background thread as consecutive .npy arrays, one file per column, so the
+recording thread never waits on disk. If the writer falls behind and the
+ring is full, snapshots are dropped and counted instead of blocking.
+Columns are kept by car ID, the columns of a car that left the platoon are NaN.
+
+Convert a recording to the old text format (one line per frame):
+    python3 recorder.py PREFIX
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import sys, queue
+from threading import Thread
+import numpy as np
+
+COLUMNS = ("time", "position", "speed", "headway")     # ONE FILE PER COLUMN
+TEXTFILES = {"position": "positionFile.txt", "speed": "speedFile.txt", "headway": "headwayFile.txt"}
+
+#-----------------------------------------------------------------------------
+# Recorder writing PREFIX + COLUMN + ".npy"
+#-----------------------------------------------------------------------------
+class Recorder:
+    def __init__(self, prefix, numcars, chunk=1024, nchunks=8):
+        self.prefix = prefix
+        self.numcars = numcars
+        self.chunk = chunk                              # SNAPSHOTS PER CHUNK
+        self.buffers = {
+            "time": np.empty((nchunks, chunk)),
+            "position": np.empty((nchunks, chunk, numcars)),
+            "speed": np.empty((nchunks, chunk, numcars)),
+            "headway": np.empty((nchunks, chunk, numcars)),
+        }
+        self.free = queue.Queue()                       # CHUNKS READY TO BE FILLED
+        self.full = queue.Queue()                       # CHUNKS WAITING TO BE WRITTEN
+        for c in range(nchunks):
+            self.free.put(c)
+        self.current = self.free.get()                  # CHUNK BEING FILLED
+        self.row = 0                                    # NEXT ROW IN CURRENT CHUNK
+        self.recorded = 0                               # SNAPSHOTS RECORDED
+        self.dropped = 0                                # SNAPSHOTS DROPPED, RING WAS FULL
+        self.files = {name: open(prefix + name + ".npy", "wb") for name in COLUMNS}
+        self.writer = Thread(target=self.write_chunks, name="recorder writer", daemon=True)
+        self.writer.start()
+
+    #-------------------------------------------------------------------------
+    # RECORD ONE SNAPSHOT, NEVER WAITS ON DISK
+    # IF slots IS GIVEN, VALUE i BELONGS TO CAR slots[i] + 1 AND THE OTHER CARS ARE NaN
+    #-------------------------------------------------------------------------
+    def record(self, t, position, speed, headway, slots=None):
+        if self.current is None:
+            try:
+                self.current = self.free.get_nowait()
+                self.row = 0
+            except queue.Empty:
+                self.dropped += 1
+                return
+        c, r = self.current, self.row
+        self.buffers["time"][c, r] = t
+        for name, values in (("position", position), ("speed", speed), ("headway", headway)):
+            row = self.buffers[name][c, r]
+            if slots is None:
+                row[:] = values
+            else:                                       # CARS THAT LEFT ARE NOT IN slots
+                row.fill(np.nan)
+                row[slots] = values
+        self.row += 1
+        self.recorded += 1
+        if self.row == self.chunk:
+            self.full.put((c, self.row))
+            self.current = None
+
+    #-------------------------------------------------------------------------
+    # FLUSH LAST PARTIAL CHUNK AND WAIT FOR WRITER
+    #-------------------------------------------------------------------------
+    def close(self):
+        if self.current is not None and self.row:
+            self.full.put((self.current, self.row))
+        self.current = None
+        self.full.put(None)
+        self.writer.join()
+        for f in self.files.values():
+            f.close()
+
+    #-------------------------------------------------------------------------
+    # BACKGROUND THREAD WRITING FULL CHUNKS
+    #-------------------------------------------------------------------------
+    def write_chunks(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                break
+            c, rows = item
+            for name in COLUMNS:
+                np.save(self.files[name], self.buffers[name][c, :rows])
+            self.free.put(c)
+
+#-----------------------------------------------------------------------------
+# Function to load one column of a recording as a single array
+#-----------------------------------------------------------------------------
+def load(prefix, name):
+    chunks = []
+    with open(prefix + name + ".npy", "rb") as f:
+        while True:
+            try:
+                chunks.append(np.load(f))
+            except (EOFError, ValueError):
+                break
+    if not chunks:
+        return np.empty((0,))
+    return np.concatenate(chunks)
+
+#-----------------------------------------------------------------------------
+# Function to convert a recording to the old text files
+#-----------------------------------------------------------------------------
+def convert(prefix):
+    for name, textfile in TEXTFILES.items():
+        data = load(prefix, name)
+        with open(prefix + textfile, "w") as f:
+            for row in data:
+                f.write("".join("%f " % value for value in row))
+                f.write("\n")
+
+#-----------------------------------------------------------------------------
+################################ MAIN FUNCTION ###############################
+if __name__ == "__main__":
+    convert(sys.argv[1])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Record and replay of simulation runs
+
+A client started with --record PREFIX writes PREFIX + "car" + ID + ".log":
+one JSON line with the seed and start state of the car, one line per
+command applied by its CarState (key events, control messages from other
+cars and the server, front car positions) with the tick it was applied
+before, and one line with the final state. Since commands and the seeded
+random factor are the only inputs of a car, replaying them gives the same
+run, without sockets, threads or waiting for the tick clock.
+
+    python3 replay.py PREFIX [--out OUTPREFIX] [--profile]
+
+Every car is replayed, checked against its final state and, with --out,
+all cars are written as a recording (see recorder.py), aligned by their
+start times. --profile prints the hottest functions of the replay.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import sys, json, glob, time, argparse
+import numpy as np
+from carstate import CarState, CMD_FRONTSTATE, HEADWAY_CRASH
+from recorder import COLUMNS
+
+#-----------------------------------------------------------------------------
+# Event log of one car, written by the thread owning its CarState
+#-----------------------------------------------------------------------------
+class EventLog:
+    def __init__(self, path, carid, pos, posrate, seed, dt):
+        self.file = open(path, "w")
+        header = {"car": carid, "pos": pos, "posrate": posrate, "seed": seed, "dt": dt, "start": time.time()}
+        self.file.write(json.dumps(header) + "\n")
+
+    #-------------------------------------------------------------------------
+    # ONE COMMAND APPLIED BEFORE TICK tick
+    #-------------------------------------------------------------------------
+    def write(self, tick, cmd, arg):
+        self.file.write(json.dumps([tick, cmd, arg]) + "\n")
+
+    #-------------------------------------------------------------------------
+    # FINAL STATE, CHECKED BY THE REPLAY
+    #-------------------------------------------------------------------------
+    def close(self, state):
+        end = {"ticks": state.ticks, "pos": state.pos, "speed": state.speed, "endgame": state.endgame}
+        self.file.write(json.dumps(end) + "\n")
+        self.file.close()
+
+#-----------------------------------------------------------------------------
+# Function to read a log, returns header, commands and final state (None if the run did not end)
+#-----------------------------------------------------------------------------
+def load(path):
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    header, end = lines[0], None
+    if isinstance(lines[-1], dict) and len(lines) > 1:
+        end = lines.pop()
+    commands = []
+    for tick, cmd, arg in lines[1:]:
+        if cmd == CMD_FRONTSTATE:           # JSON HAS NO TUPLES
+            arg = tuple(arg)
+        commands.append((tick, cmd, arg))
+    return header, commands, end
+
+#-----------------------------------------------------------------------------
+# Function to replay one car, same loop as the main thread of client.py
+# RETURNS POSITION AND SPEED AFTER EVERY TICK AND THE FINAL CarState
+#-----------------------------------------------------------------------------
+def replay_car(header, commands, end=None):
+    state = CarState(header["car"], header["pos"], header["posrate"], header["seed"])
+    dt = header["dt"]
+    maxticks = end["ticks"] if end is not None else (commands[-1][0] + 1 if commands else 0)
+    pos = np.empty(maxticks)
+    speed = np.empty(maxticks)
+    pending = iter(commands)
+    nextcmd = next(pending, None)
+    while state.ticks < maxticks:
+        # COMMANDS APPLIED BEFORE THIS TICK, IN THE ORDER THEY WERE APPLIED
+        while nextcmd is not None and nextcmd[0] == state.ticks:
+            state.apply(nextcmd[1], nextcmd[2])
+            nextcmd = next(pending, None)
+        snap = state.step(dt)
+        pos[state.ticks - 1] = snap.pos
+        speed[state.ticks - 1] = snap.speed
+        if snap.endgame:
+            break
+        if snap.headway == HEADWAY_CRASH:
+            state.finish()
+            break
+    return pos[:state.ticks], speed[:state.ticks], state
+
+#-----------------------------------------------------------------------------
+# Function to replay every car of a recording
+#-----------------------------------------------------------------------------
+def replay(prefix, outprefix=None):
+    paths = sorted(glob.glob(prefix + "car*.log"), key=lambda path: int(path[len(prefix) + 3:-4]))
+    if not paths:
+        print("SYSTEM: no logs found for prefix " + prefix)
+        return False
+    runs = []
+    identical = True
+    start = time.perf_counter()
+    for path in paths:
+        header, commands, end = load(path)
+        pos, speed, state = replay_car(header, commands, end)
+        runs.append((header, pos, speed))
+        if end is None:
+            result = "no final state (run did not end cleanly)"
+        elif (state.ticks, state.pos, state.speed, state.endgame) == (end["ticks"], end["pos"], end["speed"], end["endgame"]):
+            result = "identical"
+        else:
+            result = "DIFFERENT (recorded pos {}, replayed {})".format(end["pos"], state.pos)
+            identical = False
+        print("SYSTEM: car {}: {} commands, {} ticks, final position {:.3f}: {}".format(
+            header["car"], len(commands), state.ticks, state.pos, result))
+    elapsed = time.perf_counter() - start
+    simulated = sum(len(pos)*header["dt"] for header, pos, speed in runs)
+    print("SYSTEM: replayed {:.1f} car-seconds in {:.3f} s ({:.0f}x real time)".format(
+        simulated, elapsed, simulated/elapsed if elapsed else 0))
+    if outprefix:
+        write_recording(outprefix, runs)
+    return identical
+
+#-----------------------------------------------------------------------------
+# Function to write replayed cars as one recording, tick k of a car is its
+# start time plus k ticks; a car holds its start/final position outside its run
+#-----------------------------------------------------------------------------
+def write_recording(outprefix, runs):
+    runs = sorted(runs, key=lambda run: run[0]["car"])
+    dt = runs[0][0]["dt"]
+    t0 = min(header["start"] for header, pos, speed in runs)
+    offsets = [int(round((header["start"] - t0)/dt)) for header, pos, speed in runs]
+    numticks = max(offset + len(pos) for offset, (header, pos, speed) in zip(offsets, runs))
+    columns = {"time": t0 + dt*np.arange(numticks),
+               "position": np.empty((numticks, len(runs))),
+               "speed": np.zeros((numticks, len(runs))),
+               "headway": np.zeros((numticks, len(runs)))}
+    for i, (offset, (header, pos, speed)) in enumerate(zip(offsets, runs)):
+        columns["position"][:, i] = pos[-1] if len(pos) else header["pos"]
+        columns["position"][:offset, i] = header["pos"]
+        columns["position"][offset:offset + len(pos), i] = pos
+        columns["speed"][offset:offset + len(pos), i] = speed
+    columns["headway"][:, 1:] = columns["position"][:, :-1] - columns["position"][:, 1:]
+    # SAME FILES AS recorder.Recorder, WRITTEN AT ONCE (NOTHING TO KEEP UP WITH OFFLINE)
+    for name in COLUMNS:
+        with open(outprefix + name + ".npy", "wb") as f:
+            np.save(f, columns[name])
+    print("SYSTEM: {} snapshots written to {}*.npy".format(numticks, outprefix))
+
+#-----------------------------------------------------------------------------
+################################ MAIN FUNCTION ###############################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a platoon run recorded with client.py --record")
+    parser.add_argument("prefix", help="prefix given to --record")
+    parser.add_argument("--out", help="write the replayed run as a recording with this prefix")
+    parser.add_argument("--profile", action="store_true", help="print the hottest functions of the replay")
+    args = parser.parse_args()
+    if args.profile:
+        import cProfile, pstats
+        profiler = cProfile.Profile()
+        identical = profiler.runcall(replay, args.prefix, args.out)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+    else:
+        identical = replay(args.prefix, args.out)
+    sys.exit(0 if identical else 1)
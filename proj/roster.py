@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ordered roster of a platoon
+
+Cars of a platoon ordered by position, front car first, kept by the ingest
+server from the position updates it receives. Neighbours of a car are the
+cars before and after it in this order, not ID - 1 and ID + 1, so a car can
+leave (or cars can pass each other) without restarting the platoon: every
+change returns the cars whose neighbours changed, which the server tells to
+rewire their links (MSG_REWIRE, see peers.py).
+
+The order is a skip list of (-position, car ID) keys with one node per car,
+looked up by ID. The neighbours of a car are the nodes next to it on the
+bottom level, so an update that keeps a car between its neighbours, almost
+every update, only replaces its key. A change of order (or a car leaving)
+unlinks the node and links it in again, O(log n) expected.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import random
+from threading import Lock
+
+MAXLEVEL = 32           # LEVELS OF THE SKIP LIST, ENOUGH FOR 2**32 CARS
+
+#-----------------------------------------------------------------------------
+# One car in the skip list
+#-----------------------------------------------------------------------------
+class Node:
+    __slots__ = ("key", "next", "prev")
+
+    def __init__(self, key, level):
+        self.key = key                          # (-POSITION, CAR ID)
+        self.next = [None]*level                # NEXT NODE ON EVERY LEVEL OF THIS NODE
+        self.prev = None                        # PREVIOUS NODE ON THE BOTTOM LEVEL (head FOR THE FRONT CAR)
+
+#-----------------------------------------------------------------------------
+# Roster of one platoon, neighbour IDs are 0 if there is none
+#-----------------------------------------------------------------------------
+class Roster:
+    def __init__(self, positions=None, seed=0):
+        self.head = Node(None, MAXLEVEL)        # BEFORE THE FRONT CAR ON EVERY LEVEL
+        self.level = 1                          # LEVELS IN USE
+        self.nodes = {}                         # CAR ID -> NODE
+        self.rng = random.Random(seed)          # LEVELS OF NEW NODES
+        self.lock = Lock()                      # ORDER CHANGES AGAINST order() FROM ANOTHER THREAD
+        for carid, pos in (positions or {}).items():
+            self.link(Node((-pos, carid), self.random_level()))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    #-------------------------------------------------------------------------
+    # CAR IDS FROM FRONT TO BACK
+    #-------------------------------------------------------------------------
+    def order(self):
+        order = []
+        with self.lock:
+            node = self.head.next[0]
+            while node is not None:
+                order.append(node.key[1])
+                node = node.next[0]
+        return order
+
+    #-------------------------------------------------------------------------
+    # (FRONT, BACK) NEIGHBOUR OF A CAR
+    #-------------------------------------------------------------------------
+    def neighbours(self, carid):
+        node = self.nodes[carid]
+        front = node.prev.key[1] if node.prev is not self.head else 0
+        back = node.next[0].key[1] if node.next[0] is not None else 0
+        return front, back
+
+    #-------------------------------------------------------------------------
+    # NEW POSITION OF A CAR, RETURNS {CAR ID: (FRONT, BACK)} OF CARS WHOSE NEIGHBOURS CHANGED
+    #-------------------------------------------------------------------------
+    def update(self, carid, pos):
+        node = self.nodes.get(carid)
+        if node is None:                        # CAR LEFT, A LATE UPDATE DOES NOT BRING IT BACK
+            return {}
+        key = (-pos, carid)
+        # STILL BETWEEN ITS NEIGHBOURS: SAME ORDER, REPLACE THE KEY IN PLACE
+        if (node.prev is self.head or node.prev.key < key) and (node.next[0] is None or key < node.next[0].key):
+            node.key = key
+            return {}
+        before = {c: self.neighbours(c) for c in self.around(node)}
+        with self.lock:
+            self.unlink(node)
+            node.key = key
+            self.link(node)
+        return self.changes(set(before) | self.around(node), before)
+
+    #-------------------------------------------------------------------------
+    # CAR LEAVES THE PLATOON, ITS FRONT AND BACK CAR BECOME NEIGHBOURS
+    #-------------------------------------------------------------------------
+    def remove(self, carid):
+        node = self.nodes.get(carid)
+        if node is None:
+            return {}
+        affected = self.around(node) - {carid}
+        before = {c: self.neighbours(c) for c in affected}
+        with self.lock:
+            self.unlink(node)
+            del self.nodes[carid]
+        return self.changes(affected, before)
+
+    #-------------------------------------------------------------------------
+    # IDS OF THE CAR OF node AND OF THE CARS NEXT TO IT
+    #-------------------------------------------------------------------------
+    def around(self, node):
+        cars = {node.key[1]}
+        if node.prev is not self.head:
+            cars.add(node.prev.key[1])
+        if node.next[0] is not None:
+            cars.add(node.next[0].key[1])
+        return cars
+
+    #-------------------------------------------------------------------------
+    # NEIGHBOURS OF affected CARS AFTER A CHANGE, ONLY THOSE DIFFERENT FROM before
+    #-------------------------------------------------------------------------
+    def changes(self, affected, before):
+        after = {c: self.neighbours(c) for c in affected}
+        return {c: n for c, n in after.items() if before.get(c) != n}
+
+    #-------------------------------------------------------------------------
+    # LAST NODE BEFORE key ON EVERY LEVEL, O(log n) EXPECTED
+    #-------------------------------------------------------------------------
+    def path(self, key):
+        path = [self.head]*MAXLEVEL
+        node = self.head
+        for i in range(self.level - 1, -1, -1):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            path[i] = node
+        return path
+
+    #-------------------------------------------------------------------------
+    # LINK node IN AT ITS KEY
+    #-------------------------------------------------------------------------
+    def link(self, node):
+        path = self.path(node.key)
+        for i in range(len(node.next)):
+            node.next[i] = path[i].next[i]
+            path[i].next[i] = node
+        node.prev = path[0]
+        if node.next[0] is not None:
+            node.next[0].prev = node
+        self.level = max(self.level, len(node.next))
+        self.nodes[node.key[1]] = node
+
+    #-------------------------------------------------------------------------
+    # UNLINK node FROM EVERY LEVEL IT IS ON
+    #-------------------------------------------------------------------------
+    def unlink(self, node):
+        path = self.path(node.key)
+        for i in range(len(node.next)):
+            path[i].next[i] = node.next[i]
+        if node.next[0] is not None:
+            node.next[0].prev = node.prev
+        while self.level > 1 and self.head.next[self.level - 1] is None:
+            self.level -= 1
+
+    #-------------------------------------------------------------------------
+    # LEVEL OF A NEW NODE, EVERY LEVEL HOLDS HALF THE NODES OF THE ONE BELOW
+    #-------------------------------------------------------------------------
+    def random_level(self):
+        level = 1
+        while level < MAXLEVEL and self.rng.random() < 0.5:
+            level += 1
+        return level
@@ -9,7 +9,16 @@ Readme as follows:
     ---------------------------------------Sets Up Simulation---------------------------------------
     1. place car2.png, client.py, server.py under current directory
     2. run following command to set up server connection 
-        python3 server.py
+        python3 server.py [--headless] [--transport tcp|unix] [--shm] [--stats SEC] [--metrics-port PORT] [--expect N]
+    * Note: --headless records the simulation without pygame or a display
+    * Note: --transport unix uses Unix domain sockets (server and all clients on one machine, same option on clients)
+    * Note: --shm lets clients on the server machine publish positions through shared memory (same option on clients)
+    * Note: --stats SEC prints metrics (messages, bytes, latencies, frame time, ingest backlog) every SEC seconds,
+      --metrics-port PORT serves them on http://127.0.0.1:PORT/metrics (clients take the same options, client port is PORT + ID)
+    * Note: python3 local.py N runs the server and N clients in one process (see local.py)
+    * Note: --expect N admits the first N cars without 'c' and runs their handshakes in parallel, 's' starts once all N joined
+    * Note: --platoon K serves platoon K on its own port (cars take the same option), python3 shard.py P runs P platoons in P processes
+    * Note: cars started with --group G report through aggregator.py G (one server connection per group, see aggregator.py)
     * Note: server must be established in order to accept any client connection
     3. run following command to set up client connection
         python3 client.py NAMEOFSERVERMACHINE <default to PSU SUN lab machines>
@@ -18,148 +27,120 @@ Readme as follows:
         - press 'c' or 'C' to add one more client
         - press 's' or 'S' to start simulation (no more client accepted from this point)
     * Note: clients and server may ssh into any machines in SUN lab
-    * Note: maximum number of cars is 9
+    * Note: maximum number of cars is set by maxclients in client.py (default 500, at most 899: higher car ports belong to aggregators)
     ---------------------------------------Simulation Began---------------------------------------
     4. Each client has following functionalities
         - press 'd' or 'D' to accelerate
         - press 'a' or 'A' to decelerate
         - press 's' or 'S' to stop
         - press 'q' or 'Q' to quit
+        - press 'l' or 'L' to leave the platoon (the other cars go on, see note below)
     * Note: acceleration and deceleration of non-lead car may not affect the speed of platoon due to conflicts (front car priority)
     * Note: maximum speed of platoon is 1.1
     * Note: all failures handled properly (quit or failure of one or more client immediately stop and quits entire system)
+    * Note: stop and quit reach every car through the server (broadcast) and hop by hop, the first copy to arrive is applied
+    * Note: a car that leaves ends its simulation, its front and back car link to each other without restarting the platoon
+      (if the lead car leaves, the car behind it becomes the lead car), cars that left are NaN in the records
     * Note: no action is taken from server side but only visualization
-    * Note: when all program exits, server outputs 3 records (speed, position, headways) of simulation into text files
+    * Note: when all program exits, server outputs 4 records (time, speed, position, headways) of simulation into .npy files
+      (run python3 recorder.py demo1_ to convert them to the old text files)
 """
 #-----------------------------------------------------------------------------
 # IMPORT PACKAGES
-import socket, sys, json, pygame, time, os, errno
-from threading import Thread, Lock
-
-#-----------------------------------------------------------------------------
-# DECLARE GLOBAL VARIABLES
-clientList = {}         # LIST TO MAINTAIN CLIENT ADDRESSES
-clientSockList = {}     # LIST TO MAINTAIN CLIENT SOCKETS
-dataList = {}           # LIST TO MAINTAIN POSITION INFORMATION OF CLIENTS
-lock = Lock()           # INITIALIZE LOCK VARIABLE
-prev = 0                # VARIABLE TO REFERENCE POSITION OF LEAD CAR
-                        # FOR MAINTAINING PLATOON ON THE SCREEN
-speed = {}              # LIST TO MAINTAIN SPEED INFORMATION OF CLIENTS
-simulationExit = False  # BOOL VARIABLE TO CHECK IF SIMULATION IF RUNNING
+import socket, sys, os, time, argparse
+import numpy as np
+import transport, metrics
+from ingest import IngestServer
+from recorder import Recorder
+from simclock import SimClock
+import layout
+try:                                            # PYGAME IS ONLY NEEDED FOR THE VIEWER
+    import pygame
+except ImportError:
+    pygame = None
 
 ############################ FUNCTION DEFINITIONS ############################
 
 #-----------------------------------------------------------------------------
 # Function to start server
 #-----------------------------------------------------------------------------
-def initialize():
+def initialize(args):
     os.system('clear')
-    server_connect()
+    if args.stats:
+        metrics.registry.start_dump(args.stats)
+    if args.metrics_port:
+        metrics.registry.serve(args.metrics_port)
+    server_connect(args)
 
 #-----------------------------------------------------------------------------
 # Function to accept client connections and start pygame simulation
 #-----------------------------------------------------------------------------
-def server_connect():
+def server_connect(args):
     local_hostname = socket.gethostname()       # GET LOCAL HOST NAME
     host = socket.gethostbyname(local_hostname) # TRANSLATE HOST NAME
-    port = 6789                                 # DEFINE PORT NUMBER
-    sockfd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)      # CREATE SERVER SOCKET
-    sockfd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    # SO_REUSEADDR flag tells the kernel to reuse a local socket in TIME_WAIT
-    # state, without waiting for its natural timeout to expire
+    port = transport.platoon_port(args.platoon) # DEFINE PORT NUMBER
+    # ALL CLIENT CONNECTIONS ARE HANDLED BY ONE EVENT LOOP
+    ingest = IngestServer(host, port, link=transport.get(args.transport), shared=args.shm, expect=args.expect)
     try:
-        sockfd.bind((host, port))               # TRY TO BIND SOCKET
+        ingest.start()                          # TRY TO BIND SOCKET AND START EVENT LOOP THREAD
     except:
         print("Bind failed. Error : " + str(sys.exc_info()))
         sys.exit()
 
-    print("SYSTEM: Server is ready to accept connections.")
-    sockfd.listen(10)                           # BACKLOG IS 10
-    clientID = 0                                # ASSIGN CLIENT ID TO ACCEPT CONNECTIONS
-    
-    leadConn, leadAdd = sockfd.accept()         # ACCEPT FIRST CLIENT
-    clientID += 1                               # ASSIGN CLIENT ID
-    print("SYSTEM: Connection received from CLIENT " + str(clientID) + " with address " + str(leadAdd[0]) + ":" + str(leadAdd[1]))
-    add_client_to_list(leadConn, clientID, leadAdd)     # ADDING CLIENT INFORMATION TO A LSIT
-    recvOpt = leadConn.recv(1).decode("utf-8")          
-    if recvOpt == "0":
-        send_client_ID(leadConn, clientID)              # CALL FUNCTION TO SEND FIRST CLIENT ITS ID
-
-    while True:
-        menu = leadConn.recv(1).decode("utf-8")         # CHECK WHETHER TO ACCEPT MORE CLIENT CONNECTIONS
-        if menu == "c":
-            clientConn, clientAdd = sockfd.accept()     # ACCEPT ADDITIONAL CLIENT CONNECTIONS
-            clientID += 1                               # ASSIGN CLIENT ID
-            add_client_to_list(clientConn, clientID, clientAdd)     # ADD CLIENT INFORMATION TO LIST
-            clientIP = str(clientAdd[0])                # GET CLIENT IP
-            clientPort = str(clientAdd[1])              # GET CLIENT PORT
-            print("SYSTEM: Connection received from CLIENT " + str(clientID) + " with address " + clientIP + ":" + clientPort)
-            recvOpt = clientConn.recv(1).decode("utf-8")    # RECEIVE CLIENT REQUEST TO SEND ID
-            if recvOpt == "0":
-                send_client_ID(clientConn, clientID)        # CALL FUNCTION TO SEND CLIENT ID
-        elif menu == "s":                                   # CHECK IF FIRST CLIENT WANTS TO CHECK SIMULATION
-            print("SYSTEM: Sending client list to all clients.")
-            send_client_list(clientList, clientSockList)    # SEND CLIENT INFORMATION LIST TO ALL CLIENTS
-            break
-        
-    start_simulation(clientList, clientSockList)            # CALL FUNCTION START SIMULATION
-
-    sockfd.close()                                          # CLOSE SOCKET CONNECTION ONCE SIMULATION EXITS
-    
-            
-#-----------------------------------------------------------------------------
-# Function to send client ID when appropriate request is received
-#-----------------------------------------------------------------------------
-def send_client_ID(clientConn, clientID):
-    clientConn.sendall(str(clientID).encode("utf-8"))
+    ingest.started.wait()                       # WAIT UNTIL LEAD CAR STARTS THE SIMULATION
+    if args.headless:
+        run_headless(ingest)                    # RECORD WITHOUT A DISPLAY
+    else:
+        start_simulation(ingest)                # CALL FUNCTION START SIMULATION
+    ingest.stop()                               # CLOSE CONNECTIONS ONCE SIMULATION EXITS
     
 #-----------------------------------------------------------------------------
-# Function to add a client connection and information to list
+# Function to return the snapshot indices (ID - 1) of the cars still in the platoon, front car first
 #-----------------------------------------------------------------------------
-def add_client_to_list(clientConn, clientID, clientAdd):
-    global clientList, clientSockList       # REFERENCING GLOBAL VARIABLES
-    # USE OF LOCKS TO ENSURE CONCURRENCY
-    lock.acquire()
-    clientList[clientID] = clientAdd        # ADDING CLIENT ADDRESS TO LIST
-    clientSockList[clientID] = clientConn   # ADDING CLIENT SOCKET TO LIST
-    lock.release()
+def platoon_slots(ingest):
+    if ingest.roster is None:                   # NOT STARTED, ALL CARS BY ID
+        return None
+    return np.array(ingest.roster.order(), dtype=int) - 1
 
-#-----------------------------------------------------------------------------    
-# Function to send cliend list when appropriate request is received
 #-----------------------------------------------------------------------------
-def send_client_list(clientList, clientSockList):
-    jsonList = json.dumps(clientList)       # PACK CLIENT LIST TO STRING BEFORE SENDING
-    for client in clientSockList:           # SENDING PACKED LIST TO ALL CLIENTS
-        clientSockList[client].sendall(str(jsonList).encode("utf-8"))
+# Function to run simulation without pygame, records every round of updates
+#-----------------------------------------------------------------------------
+def run_headless(ingest, fileprefix="demo1_"):
+    store = ingest.store                        # STATE IS OWNED BY THE INGEST SERVER
+    print("\nSYSTEM: STARTING THE PLATOON SIMULATION (HEADLESS).")
+    recorder = Recorder(fileprefix, len(ingest.clientList))
+    clock = SimClock(100)                       # SAMPLE RATE IF CARS WRITE SHARED MEMORY
+    frameMetrics = FrameMetrics(ingest, recorder, "headless")
+    
+    while not ingest.simulationExit:
+        # CARS IN SHARED MEMORY SEND NO UPDATES, SAMPLE THEM AT A FIXED RATE
+        if ingest.shared:
+            clock.tick()
+        # ELSE WAIT FOR NEW UPDATES FROM INGEST, NOT PACED BY A FRAME RATE
+        elif not ingest.updated.wait(0.5):
+            continue
+        ingest.updated.clear()
+        frameStart = time.perf_counter()
+        snap = store.snapshot()
+        frame = layout.compute(snap["pos"], snap["speed"], 0, platoon_slots(ingest))
+        recorder.record(time.time(), frame.position, frame.speed, frame.headway, frame.slots)
+        frameMetrics.observe(frameStart)
+    
+    recorder.close()                            # WRITE REMAINING SNAPSHOTS TO DISK
+    print("SYSTEM: {} snapshots recorded, {} dropped.".format(recorder.recorded, recorder.dropped))
 
 #-----------------------------------------------------------------------------
 # Function to start pygame simulation
+# IF frametimes IS A LIST, THE TIME SPENT ON EVERY FRAME (WITHOUT WAITING FOR THE FRAME RATE) IS APPENDED
 #-----------------------------------------------------------------------------
-def start_simulation(clientList, clientSockList, BUFSIZE = 4096):
-    global dataList, lock, prev, speed, simulationExit      # REFERENCING GLOBAL VARIABLES
+def start_simulation(ingest, fileprefix="demo1_", frametimes=None):
+    clientList = ingest.clientList              # STATE IS OWNED BY THE INGEST SERVER
+    store = ingest.store
     print("\nSYSTEM: STARTING THE PLATOON SIMULATION.")
-    # CODE TO ADD RECEIVED INFORMATION TO TEXT FILE FOR VISUALIZATION PURPOSE
-    fileprefix = "demo1_"
-    positionFile = open(fileprefix + "positionFile.txt", "w")
-    headwayFile = open(fileprefix + "headwayFile.txt", "w")
-    speedFile = open(fileprefix + "speedFile.txt", "w")
-    
-    # CALCULATE START POSITION OF ALL CARS BASED ON NUMEBR OF CLIENTS
-    start_x = list(range(1,len(clientList)+1))
-    start_x = [item*150 - 50 for item in start_x]
-    start_x.reverse()
+    # RECORD RECEIVED INFORMATION FOR VISUALIZATION PURPOSE (CONVERT TO TEXT WITH recorder.py)
+    recorder = Recorder(fileprefix, len(clientList))
     
-    # Send initial positions to all clients
-    for key, value in clientSockList.items():           # LOOP TO SEND START POSITION TO ALL CLIENTS
-        try:
-            qqq = value.recv(BUFSIZE).decode("utf-8")   # RECEIVE REQUEST FROM CLIENT TO SEND START POSITION
-            if qqq == "xpos":
-                value.sendall(str(start_x[key-1]).encode("utf-8"))  # SENDING START POSITION
-            else:
-                print(key, qqq)                         # ELSE BLOCK JUST TO CHECK IF SERVER RECEIVED CORRECT REQUEST
-        except:
-            print("Could not send the position to client")
-            sys.exit()
+    start_x = ingest.start_x                    # START POSITION OF ALL CARS
             
     pygame.init()                                   # INITIALIZE PYGAME WINDOW
     pygame.font.init()                              # INITIALIZE FONTS IN PYGAME WINDOW
@@ -188,6 +169,8 @@ def start_simulation(clientList, clientSockList, BUFSIZE = 4096):
     gameDisplay.fill(white)
     # INITIALIZE PYGAME CLOCK
     clock = pygame.time.Clock()
+    # PRE-RENDER STATIC ROAD/GROUND, TREE AND BUSH SPRITES AND LABEL TEXT ONCE
+    cache = RenderCache(font, white, display_width, display_height, black)
     
     treeSep = 240                                   # DEFINING TREE (GREEN CIRCLES) SEPARATION
     tree = [treeSep*(i+1) for i in range(display_width//treeSep)]   # CALCULATE INITIAL POSITION OF ALL TREES
@@ -197,22 +180,16 @@ def start_simulation(clientList, clientSockList, BUFSIZE = 4096):
     y1 = int(display_height/2 - 150)                # INITIALIZE POSITION FOR TREES AND BUSHES
     y2 = int(display_height/2 + 150)
     d = display_width*7/10                          # VARIABLE TO MAINTAIN PLATOON IN CENTRE OF SCREEN
+    frameMetrics = FrameMetrics(ingest, recorder, "pygame")
 
     startOfGame = True                              # VARIABLE TO CHECK IF SIMULATION IS RUNNING
-    threadList = []                                 # LIST TO MAINTAIN THREADS ON SERVER
-    threadName = "receive position thread "
-    for key, value in clientSockList.items():       # LOOP TO INITIALIZE ONE THREAD PER CLIENT
-        # APPEND THREADS TO THREAD LSIT AND SET DAEMON TO TRUE SO THREADS TERMINATE WHEN MAIN THREAD TERMINATES
-        threadList.append(Thread(target = receivePos, name = threadName + str(key),args = (value,key), daemon = True))
-        dataList[key-1] = ""
-    for i in range(len(clientList)):                # LOOP TO START ALL THREADS
-        threadList[i].start()
     
     while True:                                      # RUN SIMULATION FOREVER 
-        if simulationExit == True:                   # AND CHECK IF SIMULATION SHOULD QUIT
+        if ingest.simulationExit == True:                   # AND CHECK IF SIMULATION SHOULD QUIT
             break
+        frameStart = time.perf_counter()
         # CALL FUNCTION TO DRAW BACKGROUND OF SIMULATION WINDOW (DISPLAYS ROAD, TREES, BUSHES ETC)             
-        draw_background(gameDisplay, display_width, display_height, black, tree, bush, y1, y2)
+        draw_background(gameDisplay, cache, tree, bush, y1, y2)
         
         # DISPLAYING INITIAL POSITION OF ALL CARS
         if startOfGame == True:
@@ -223,8 +200,13 @@ def start_simulation(clientList, clientSockList, BUFSIZE = 4096):
             pygame.display.update()                     # UPDATE THE WHOLE SCREEN
             startOfGame = False
         
+        # ONE SNAPSHOT OF ALL CARS PER FRAME, CARS STILL IN THE PLATOON LAID OUT IN ITS ORDER
+        # ONCE FOR DRAWING AND RECORDING
+        snap = store.snapshot()
+        frame = layout.compute(snap["pos"], snap["speed"], d, platoon_slots(ingest))
+        
         # FUNCTION TO CALCULATE TREE SPEED BASED ON PLATOON SPEED
-        treeSpeed = calcTreeSpeed(speed)
+        treeSpeed = calcTreeSpeed(frame.speed)
         
         # LOOP TO MAKE SURE THAT TREES APPEAR AGAIN AT THE RIGHT END OF THE SCREEN ONCE THEY MOVE
         # OUT OF THE SCREEN FROM THE LEFT
@@ -243,42 +225,16 @@ def start_simulation(clientList, clientSockList, BUFSIZE = 4096):
             tree[i] -= treeSpeed
             bush[i] -= treeSpeed
             
-        # CONDITION TO CHECK IF PLATOON HAS REACHED A CERTAIN DISTANCE ON THE SCREEN OR WHETHER
-        if prev < d:    # IF POSITION OF FIRST CAR IS LESS THAN 'd' THEN DISPLAY USING THIS LOOP
-            for i in range(len(dataList)):
-                po = float(dataList[i])
-                carRect.center = (po, start_y)
-                gameDisplay.blit(carImg, carRect)
-        else:
-            # IF POSITION OF FIRST CAR IS GREATER THAN 'd' THEN DISPLAY USING THIS LOOP
-            for p in range(len(dataList)):
-                headway = []                    # LOCAL LIST TO CALCULATE HEADWAY OF CARS
-                headway.append(float(0))        # HEADWAY OF LEAD CAR IS 0.0
-                # LOOP TO CALCULATE HEADWAY OF NON-LEAD CARS BASED ON THE POSITIONS
-                # SAY POSITION OF CAR IS 2300. THE PLATOON NEEDS TO BE MAINTAINED WITH LEAD CAR
-                # AT POSITION OF 700. SO FIRST WE NEED TO CALCULATE HEADWAY AND THEN CALCULATE
-                # POSITION TO DISPLAY ON THE SCREEN
-                for o in range(len(dataList) - 1):  
-                    # APPEND HEADWAY TO LIST
-                    headway.append((float(dataList[o]) - float(dataList[o+1])))
-                xp = []
-                f = 0
-                # LOOP TO CALCULATE AT WHAT POSITION SHOULD THE PLATOON BE DISPLAYED
-                # THAT IS CALCULATE X COORDINATE TO DISPLAY PLATOON IN THE CENTRE
-                # OF THE SCREEN
-                for o in range(len(dataList)):
-                    # APPEND COORESPONSING POSITION
-                    f += headway[o]
-                    xp.append(f)            # APPEND HEADWAY TO LIST
-                # CALCULATE CENTRE OF CAR TO DISPLAY ON SCREEN
-                carRect.center = (d - xp[p], start_y)
-                # DRAW CAR IMGAE ON THE SCREEN
-                gameDisplay.blit(carImg, carRect)
+        # DRAW EVERY CAR AT ITS SCREEN POSITION (AT ITS POSITION UNTIL THE LEAD CAR REACHES 'd',
+        # THEN AT 'd' MINUS ITS DISTANCE BEHIND THE LEAD CAR TO KEEP THE PLATOON IN THE CENTRE)
+        for x in frame.screen_x:
+            carRect.center = (x, start_y)
+            gameDisplay.blit(carImg, carRect)
             
         # LOOP TO DISPLAY POSITION INFORMATION OF PLATOON AT THE TOP LEFT CORNER OF THE SCREEN
-        for i in range(len(speed)):
-            text = font.render("Position {}: ".format(i+1), True, white)
-            textSurf_pos = font.render(str(round(dataList[i])), True, white)
+        for i in range(len(frame.position)):
+            text = cache.label("Position {}: ".format(frame.slots[i]+1))
+            textSurf_pos = cache.value(("position", i), str(round(frame.position[i])))
             textRect_text = text.get_rect()
             textRect_pos = textSurf_pos.get_rect()
             textRect_text.center = (display_width/240 + 100, 25*(i+1))
@@ -286,22 +242,17 @@ def start_simulation(clientList, clientSockList, BUFSIZE = 4096):
             gameDisplay.blit(textSurf_pos, textRect_pos)
             gameDisplay.blit(text, textRect_text)
         
-        # DISPLAYING SPEED OF PLATOON AT CENTRE OF THE SCREEN
-        textSurf_speed = font.render("Platoon Speed: " + str(round(speed[0],1)), True, white)
+        # DISPLAYING SPEED OF PLATOON (ITS FRONT CAR) AT CENTRE OF THE SCREEN
+        leadSpeed = frame.speed[0] if len(frame.speed) else 0
+        textSurf_speed = cache.value("speed", "Platoon Speed: " + str(round(leadSpeed,1)))
         textRect_speed = textSurf_speed.get_rect()
         textRect_speed.center = (display_width/2 - 40, 25)
         gameDisplay.blit(textSurf_speed, textRect_speed)
         
-        headway = []                    # LOCAL LIST TO CALCULATE HEADWAY OF ALL CARS
-        headway.append(float(0))        # HEADWAY OF LEAD CAR IS 0
-        for o in range(len(dataList) - 1):
-            # CALCULATE HEADWAY OF NON-LEAD CARS BASED ON POSITION
-            headway.append((float(dataList[o]) - float(dataList[o+1])))
-        
         # LOOP TO DISPLAY HEADWAY OF ALL CARS AT THE TOP RIGHT CORNER OF THE SCREEN
-        for i in range(len(headway)):
-            headway_text = font.render("Headway {}: ".format(i+1), True, white)
-            headway_value = font.render(str(round(headway[i])), True, white)
+        for i in range(len(frame.headway)):
+            headway_text = cache.label("Headway {}: ".format(frame.slots[i]+1))
+            headway_value = cache.value(("headway", i), str(round(frame.headway[i])))
             headway_text_rect = headway_text.get_rect()
             headway_value_rect = headway_value.get_rect()
             headway_text_rect.center = (display_width-220, 25*(i+1))
@@ -309,100 +260,42 @@ def start_simulation(clientList, clientSockList, BUFSIZE = 4096):
             gameDisplay.blit(headway_text, headway_text_rect)
             gameDisplay.blit(headway_value, headway_value_rect)
 
-        # PRINT POSITION INFORMATION RECEIVED BY SERVER
-        print("POSITIONS RECEIVED: {}".format([float(value) for key, value in dataList.items()]))
-
-        # LOOP TO WRITE POSITION INFORMATION OF CLIENTS IN A TEXT FILE
-        for key, value in dataList.items():
-            positionFile.write("%f "%float(value))
-        positionFile.write("\n")
-        
-        # LOOP TO WRITE SPEED INFORMATION OF CLIENTS IN A TEXT FILE
-        for key, value in speed.items():
-            speedFile.write("%f "%float(value))
-        speedFile.write("\n")
-        
-        # LOOP TO WRITE HEADWAY INFORMATION OF CLIENTS INA  TEXT FILE
-        for item in headway:
-            headwayFile.write("%f "%float(item))
-        headwayFile.write("\n")
+        # RECORD TIMESTAMPED POSITION, SPEED AND HEADWAY OF CLIENTS BY ID, CARS THAT LEFT ARE NaN
+        # (WRITTEN TO DISK BY A BACKGROUND THREAD)
+        recorder.record(time.time(), frame.position, frame.speed, frame.headway, frame.slots)
         
         pygame.display.flip()           # UPDATE WHOLE SCREEN AFTER ALL CARS HAVE BEEN DRAWN ON THE SCREEN
-        clock.tick(120)                 # FRAME RATE
-        gameDisplay.fill(white)         # FILL SCREEN WITH WHITE TO UPDATE THE NEXT FRAME
+        frameMetrics.observe(frameStart)
+        if frametimes is not None:
+            frametimes.append(time.perf_counter() - frameStart)
+        clock.tick(120)                 # FRAME RATE (NEXT FRAME STARTS BY BLITTING THE WHOLE BACKGROUND)
+    
+    recorder.close()                    # WRITE REMAINING SNAPSHOTS TO DISK
         
 #-----------------------------------------------------------------------------
-# Function to receive position and speed information from clients
-# This function is running for each client in a thread
-#-----------------------------------------------------------------------------
-def receivePos(client_sock,key, BUFSIZE = 8196):        # client_sock is the client socket connection variables
-    global lock, dataList, prev, speed, simulationExit  # REFERENCE GLOBAL VARIABLES
-    localList = {}          # LOCAL LIST TO COPY INFORMATION RECEIVED BY CLIENTS
-    while True:             # LOOP TO RECEIVE INFORMATION UNTIL SIMULATION QUITS
-        try:                # RECEIVE 
-            jsonPosList = client_sock.recv(BUFSIZE).decode("utf-8")
-        except socket.error as e:           # CHECK IF THERE WAS AN ERROR WHILE RECEIVING INFORMATION
-            if detectfailure(e):            # IF THERE WAS A FAILURE/ERROR THEN
-                with lock:                  # EXIT SIMULATION LOOP
-                    simulationExit = True
-                sys.exit()
-        if jsonPosList:                     # IF INFORMATION RECEIVED BY CLIENT EXISTS THEN...
-            try:
-                speedPosList = json.loads(jsonPosList)  # UNPACK FROM STRING TO DICTIONARY USING JSON INTO A LOCAL VARIABLE
-            except:                         # IF SERVER COULD NOT UNPACK INFORMATION THEN QUIT SIMULATION
-                with lock:
-                    simulationExit = True
-                sys.exit()
-            
-            # LOOP TO COPT RECIVED INFORMATION TO LOST LIST
-            for i, j in speedPosList.items():
-                localList[i] = float(j)
-            
-            lock.acquire()
-            dataList[key-1] = localList['0']        # GET POSITION OF LEAD CAR
-            speed[key-1] = localList['1']           # GET SPEED OF PLATOON
-            prev = float(dataList[0])           
-            lock.release()
-            # BLOCK TO SEND ACK TO CLIENT ON RECEIVING INFORMATION
-            try:
-                client_sock.send("ACK".encode("utf-8"))
-            except socket.error as e:
-                if detectfailure(e):                # DETECT SOCKET FAILURE TO SEND INFORMATION AND QUIT SIMULATION
-                    with lock:
-                        simulationExit = True
-                    sys.exit()
-            except:                                 # DETECT ANY OTHER ERROR AND QUIT SIMULATION
-                with lock:
-                    simulationExit = True
-                sys.exit()                          
-            # CHECK IF USER QUIT SIMULATION ON CLIENT SIDE, THEN QUIT SIMULATION ON SERVER SIDE
-            if dataList[key-1] < 0 and speed[key-1] < 0:
-                with lock:
-                    simulationExit = True
-                break
-            time.sleep(0.001) 
-        else:
-            print("SYSTEM: Failure detected, quiting now...\r")
-            with lock:
-                simulationExit = True
-            break
-                
-#-----------------------------------------------------------------------------
-# DETECT FAILURE (BROKEN PIPE ERROR), Function to detect socket failure
+# Metrics of the frame loop: frame time, updates received since the previous
+# frame (ingest backlog) and recorder queue
 #-----------------------------------------------------------------------------
-def detectfailure(e):
-    if isinstance(e.args, tuple):
-        if e== errno.EPIPE or e == errno.ECONNRESET:
-            print("SYSTEM: Failure detected, quiting now...\r")
-            return True
-        else:
-            return False
+class FrameMetrics:
+    def __init__(self, ingest, recorder, view):
+        self.updates = ingest.updates
+        self.lastUpdates = self.updates.value
+        self.frameSeconds = metrics.histogram("frame_seconds", view=view)
+        self.pending = metrics.histogram("ingest_pending", metrics.DEPTHS)
+        metrics.gauge("recorder_queue", recorder.full.qsize)     # CHUNKS WAITING FOR DISK
+        metrics.gauge("recorder_dropped", lambda: recorder.dropped)
+
+    def observe(self, frameStart):
+        self.frameSeconds.observe(time.perf_counter() - frameStart)
+        updates = self.updates.value
+        self.pending.observe(updates - self.lastUpdates)
+        self.lastUpdates = updates
 
 #-----------------------------------------------------------------------------
 # Function to return tree speed based on platoon speed
 #-----------------------------------------------------------------------------
 def calcTreeSpeed(speed):
-    if sum(speed.values()) == 0:
+    if sum(speed) == 0:
         return 0
     else:
         leadCarSpeed = round(float(speed[0]),1)
@@ -432,9 +325,68 @@ def calcTreeSpeed(speed):
         return switcher.get(leadCarSpeed,0)
         
 #-----------------------------------------------------------------------------
-# Function to start pygame simulation
+# Surfaces rendered once and reused every frame
+#-----------------------------------------------------------------------------
+class RenderCache:
+    def __init__(self, font, color, display_width, display_height, black):
+        self.font = font
+        self.color = color
+        self.labels = {}                        # STATIC LABEL TEXT -> SURFACE
+        self.values = {}                        # SLOT -> (TEXT, SURFACE), RE-RENDERED ON CHANGE
+        # STATIC ROAD AND GROUND
+        self.background = pygame.Surface((display_width, display_height)).convert()
+        self.background.fill((255, 255, 255))
+        draw_road(self.background, display_width, display_height, black)
+        # TREE AND BUSH SPRITES, ONLY THEIR OFFSETS CHANGE EVERY FRAME
+        self.treeImg = make_circle((0, 125, 0), 25)
+        self.bushImg = make_circle((0, 100, 0), 20)
+
+    #-------------------------------------------------------------------------
+    # TEXT THAT NEVER CHANGES (E.G. "Position 1: ")
+    #-------------------------------------------------------------------------
+    def label(self, text):
+        surf = self.labels.get(text)
+        if surf is None:
+            surf = self.labels[text] = self.font.render(text, True, self.color)
+        return surf
+
+    #-------------------------------------------------------------------------
+    # TEXT SHOWN IN A FIXED SLOT, RE-RENDERED ONLY WHEN IT CHANGES
+    #-------------------------------------------------------------------------
+    def value(self, slot, text):
+        cached = self.values.get(slot)
+        if cached is None or cached[0] != text:
+            cached = self.values[slot] = (text, self.font.render(text, True, self.color))
+        return cached[1]
+
+#-----------------------------------------------------------------------------
+# Function to render a filled circle on a transparent surface
+#-----------------------------------------------------------------------------
+def make_circle(color, radius):
+    surf = pygame.Surface((2*radius, 2*radius), pygame.SRCALPHA).convert_alpha()
+    pygame.draw.circle(surf, color, (radius, radius), radius, 0)
+    return surf
+
+#-----------------------------------------------------------------------------
+# Function to draw background: cached road and ground, trees and bushes at their offsets
+#-----------------------------------------------------------------------------
+def draw_background(gameDisplay, cache, tree, bush, y1, y2):
+    gameDisplay.blit(cache.background, (0, 0))
+    
+    # DRAW TREE ON THE SCREEN
+    for j in range(len(tree)):
+        gameDisplay.blit(cache.treeImg, (tree[j] - 25, y1 - 25))
+        gameDisplay.blit(cache.treeImg, (tree[j] - 25, y2 - 25))
+    
+    # DRAW BUSH ON THE SCREEN
+    for j in range(len(bush)):
+        gameDisplay.blit(cache.bushImg, (bush[j] - 20, y1 - 100 - 20))
+        gameDisplay.blit(cache.bushImg, (bush[j] - 20, y2 + 100 - 20))
+
+#-----------------------------------------------------------------------------
+# Function to draw the static road and ground (rendered once into the cache)
 #-----------------------------------------------------------------------------
-def draw_background(gameDisplay, display_width, display_height, black, tree, bush, y1, y2):
+def draw_road(surface, display_width, display_height, black):
     # DEFINE ROAD RGB COLORS
     road_1 = (120, 120, 120)
     road_2 = (128, 128, 128)    
@@ -451,59 +403,59 @@ def draw_background(gameDisplay, display_width, display_height, black, tree, bus
     ground_1 = (0, 176, 0)
     ground_2 = (0, 192, 0)
     
-    # DEFINE TREE AND BUSH COLORS
-    green = (0, 125, 0)
-    darkGreen = (0, 100, 0)
-    
     # DRAW ROAD ON THE SCREEN
-    pygame.draw.rect(gameDisplay, road_1, (0, display_height/2 - 100, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_2, (0, display_height/2 - 90, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_3, (0, display_height/2 - 80, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_4, (0, display_height/2 - 70, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_5, (0, display_height/2 - 60, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_6, (0, display_height/2 - 50, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_7, (0, display_height/2 - 40, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_8, (0, display_height/2 - 30, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_9, (0, display_height/2 - 20, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_10, (0, display_height/2 - 10, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_10, (0, display_height/2, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_9, (0, display_height/2 + 10, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_8, (0, display_height/2 + 20, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_7, (0, display_height/2 + 30, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_6, (0, display_height/2 + 40, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_5, (0, display_height/2 + 50, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_4, (0, display_height/2 + 60, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_3, (0, display_height/2 + 70, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_2, (0, display_height/2 + 80, display_width, 10), 0)
-    pygame.draw.rect(gameDisplay, road_1, (0, display_height/2 + 90, display_width, 10), 0)
+    pygame.draw.rect(surface, road_1, (0, display_height/2 - 100, display_width, 10), 0)
+    pygame.draw.rect(surface, road_2, (0, display_height/2 - 90, display_width, 10), 0)
+    pygame.draw.rect(surface, road_3, (0, display_height/2 - 80, display_width, 10), 0)
+    pygame.draw.rect(surface, road_4, (0, display_height/2 - 70, display_width, 10), 0)
+    pygame.draw.rect(surface, road_5, (0, display_height/2 - 60, display_width, 10), 0)
+    pygame.draw.rect(surface, road_6, (0, display_height/2 - 50, display_width, 10), 0)
+    pygame.draw.rect(surface, road_7, (0, display_height/2 - 40, display_width, 10), 0)
+    pygame.draw.rect(surface, road_8, (0, display_height/2 - 30, display_width, 10), 0)
+    pygame.draw.rect(surface, road_9, (0, display_height/2 - 20, display_width, 10), 0)
+    pygame.draw.rect(surface, road_10, (0, display_height/2 - 10, display_width, 10), 0)
+    pygame.draw.rect(surface, road_10, (0, display_height/2, display_width, 10), 0)
+    pygame.draw.rect(surface, road_9, (0, display_height/2 + 10, display_width, 10), 0)
+    pygame.draw.rect(surface, road_8, (0, display_height/2 + 20, display_width, 10), 0)
+    pygame.draw.rect(surface, road_7, (0, display_height/2 + 30, display_width, 10), 0)
+    pygame.draw.rect(surface, road_6, (0, display_height/2 + 40, display_width, 10), 0)
+    pygame.draw.rect(surface, road_5, (0, display_height/2 + 50, display_width, 10), 0)
+    pygame.draw.rect(surface, road_4, (0, display_height/2 + 60, display_width, 10), 0)
+    pygame.draw.rect(surface, road_3, (0, display_height/2 + 70, display_width, 10), 0)
+    pygame.draw.rect(surface, road_2, (0, display_height/2 + 80, display_width, 10), 0)
+    pygame.draw.rect(surface, road_1, (0, display_height/2 + 90, display_width, 10), 0)
     
     # DRAW GROUND ON THE SCREEN
-    pygame.draw.rect(gameDisplay, black, (0, display_height/2 - 600, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, black, (0, display_height/2 - 500, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, black, (0, display_height/2 - 400, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, ground_2, (0, display_height/2 - 300, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, ground_1, (0, display_height/2 - 200, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, ground_1, (0, display_height/2 + 100, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, ground_2, (0, display_height/2 + 200, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, black, (0, display_height/2 + 300, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, black, (0, display_height/2 + 400, display_width, 100), 0)
-    pygame.draw.rect(gameDisplay, black, (0, display_height/2 + 500, display_width, 100), 0)
+    pygame.draw.rect(surface, black, (0, display_height/2 - 600, display_width, 100), 0)
+    pygame.draw.rect(surface, black, (0, display_height/2 - 500, display_width, 100), 0)
+    pygame.draw.rect(surface, black, (0, display_height/2 - 400, display_width, 100), 0)
+    pygame.draw.rect(surface, ground_2, (0, display_height/2 - 300, display_width, 100), 0)
+    pygame.draw.rect(surface, ground_1, (0, display_height/2 - 200, display_width, 100), 0)
+    pygame.draw.rect(surface, ground_1, (0, display_height/2 + 100, display_width, 100), 0)
+    pygame.draw.rect(surface, ground_2, (0, display_height/2 + 200, display_width, 100), 0)
+    pygame.draw.rect(surface, black, (0, display_height/2 + 300, display_width, 100), 0)
+    pygame.draw.rect(surface, black, (0, display_height/2 + 400, display_width, 100), 0)
+    pygame.draw.rect(surface, black, (0, display_height/2 + 500, display_width, 100), 0)
 
     # DRAW SIDE LINES OF THE ROAD
-    pygame.draw.line(gameDisplay,black, (0,display_height/2 - 100),(display_width,display_height/2 - 100), 4)
-    pygame.draw.line(gameDisplay,black, (0,display_height/2 + 100),(display_width,display_height/2 + 100), 4)
+    pygame.draw.line(surface,black, (0,display_height/2 - 100),(display_width,display_height/2 - 100), 4)
+    pygame.draw.line(surface,black, (0,display_height/2 + 100),(display_width,display_height/2 + 100), 4)
     
-    # DRAW TREE ON THE SCREEN
-    for j in range(len(tree)):
-        pygame.draw.circle(gameDisplay, green, (tree[j],y1), 25, 0)
-        pygame.draw.circle(gameDisplay, green, (tree[j],y2), 25, 0)
-    
-    # DRAW BUSH ON THE SCREEN
-    for j in range(len(bush)):
-        pygame.draw.circle(gameDisplay, darkGreen, (bush[j],y1-100), 20, 0)
-        pygame.draw.circle(gameDisplay, darkGreen, (bush[j],y2+100), 20, 0)
-
 #-----------------------------------------------------------------------------
 ################################ MAIN FUNCTION ###############################
 if __name__ == "__main__":
-    initialize()
+    parser = argparse.ArgumentParser(description="P2P platoon simulation server")
+    parser.add_argument("--headless", action="store_true", help="record the simulation without pygame or a display")
+    parser.add_argument("--transport", choices=("tcp", "unix"), default="tcp", help="transport clients connect through (default %(default)s)")
+    parser.add_argument("--shm", action="store_true", help="cars on this machine write positions to shared memory (clients need --shm too)")
+    parser.add_argument("--stats", type=float, default=0, help="print metrics to stderr every SEC seconds (default off)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve metrics on http://127.0.0.1:PORT/metrics (default off)")
+    parser.add_argument("--expect", type=int, default=0, help="platoon size: admit the first N cars without 'c', in parallel (default off)")
+    parser.add_argument("--platoon", type=int, default=0, help="serve this platoon, cars join with --platoon too (default %(default)s)")
+    args = parser.parse_args()
+    if args.expect > transport.MAXCARS:
+        sys.exit("SYSTEM: at most {} cars per platoon".format(transport.MAXCARS))
+    if pygame is None and not args.headless:
+        print("SYSTEM: pygame is not installed, running headless.")
+        args.headless = True
+    initialize(args)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sharded platoon server
+
+Runs P independent platoons on one machine, each owned by its own worker
+process: the ingest event loop, state and recording of platoon K live in
+worker K, which serves on the port of platoon K (cars join it with
+client.py --platoon K). Workers share no lock, memory or interpreter, so
+platoons do not contend on one GIL. The coordinator starts the workers,
+reports the admission of every platoon (listening, started with N cars,
+exited) and, once every platoon exited, merges their recordings into one.
+
+    python3 shard.py P [--transport tcp|unix] [--shm] [--expect N] [--prefix PREFIX] [--metrics-port PORT]
+
+Platoon K records to PREFIX + "pK_", the merged recording is written to
+PREFIX (see merge): one column per car, platoon after platoon, sampled at
+--rate snapshots per second.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import sys, time, queue, socket, argparse, multiprocessing
+import numpy as np
+import transport, metrics, recorder
+
+#-----------------------------------------------------------------------------
+# Function run by worker K: serve platoon K until it exits, events go to the coordinator
+#-----------------------------------------------------------------------------
+def worker(platoon, args, events):
+    import server
+    from ingest import IngestServer
+    if args.metrics_port:
+        metrics.registry.serve(args.metrics_port + platoon)
+    port = transport.platoon_port(platoon)
+    ingest = IngestServer(args.host, port, link=transport.get(args.transport), shared=args.shm, expect=args.expect)
+    try:
+        ingest.start()
+    except OSError as e:
+        events.put(("failed", platoon, str(e)))
+        return
+    events.put(("listening", platoon, port))
+    ingest.started.wait()                       # WAIT UNTIL LEAD CAR OF THIS PLATOON STARTS
+    events.put(("started", platoon, len(ingest.clientList)))
+    server.run_headless(ingest, args.prefix + "p{}_".format(platoon))
+    ingest.stop()
+    events.put(("exited", platoon, len(ingest.clientList)))
+
+#-----------------------------------------------------------------------------
+# Coordinator of P platoons
+#-----------------------------------------------------------------------------
+class Coordinator:
+    def __init__(self, numplatoons, args):
+        self.numplatoons = numplatoons
+        self.args = args
+        context = multiprocessing.get_context("spawn")   # WORKERS START CLEAN, NO THREADS FORKED
+        self.events = context.Queue()
+        self.workers = [context.Process(target=worker, name="platoon {}".format(k), args=(k, args, self.events))
+                        for k in range(numplatoons)]
+        self.state = ["starting"]*numplatoons   # LAST EVENT OF EVERY PLATOON
+
+    #-------------------------------------------------------------------------
+    # START WORKERS, RETURNS WHEN EVERY PLATOON EXITED
+    #-------------------------------------------------------------------------
+    def run(self):
+        start = time.monotonic()
+        for w in self.workers:
+            w.start()
+        try:
+            while any(state not in ("exited", "failed") for state in self.state):
+                try:
+                    event, platoon, value = self.events.get(timeout=1.0)
+                except queue.Empty:             # CHECK FOR WORKERS THAT DIED
+                    for k, w in enumerate(self.workers):
+                        if not w.is_alive() and self.state[k] not in ("exited", "failed"):
+                            print("SYSTEM: platoon {} worker died (exit code {}).".format(k, w.exitcode))
+                            self.state[k] = "failed"
+                    continue
+                self.state[platoon] = event
+                elapsed = time.monotonic() - start
+                if event == "listening":
+                    print("SYSTEM: platoon {} listening on port {} ({:.3f} s).".format(platoon, value, elapsed))
+                elif event == "started":
+                    print("SYSTEM: platoon {} started with {} cars ({:.3f} s), {} of {} platoons running.".format(
+                        platoon, value, elapsed, self.state.count("started"), self.numplatoons))
+                elif event == "exited":
+                    print("SYSTEM: platoon {} exited ({:.3f} s).".format(platoon, elapsed))
+                else:
+                    print("SYSTEM: platoon {} failed: {}".format(platoon, value))
+        finally:
+            for w in self.workers:
+                w.join(5)
+                if w.is_alive():
+                    w.terminate()
+        return [k for k in range(self.numplatoons) if self.state[k] == "exited"]
+
+#-----------------------------------------------------------------------------
+# Function to merge the recordings of several platoons into one recording at prefix
+# EVERY PLATOON HAS ITS OWN TIMES, EACH IS SAMPLED AT THE LAST SNAPSHOT NOT
+# AFTER EVERY TICK OF A COMMON CLOCK (FIRST SNAPSHOT BEFORE IT STARTED)
+#-----------------------------------------------------------------------------
+def merge(prefixes, prefix, rate=100.0):
+    platoons = []
+    for p in prefixes:
+        columns = {name: recorder.load(p, name) for name in recorder.COLUMNS}
+        if len(columns["time"]):
+            platoons.append(columns)
+    if not platoons:
+        print("SYSTEM: nothing recorded, no merged recording written.")
+        return 0
+    t0 = min(columns["time"][0] for columns in platoons)
+    t1 = max(columns["time"][-1] for columns in platoons)
+    times = t0 + np.arange(int((t1 - t0)*rate) + 1)/rate
+    merged = {"time": times}
+    for name in recorder.COLUMNS[1:]:
+        parts = []
+        for columns in platoons:
+            rows = np.searchsorted(columns["time"], times, side="right") - 1
+            parts.append(columns[name][np.clip(rows, 0, None)])
+        merged[name] = np.hstack(parts)
+    # PLATOON OF EVERY COLUMN, NOT PART OF THE RECORDER FORMAT
+    merged["platoon"] = np.concatenate([np.full(columns["position"].shape[1], k) for k, columns in enumerate(platoons)])
+    for name, data in merged.items():
+        with open(prefix + name + ".npy", "wb") as f:
+            np.save(f, data)
+    print("SYSTEM: {} platoons, {} cars, {} snapshots merged to {}*.npy".format(
+        len(platoons), merged["position"].shape[1], len(times), prefix))
+    return len(times)
+
+#-----------------------------------------------------------------------------
+################################ MAIN FUNCTION ###############################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several platoons on one machine, one worker process each")
+    parser.add_argument("platoons", type=int, help="number of platoons")
+    parser.add_argument("--host", default=socket.gethostbyname(socket.gethostname()), help="address the workers listen on (default this host)")
+    parser.add_argument("--transport", choices=("tcp", "unix"), default="tcp", help="transport clients connect through (default %(default)s)")
+    parser.add_argument("--shm", action="store_true", help="cars on this machine write positions to shared memory (clients need --shm too)")
+    parser.add_argument("--expect", type=int, default=0, help="cars per platoon: admit them without 'c', in parallel (default off)")
+    parser.add_argument("--prefix", default="demo1_", help="prefix of the merged recording (default %(default)s)")
+    parser.add_argument("--rate", type=float, default=100.0, help="snapshots per second of the merged recording (default %(default)s)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="platoon K serves metrics on http://127.0.0.1:PORT+K/metrics (default off)")
+    args = parser.parse_args()
+    if args.platoons*transport.PLATOONPORTS + transport.PORT > 65535:
+        sys.exit("SYSTEM: at most {} platoons".format((65535 - transport.PORT)//transport.PLATOONPORTS))
+    if args.expect > transport.MAXCARS:
+        sys.exit("SYSTEM: at most {} cars per platoon".format(transport.MAXCARS))
+    done = Coordinator(args.platoons, args).run()
+    merge([args.prefix + "p{}_".format(k) for k in done], args.prefix, args.rate)
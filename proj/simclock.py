@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixed-timestep simulation clock
+
+Every tick advances simulation time by the same dt, and tick() sleeps until
+the wall clock deadline of the next tick, so the simulation runs at the same
+speed on any hardware instead of as fast as the loop can spin.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import time
+
+MAXLAG = 10             # TICKS BEHIND SCHEDULE BEFORE CLOCK STOPS CATCHING UP
+
+#-----------------------------------------------------------------------------
+# Fixed-timestep clock
+#-----------------------------------------------------------------------------
+class SimClock:
+    def __init__(self, tickrate):
+        self.tickrate = tickrate            # TICKS PER SECOND
+        self.dt = 1.0/tickrate              # SIMULATION SECONDS PER TICK
+        self.ticks = 0                      # TICKS SINCE START
+        self.deadline = None                # WALL CLOCK TIME OF NEXT TICK
+
+    #-------------------------------------------------------------------------
+    # SLEEP UNTIL NEXT TICK IS DUE, RETURNS dt
+    #-------------------------------------------------------------------------
+    def tick(self):
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += self.dt
+        delay = self.deadline - now
+        if delay > 0:
+            time.sleep(delay)
+        # IF FAR BEHIND SCHEDULE (E.G. PROCESS WAS SUSPENDED), DO NOT RUN A BURST OF TICKS
+        elif delay < -MAXLAG*self.dt:
+            self.deadline = now
+        self.ticks += 1
+        return self.dt
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sequence-locked snapshot store
+
+Holds the latest position, speed and receive time of every car in one
+structured NumPy array. The writer (ingest event loop) publishes per-car
+updates without taking a lock: it makes the store sequence odd, writes the
+slot and makes the sequence even again. Readers (render loop, recorder) copy
+the whole array and retry if the sequence was odd or changed during the copy,
+so every frame sees one consistent, immutable view of all cars.
+
+SharedStore keeps the same slots in shared memory for cars running on the
+same machine as the server. Every car writes only its own slot, so each slot
+has its own sequence counter: readers (server, car behind) retry a slot that
+was being written. A snapshot is consistent per car, not across cars.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+#-----------------------------------------------------------------------------
+# ONE SLOT PER CAR: SEQUENCE (ODD WHILE SLOT IS WRITTEN, +2 PER UPDATE), POSITION, SPEED, TIME OF LAST UPDATE
+SLOT = np.dtype([("seq", np.uint64), ("pos", np.float64), ("speed", np.float64), ("time", np.float64)])
+
+#-----------------------------------------------------------------------------
+# Snapshot store, index i holds car with ID i+1
+#-----------------------------------------------------------------------------
+class SnapshotStore:
+    def __init__(self, numcars):
+        self.numcars = numcars
+        self.slots = np.zeros(numcars, dtype=SLOT)      # LATEST STATE OF EVERY CAR
+        self.seq = 0                                    # ODD WHILE A WRITE IS IN PROGRESS
+        self.retries = 0                                # SNAPSHOTS COPIED AGAIN, WRITER WAS BUSY
+
+    #-------------------------------------------------------------------------
+    # PUBLISH ONE CAR UPDATE, SINGLE WRITER ONLY
+    #-------------------------------------------------------------------------
+    def update(self, idx, pos, speed, t):
+        self.seq += 1
+        slot = self.slots[idx]
+        slot["seq"] += 1
+        slot["pos"] = pos
+        slot["speed"] = speed
+        slot["time"] = t
+        slot["seq"] += 1
+        self.seq += 1
+
+    #-------------------------------------------------------------------------
+    # INITIALIZE POSITION OF ALL CARS, SPEED 0
+    #-------------------------------------------------------------------------
+    def reset(self, positions, t):
+        self.seq += 1
+        self.slots["seq"] = 0
+        self.slots["pos"] = positions
+        self.slots["speed"] = 0.0
+        self.slots["time"] = t
+        self.seq += 1
+
+    #-------------------------------------------------------------------------
+    # CONSISTENT READ-ONLY COPY OF ALL CARS
+    #-------------------------------------------------------------------------
+    def snapshot(self):
+        while True:
+            before = self.seq
+            if before % 2 == 0:
+                view = self.slots.copy()
+                if self.seq == before:
+                    view.flags.writeable = False
+                    return view
+            self.retries += 1
+
+#-----------------------------------------------------------------------------
+# Function to name the shared memory of the server listening on port
+#-----------------------------------------------------------------------------
+def shared_name(port):
+    return "platoon_{}".format(port)
+
+#-----------------------------------------------------------------------------
+# Snapshot store in shared memory, one writer per slot
+#-----------------------------------------------------------------------------
+class SharedStore:
+    created = set()                                     # SEGMENTS CREATED BY THIS PROCESS
+
+    def __init__(self, name, numcars, create=False):
+        self.numcars = numcars
+        self.owner = create                             # CREATOR REMOVES THE SHARED MEMORY
+        if create:
+            try:                                        # STALE SEGMENT FROM A PREVIOUS RUN
+                shared_memory.SharedMemory(name=name).unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=numcars*SLOT.itemsize)
+            self.created.add(name)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # ONLY THE CREATOR MAY REMOVE THE SEGMENT, NOT THE RESOURCE TRACKER OF AN ATTACHED PROCESS
+            if name not in self.created:
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.slots = np.ndarray(numcars, dtype=SLOT, buffer=self.shm.buf)
+        self.retries = 0                                # SLOTS COPIED AGAIN, WRITER WAS BUSY
+
+    #-------------------------------------------------------------------------
+    # PUBLISH ONE CAR UPDATE, ONLY THE OWNER OF SLOT idx MAY CALL THIS
+    #-------------------------------------------------------------------------
+    def update(self, idx, pos, speed, t):
+        seq = self.slots["seq"]
+        seq[idx] += 1
+        self.slots["pos"][idx] = pos
+        self.slots["speed"][idx] = speed
+        self.slots["time"][idx] = t
+        seq[idx] += 1
+
+    #-------------------------------------------------------------------------
+    # INITIALIZE POSITION OF ALL CARS, BEFORE ANY CAR ATTACHES
+    #-------------------------------------------------------------------------
+    def reset(self, positions, t):
+        self.slots["seq"] = 0
+        self.slots["pos"] = positions
+        self.slots["speed"] = 0.0
+        self.slots["time"] = t
+
+    #-------------------------------------------------------------------------
+    # CONSISTENT COPY OF ONE SLOT
+    #-------------------------------------------------------------------------
+    def read(self, idx):
+        while True:
+            before = self.slots["seq"][idx]
+            if before % 2 == 0:
+                slot = self.slots[idx].copy()
+                if self.slots["seq"][idx] == before:
+                    return slot
+            self.retries += 1
+
+    #-------------------------------------------------------------------------
+    # READ-ONLY COPY OF ALL CARS, EVERY SLOT CONSISTENT
+    #-------------------------------------------------------------------------
+    def snapshot(self):
+        before = self.slots["seq"].copy()
+        view = self.slots.copy()
+        # COPY AGAIN ONLY THE SLOTS THAT WERE BEING WRITTEN
+        busy = np.flatnonzero((before % 2 == 1) | (self.slots["seq"] != before))
+        for idx in busy:
+            view[idx] = self.read(idx)
+        view.flags.writeable = False
+        return view
+
+    #-------------------------------------------------------------------------
+    # DETACH, CREATOR ALSO REMOVES THE SEGMENT
+    #-------------------------------------------------------------------------
+    def close(self):
+        del self.slots
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            self.created.discard(self.shm.name)
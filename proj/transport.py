@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Transport layer
+
+The server handshake, server telemetry and peer links are opened through a
+transport instead of hardwired TCP sockets. Every endpoint is named by
+(host, port) as before; the transport decides what that means:
+
+    tcp     TCP socket on host:port (default, cars on different machines)
+    unix    Unix domain socket DIRECTORY/platoon-PORT.sock, host is ignored
+    inproc  in-process endpoint registered under PORT, host is ignored
+
+An in-process connection is a socketpair handed straight to the listener,
+so no port is used and no TCP stack is involved, but both ends are still
+real sockets: select(), timeouts and asyncio streams work unchanged.
+"""
+#-----------------------------------------------------------------------------
+# IMPORT PACKAGES
+import asyncio, os, queue, socket, tempfile
+from threading import Lock
+
+PORT = 6789             # SERVER PORT OF PLATOON 0, CAR ID LISTENS ON SERVER PORT + ID
+PLATOONPORTS = 1000     # PORTS PER PLATOON: SERVER, ITS CARS AND ITS AGGREGATORS
+GROUPPORTS = 900        # AGGREGATOR G OF A PLATOON LISTENS ON ITS SERVER PORT + GROUPPORTS + G
+MAXCARS = GROUPPORTS - 1                # CAR IDS 1 .. MAXCARS, A HIGHER ID WOULD LISTEN ON AN AGGREGATOR PORT
+MAXGROUPS = PLATOONPORTS - GROUPPORTS   # GROUPS 0 .. MAXGROUPS - 1, A HIGHER ONE WOULD TAKE THE NEXT PLATOON'S PORTS
+
+#-----------------------------------------------------------------------------
+# Function to get the server port of a platoon, several platoons share a machine (see shard.py)
+#-----------------------------------------------------------------------------
+def platoon_port(platoon):
+    return PORT + platoon*PLATOONPORTS
+
+#-----------------------------------------------------------------------------
+# Function to get the port of aggregator group of a platoon (see aggregator.py)
+#-----------------------------------------------------------------------------
+def group_port(platoon, group):
+    return platoon_port(platoon) + GROUPPORTS + group
+
+#-----------------------------------------------------------------------------
+# Socket written by several threads (e.g. the server link of a car): one
+# sendall at a time, so frames of different threads never interleave
+#-----------------------------------------------------------------------------
+class SerialSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = Lock()                      # HELD FOR A WHOLE FRAME
+
+    def sendall(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+#-----------------------------------------------------------------------------
+# TCP sockets
+#-----------------------------------------------------------------------------
+class TCPTransport:
+    name = "tcp"
+
+    def listen(self, host, port, backlog=1):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+        return sock
+
+    def connect(self, host, port, timeout=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect((host, port))
+        except:
+            sock.close()
+            raise
+        return sock
+
+    async def start_server(self, handler, host, port, backlog):
+        return await asyncio.start_server(handler, host, port, backlog=backlog, reuse_address=True)
+
+#-----------------------------------------------------------------------------
+# Unix domain sockets, one socket file per port
+#-----------------------------------------------------------------------------
+class UnixTransport:
+    name = "unix"
+
+    def __init__(self, directory=None):
+        self.directory = directory or tempfile.gettempdir()
+
+    def path(self, port):
+        return os.path.join(self.directory, "platoon-{}.sock".format(port))
+
+    def listen(self, host, port, backlog=1):
+        path = self.path(port)
+        if os.path.exists(path):                # STALE SOCKET FILE FROM A PREVIOUS RUN
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(backlog)
+        return sock
+
+    def connect(self, host, port, timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path(port))
+        except:
+            sock.close()
+            raise
+        return sock
+
+    async def start_server(self, handler, host, port, backlog):
+        path = self.path(port)
+        if os.path.exists(path):
+            os.unlink(path)
+        return await asyncio.start_unix_server(handler, path, backlog=backlog)
+
+#-----------------------------------------------------------------------------
+# In-process listener, accept() returns the server end of a socketpair
+#-----------------------------------------------------------------------------
+class InProcListener:
+    def __init__(self, port):
+        self.port = port
+        self.pending = queue.Queue()            # CONNECTIONS NOT ACCEPTED YET
+        self.handler = None                     # ASYNCIO HANDLER, SET BY start_server()
+        self.loop = None
+
+    def deliver(self, sock):
+        if self.handler is None:
+            self.pending.put(sock)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.create_task, self.serve(sock))
+
+    async def serve(self, sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.handler(reader, writer)
+
+    def accept(self):
+        sock = self.pending.get()
+        if sock is None:                        # LISTENER WAS CLOSED
+            raise OSError("listener closed")
+        return sock, ("inproc", self.port)
+
+    def close(self):
+        InProcTransport.unregister(self)
+        self.pending.put(None)
+
+    # SAME USE AS THE SERVER RETURNED BY asyncio.start_server()
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+#-----------------------------------------------------------------------------
+# In-process endpoints, shared by every instance in the process
+#-----------------------------------------------------------------------------
+class InProcTransport:
+    name = "inproc"
+    listeners = {}                              # PORT -> InProcListener
+    lock = Lock()
+
+    @classmethod
+    def unregister(cls, listener):
+        with cls.lock:
+            if cls.listeners.get(listener.port) is listener:
+                del cls.listeners[listener.port]
+
+    def register(self, listener):
+        with self.lock:
+            if listener.port in self.listeners:
+                raise OSError("in-process port {} already in use".format(listener.port))
+            self.listeners[listener.port] = listener
+        return listener
+
+    def listen(self, host, port, backlog=1):
+        return self.register(InProcListener(port))
+
+    def connect(self, host, port, timeout=None):
+        with self.lock:
+            listener = self.listeners.get(port)
+        if listener is None:
+            raise ConnectionRefusedError("no in-process listener on port {}".format(port))
+        mine, theirs = socket.socketpair()
+        mine.settimeout(timeout)
+        listener.deliver(theirs)
+        return mine
+
+    async def start_server(self, handler, host, port, backlog):
+        listener = InProcListener(port)
+        listener.loop = asyncio.get_running_loop()
+        listener.handler = handler              # SET BEFORE REGISTERING, NO CONNECTION IS LEFT PENDING
+        return self.register(listener)
+
+TRANSPORTS = {"tcp": TCPTransport, "unix": UnixTransport, "inproc": InProcTransport}
+
+#-----------------------------------------------------------------------------
+# Function to create a transport by name
+#-----------------------------------------------------------------------------
+def get(name):
+    return TRANSPORTS[name]()